@@ -0,0 +1,199 @@
+'''
+Analyzes tracks in the background on a pool of worker processes: their metadata and duration, and (with NumPy) their
+ReplayGain and waveform. Results are stored in the library as each track is analyzed, so an analysis that is
+cancelled (or interrupted by quitting) resumes where it stopped when it is run again.
+'''
+
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+
+import backend
+import dsp
+import library
+import replaygain
+import waveform
+
+
+# -----------------------------------------
+# Types
+# -----------------------------------------
+
+class Analysis(object):
+    '''An analysis of a list of files, coordinated by its own thread. Files whose results are already stored in the
+       library are skipped. Only a few files per worker are submitted at a time, so cancelling is prompt.'''
+    def __init__(self, paths):
+        self.total = len(paths)
+        self.analyzed = 0
+        self.skipped = 0            # Files already analyzed
+        self.failed = 0
+        self.seconds = 0.0          # Total duration of the files analyzed or skipped
+        self.done = False
+        self.__paths = paths
+        self.__cancelled = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+
+    def start(self):
+        self.__thread.start()
+
+    def cancel(self):
+        '''Stops the analysis. Files already being analyzed are finished and stored.'''
+        self.__cancelled.set()
+
+    def is_cancelled(self):
+        return self.__cancelled.is_set()
+
+    def get_progress(self):
+        '''Returns the number of files that have been analyzed, skipped or have failed'''
+        return self.analyzed + self.skipped + self.failed
+
+    def __run(self):
+        '''Submits the files that need analyzing to the workers, storing their results as they complete'''
+        try:
+            # Workers are started fresh rather than forked, as forking would copy the state of the player's threads
+            context = multiprocessing.get_context('spawn')
+            with concurrent.futures.ProcessPoolExecutor(max_workers=__WORKERS__, mp_context=context) as executor:
+                paths = iter(self.__paths)
+                pending = {}        # Future -> (absolute path, stat) of the file it analyzes
+                while not self.is_cancelled():
+                    while len(pending) < __WORKERS__ * __QUEUED_PER_WORKER__:
+                        path = next(paths, None)
+                        if path is None:
+                            break
+                        self.__submit(executor, pending, os.path.abspath(path))
+                    if len(pending) == 0:
+                        break
+
+                    completed, running = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in completed:
+                        key, stat = pending.pop(future)
+                        self.__store(future, key, stat)
+
+                executor.shutdown(wait=True, cancel_futures=True)
+                for future, (key, stat) in pending.items():
+                    if future.done() and not future.cancelled():
+                        self.__store(future, key, stat)
+        finally:
+            self.done = True
+
+    def __submit(self, executor, pending, key):
+        '''Submits a file for analysis, unless its results are already stored'''
+        try:
+            stat = os.stat(key)
+        except OSError:
+            self.failed = self.failed + 1
+            return
+
+        meta = get_stored_metadata(key, stat)
+        if meta is not None:
+            self.skipped = self.skipped + 1
+            self.seconds = self.seconds + (meta.duration or 0.0)
+            return
+        pending[executor.submit(analyze_file, key)] = (key, stat)
+
+    def __store(self, future, key, stat):
+        '''Stores the results of an analysis in the library'''
+        try:
+            fields, gain, peaks = future.result()
+        except Exception:
+            self.failed = self.failed + 1
+            return
+
+        meta = library.TrackMetadata(*fields)
+        library.store(key, stat, meta)
+        if dsp.is_available():
+            replaygain.store_replaygain(key, stat, replaygain.ReplayGain.from_bytes(gain) if gain is not None else None)
+            waveform.store_peaks(key, stat, peaks)
+        self.analyzed = self.analyzed + 1
+        self.seconds = self.seconds + (meta.duration or 0.0)
+
+
+# -----------------------------------------
+# Global constants
+# -----------------------------------------
+
+__WORKERS__ = max(1, (os.cpu_count() or 1) - 1)     # A core is left for playback
+__QUEUED_PER_WORKER__ = 2       # Files submitted per worker ahead of those being analyzed
+
+
+# -----------------------------------------
+# Global variables
+# -----------------------------------------
+
+__analysis__ = None             # The running (or last) analysis
+
+
+# -----------------------------------------
+# Functions
+# -----------------------------------------
+
+def start_analysis(paths):
+    '''Starts analyzing the specified files in the background, returning the analysis, or None if one is already running'''
+    global __analysis__
+    if is_analyzing():
+        return None
+    __analysis__ = Analysis(paths)
+    __analysis__.start()
+    return __analysis__
+
+
+def get_analysis():
+    '''Returns the running analysis, or the last one if none is running (None if none has been started)'''
+    return __analysis__
+
+
+def is_analyzing():
+    return __analysis__ is not None and not __analysis__.done
+
+
+def cancel():
+    '''Cancels the running analysis, if any'''
+    if __analysis__ is not None:
+        __analysis__.cancel()
+
+
+def forget_analysis():
+    '''Forgets the last analysis, once it is done and its results have been reported'''
+    global __analysis__
+    if __analysis__ is not None and __analysis__.done:
+        __analysis__ = None
+
+
+def get_stored_metadata(key, stat):
+    '''Returns the stored metadata of a file if all of its analysis is stored and still valid, otherwise None.
+       Its metadata and ReplayGain are loaded into memory, so that they are known before the file is played.'''
+    meta = library.prime(key, stat)
+    if meta is None:
+        return None
+    if dsp.is_available():
+        if library.lookup_blob(replaygain.__CACHE_KIND__, key, stat) is None or library.lookup_blob(waveform.__CACHE_KIND__, key, stat) is None:
+            return None
+        replaygain.get_replaygain(key)
+    return meta
+
+
+def analyze_file(path):
+    '''Analyzes a single file. Runs in a worker process, so the results are returned rather than stored:
+       the metadata fields (see library.TrackMetadata), and the ReplayGain and peaks (as bytes, or None).
+       The file is decoded once, for both its loudness and its peaks. Its ReplayGain tags are used if it has any.'''
+    source = backend.get_pyglet().media.load(path, streaming=True)
+    meta = library.TrackMetadata.from_source(source)
+    if not dsp.is_available():
+        return [getattr(meta, field) for field in library.__FIELDS__], None, None
+
+    gain = replaygain.read_tags(path)
+    loudness = replaygain.LoudnessMeter(source.audio_format) if gain is None else None
+    peaks = waveform.PeakMeter()
+    frames_read = 0
+    for frames in dsp.read_frames(source):
+        peaks.add(frames)
+        if loudness is not None:
+            loudness.add(frames)
+        frames_read = frames_read + len(frames)
+
+    if loudness is not None:
+        gain = loudness.get_replaygain()
+    if not meta.duration and frames_read > 0:
+        meta.duration = frames_read / source.audio_format.sample_rate
+    return [getattr(meta, field) for field in library.__FIELDS__], gain.to_bytes() if gain is not None else None, peaks.get_peaks()
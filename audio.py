@@ -2,9 +2,21 @@
 Handles all-audio related logic
 '''
 
+import collections
+import concurrent.futures
 from enum import Enum
+import functools
 import os.path
-import pyglet
+
+import backend
+import dsp
+import library
+import playlist
+import replaygain
+import search
+import session
+import shuffle
+import stats
 
 
 # -----------------------------------------
@@ -17,30 +29,52 @@ class PlaybackState(Enum):
     PLAYING = 2
     PAUSED = 3
 
+class RepeatMode(Enum):
+    '''What plays once the playlist has been played to its end: nothing, the current track again, or the whole playlist'''
+    OFF = 1
+    ONE = 2
+    ALL = 3
+
 class Duration(object):
-    '''Stores the duration of a track'''
+    '''Stores the duration of a track, in whole seconds. Durations are immutable, so the same object can be shared:
+       from_seconds() returns cached durations, and the playing time is redrawn without allocating a new one each time.'''
+    __slots__ = ('hours', 'minutes', 'seconds', 'totalseconds', '__timestamp')
+
     def __init__(self, hours = 0, minutes = 0, seconds = 0):
-        self.hours = hours
-        self.minutes = minutes
-        self.seconds = seconds
-        self.totalseconds = (hours * 3600) + (minutes * 60) + seconds
+        totalseconds = (hours * 3600) + (minutes * 60) + seconds
+        object.__setattr__(self, 'hours', totalseconds // 3600)
+        object.__setattr__(self, 'minutes', totalseconds // 60 % 60)
+        object.__setattr__(self, 'seconds', totalseconds % 60)
+        object.__setattr__(self, 'totalseconds', totalseconds)
+        object.__setattr__(self, '_Duration__timestamp', '{:02d}:{:02d}:{:02d}'.format(self.hours, self.minutes, self.seconds))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Duration is immutable')
 
-    def set_from_sec(self, sec):
-        self.hours = int(sec / 3600)
-        self.minutes = int(sec / 60) % 60
-        self.seconds = int(sec) % 60
-        self.totalseconds = sec
+    def __eq__(self, other):
+        return isinstance(other, Duration) and self.totalseconds == other.totalseconds
+
+    def __hash__(self):
+        return hash(self.totalseconds)
+
+    @staticmethod
+    def from_seconds(sec):
+        '''Returns the duration of the whole seconds in sec'''
+        return get_duration(max(0, int(sec)))
 
     def get_timestamp_str(self):
         '''Returns a string-type timestamp in the format of hh:mm:ss'''
-        return '{}:{}:{}'.format('{}'.format(self.hours).rjust(2, '0'), '{}'.format(self.minutes).rjust(2, '0'), '{}'.format(self.seconds).rjust(2, '0'))
+        return self.__timestamp
 
 
 # -----------------------------------------
 # Global constants
 # -----------------------------------------
 
-__SUPPORTED_FORMATS__ = ['au', 'mp2', 'mp3', 'ogg', 'wav', 'wma', 'flac', 'm4a']
+__SUPPORTED_FORMATS__ = frozenset(['au', 'mp2', 'mp3', 'ogg', 'wav', 'wma', 'flac', 'm4a'])
+__PREFETCH_DEPTH__ = 2          # Number of upcoming playlist tracks to load and queue ahead of time
+__LOAD_POLL_INTERVAL__ = 0.02   # Seconds between checks for completed loads
+__DURATION_CACHE_SIZE__ = 4096  # Number of distinct durations kept for reuse
 
 
 # -----------------------------------------
@@ -49,9 +83,33 @@ __SUPPORTED_FORMATS__ = ['au', 'mp2', 'mp3', 'ogg', 'wav', 'wma', 'flac', 'm4a']
 
 __player__ = None
 
-__playlist__ = []
-__current_track_idx__ = 0
+__playlist__ = playlist.Playlist()
+__current_track_id__ = None     # Id of the current track in the playlist. None refers to the first track.
+__search_index__ = None         # Index of the words of the playlist tracks, built in the background on the first search
+__search_build__ = None         # Future of the index being built, or None
+__search_edits__ = []           # Playlist edits made while the index was being built: (True, ids) added, (False, texts) removed
+__search_untagged__ = {}        # Absolute path -> ids of the tracks indexed before their tags were known
+__search_library_version__ = 0  # Library version up to which the tags read have been indexed
+__search_version__ = 0          # Incremented whenever the matches of a query change other than by editing the playlist
 __playback_state__ = PlaybackState.STOPPED
+__repeat_mode__ = RepeatMode.ALL
+__shuffle__ = None              # Shuffled play order (see shuffle.ShuffleOrder), while shuffle is on
+__up_next__ = collections.deque()   # Ids of the playlist tracks queued by the user to play next, ahead of the playlist order
+__up_next_version__ = 0         # Incremented whenever the up next queue changes
+
+__loader__ = None               # Executor that loads sources off the input thread
+__indexer__ = None              # Executor that builds the search index off the input thread
+__prefetch__ = {}               # Path -> future of a source being loaded, or loaded but not yet queued
+__queued__ = []                 # (id, path) of the playlist tracks queued on the player after the current track
+__sources__ = []                # Buffered sources on the player: the current source, followed by those queued
+__pending_play__ = None         # Path of the track to start playing once it has loaded
+__pending_since__ = None        # Time at which the pending playback was requested, when statistics are recorded
+__playing_path__ = None         # Path of the track loaded into the player
+__playing_from_playlist__ = False
+__resume_position__ = None     # Position (in seconds) to seek to once the pending playback has loaded
+__failed_loads__ = set()        # Paths of the tracks that could not be loaded, skipped until the playlist changes
+__failed_loads_version__ = 0    # Playlist version at which the failed loads were recorded
+__load_errors__ = []            # Messages about the tracks that could not be loaded, until they are taken
 
 
 # -----------------------------------------
@@ -66,80 +124,345 @@ def get_playlist():
     return __playlist__
 
 
+def get_repeat_mode():
+    return __repeat_mode__
+
+
+def is_shuffled():
+    return __shuffle__ is not None
+
+
+def get_playlist_version():
+    return __playlist__.version
+
+
+def get_up_next_version():
+    return __up_next_version__
+
+
 def get_current_track():
-    if __current_track_idx__ < len(__playlist__):
-        return __playlist__[__current_track_idx__]
+    if get_current_track_idx() < len(__playlist__):
+        return __playlist__[get_current_track_idx()]
     else:
         return None
 
 def get_current_track_idx():
-    return __current_track_idx__
+    if __current_track_id__ is None:
+        return 0
+    return __playlist__.index_of(__current_track_id__)
 
 def get_current_track_time():
     '''Returns the current playing time of the current track.'''
-    duration = Duration()
     if (__player__ is not None):
-        duration.set_from_sec(__player__.time)
-    return duration
+        return Duration.from_seconds(__player__.time)
+    return Duration.from_seconds(0)
 
 def get_current_track_duration():
-    '''Returns the total playing time of the current track.'''
-    duration = Duration()
-    if (__player__ is not None):
-        if __player__.source.duration:
-            duration.set_from_sec(__player__.source.duration)
-    return duration
-
-def get_current_track_info():
-    '''Returns a tuple of three objects: trackInfo, audioFormat, and trackDuration.
-       Available trackInfo properties (accessible as info.property_name):     title, album, author, year, track, genre, copyright, comment
-       Available audioFormat properties (accessible as audiof.property_name): channels, sample_size, sample_rate
-       Available trackDuration properties (accessible as trackDuration.property_name): hours, minutes, seconds'''
-    info = None
-    audiof = None
+    '''Returns the total playing time of the current track. Sources that do not report their duration fall back to
+       the duration stored in the library (see analyzer).'''
     if (__player__ is not None):
-        if __player__.source.info:
-            info = __player__.source.info
-        if __player__.source.audio_format:
-            audiof = __player__.source.audio_format
-        
-    return info, audiof, get_current_track_duration()
+        if __player__.source is not None and __player__.source.duration:
+            return Duration.from_seconds(__player__.source.duration)
+        meta = library.get_cached_metadata(__playing_path__) if __playing_path__ is not None else None
+        if meta is not None and meta.duration:
+            return Duration.from_seconds(meta.duration)
+    return Duration.from_seconds(0)
+
+def get_position():
+    '''Returns the playing time of the current track, in seconds'''
+    if __player__ is not None:
+        return __player__.time
+    return __resume_position__ or 0.0
+
+def get_playing_track():
+    '''Returns the path of the track loaded into the player, or None if nothing is loaded'''
+    return __playing_path__
+
+def get_current_track_metadata():
+    '''Returns the metadata of the playing track, or of the current playlist track if nothing is playing.
+       Returns None if the metadata is not known yet (it is then read in the background).'''
+    path = __playing_path__ if __playing_path__ is not None else get_current_track()
+    return library.get_metadata(path)
+
+
+# -----------------------------------------
+# Functions - Events
+# -----------------------------------------
+
+def dispatch_events():
+    '''Dispatches pending player events (e.g. end of stream) on the calling thread, and services completed loads'''
+    backend.dispatch_events()
+    service_loads()
+
+
+def get_event_timeout():
+    '''Returns the time (in seconds) until the backend next has player events or a load should be checked, or None if there is nothing to wait for'''
+    timeout = backend.get_event_timeout()
+    if has_pending_loads():
+        timeout = __LOAD_POLL_INTERVAL__ if timeout is None else min(timeout, __LOAD_POLL_INTERVAL__)
+    return timeout
 
 
 # -----------------------------------------
 # Functions - Playlist Managagment
 # -----------------------------------------
 
-def add_to_playlist(tracklist):
-    '''Appends the provided files to the playlist, firest checking for their existence and then if they are supported'''
-    global __playlist__
-    count = 0
-    for track in tracklist:
-        if os.path.isfile(track) and (os.path.splitext(track)[1][1:].strip().lower() in __SUPPORTED_FORMATS__):
-            __playlist__.append(track)
-            count = count + 1
-    
-    return count
+def add_to_playlist(tracklist, validate = True):
+    '''Appends the provided files to the playlist, firest checking for their existence and then if they are supported.
+       The checks can be skipped for files that are already known to be valid (e.g. found by a directory scan).'''
+    if validate:
+        tracklist = validate_tracks(tracklist)
+    ids = __playlist__.extend(tracklist)
+    if __search_index__ is not None:
+        __search_index__.add(get_search_texts(zip(ids, tracklist), __search_untagged__))
+    elif __search_build__ is not None:
+        __search_edits__.append((True, list(ids)))
+    session.record_add(tracklist)
+    return len(tracklist)
 
 
-def rem_from_playlist(indices):
-    '''Removes the playlist item at the specified index'''
-    global __playlist__, __current_track_idx__
+def validate_tracks(tracklist):
+    '''Returns the files of the list that exist and are of a supported format. Uses no state of the player, so it
+       can run without the state lock (see commands).'''
+    return [track for track in tracklist if is_supported_format(track) and os.path.isfile(track)]
+
+
+def is_supported_format(track):
+    '''Returns whether the file extension of the specified track is that of a supported format'''
+    return os.path.splitext(track)[1][1:].strip().lower() in __SUPPORTED_FORMATS__
 
-    for i in range(len(indices) -1, -1, -1):
-        index = int(indices[i])
-        del __playlist__[index - 1]
 
-        if __current_track_idx__ == index:
-            stop()
-            __current_track_idx__ = 0
-        elif __current_track_idx__ > index:
-            __current_track_idx__ = __current_track_idx__ - 1   
+def rem_from_playlist(indices):
+    '''Removes the playlist items at the specified (1-based) indices. If the current track is removed, playback stops and the first track becomes current.'''
+    global __current_track_id__
+
+    positions = [int(index) - 1 for index in indices if int(index) > 0]
+    ids = [__playlist__.get_id(position) for position in positions]
+    if __current_track_id__ in ids:
+        stop()
+        __current_track_id__ = None
+    if __search_index__ is not None:
+        __search_index__.remove(get_search_texts(get_playlist_tracks(ids), {}))
+    elif __search_build__ is not None:
+        __search_edits__.append((False, get_search_texts(get_playlist_tracks(ids), {})))
+    __playlist__.remove_ids(ids)
+    session.record_remove(positions)
+
+
+def move_in_playlist(src, dst):
+    '''Moves the playlist item at the specified (1-based) index to another index, clamped to the playlist (e.g. 0
+       moves it to the top). The current track is unaffected.'''
+    src, dst = int(src) - 1, int(dst) - 1
+    if not 0 <= src < len(__playlist__):
+        raise IndexError('Playlist index out of range')
+    dst = max(0, min(dst, len(__playlist__) - 1))
+    __playlist__.move(src, dst)
+    session.record_move(src, dst)
 
 
 def clear_playlist():
-    '''Clears all songs from the playlist'''
+    '''Clears all songs from the playlist, and the up next queue'''
+    global __current_track_id__
+    __playlist__.clear()
+    __current_track_id__ = None
+    reset_search_index()
+    clear_up_next()
+    session.record_clear()
+
+
+def restore_playlist(restore):
+    '''Replaces the playlist with that of a restored session: restore is called with the emptied playlist, and fills
+       it (see session.load). Its tracks are not validated or journaled again. Returns the result of restore.'''
+    global __current_track_id__
     __playlist__.clear()
+    __current_track_id__ = None
+    reset_search_index()
+    clear_up_next()
+    return restore(__playlist__)
+
+
+def search_playlist(query, wait = False):
+    '''Returns the set of ids of the playlist tracks matching the query (see search.SearchIndex), which must not be
+       modified, or None if the query has no words. The matches are put in playlist order by order_search_matches.
+       The index is built in the background on the first search, and nothing matches until it has been built (see
+       get_search_version), unless wait is set. It is then kept up to date as the playlist is edited and the tags of
+       its tracks are read.'''
+    global __search_build__, __search_library_version__, __indexer__
+    start = stats.start()
+    if __search_index__ is None and __search_build__ is None:
+        # The tracks are copied for the indexer thread, as the playlist may be edited while the index is built
+        if __indexer__ is None:
+            __indexer__ = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        __search_library_version__ = library.get_version()
+        __search_build__ = __indexer__.submit(build_search_index, list(zip(__playlist__.iter_ids(), __playlist__)))
+    update_search_index(wait)
+
+    matches = __search_index__.search(query) if __search_index__ is not None else None
+    stats.stop('search.query', start)
+    return matches
+
+
+def order_search_matches(matches, count):
+    '''Returns the first count of the matches of a search, in playlist order. Only the matches shown are ordered, so
+       that typing a query that matches much of a large playlist stays cheap.'''
+    return __playlist__.sort_ids(matches, count)
+
+
+def update_search_index(wait = False):
+    '''Installs the search index once it has been built (waiting for it if wait is set), and indexes the tags of the
+       tracks that have been read since the tracks were indexed. Called as the player services its events.'''
+    global __search_index__, __search_build__, __search_untagged__, __search_library_version__, __search_version__
+    if __search_build__ is not None and (wait or __search_build__.done()):
+        __search_index__, __search_untagged__ = __search_build__.result()
+        __search_build__ = None
+        for added, edit in __search_edits__:
+            if added:
+                __search_index__.add(get_search_texts(get_playlist_tracks(track_id for track_id in edit if __playlist__.has_id(track_id)), __search_untagged__))
+            else:
+                __search_index__.remove(edit)
+        __search_edits__.clear()
+        __search_version__ = __search_version__ + 1
+
+    if __search_index__ is None or library.get_version() == __search_library_version__:
+        return
+    keys, __search_library_version__ = library.get_stored_since(__search_library_version__)
+    tracks = get_playlist_tracks(track_id for key in keys for track_id in __search_untagged__.pop(key, []) if __playlist__.has_id(track_id))
+    if len(tracks) > 0:
+        __search_index__.remove([(track_id, search.get_track_text(path)) for track_id, path in tracks])
+        __search_index__.add(get_search_texts(tracks, __search_untagged__))
+        __search_version__ = __search_version__ + 1
+
+
+def is_indexing():
+    '''Returns whether the search index is being built'''
+    return __search_build__ is not None
+
+
+def get_search_version():
+    '''Returns the version of the matches of searches, which changes whenever they may have changed'''
+    return __playlist__.version, __search_version__
+
+
+def reset_search_index():
+    '''Discards the search index (and any index being built), when the playlist is replaced'''
+    global __search_index__, __search_build__, __search_untagged__
+    __search_index__ = None
+    __search_build__ = None
+    __search_edits__.clear()
+    __search_untagged__ = {}
+
+
+def build_search_index(tracks):
+    '''Builds the search index of the specified (id, path) pairs. Runs on the indexer thread, so it uses no state of
+       the player. Returns the index, and the tracks whose tags were not known (see get_search_texts).'''
+    untagged = {}
+    index = search.SearchIndex()
+    index.add(get_search_texts(tracks, untagged))
+    return index, untagged
+
+
+def get_search_texts(tracks, untagged):
+    '''Returns the (id, searchable text) of the specified (id, path) pairs. The tracks whose tags are not yet known
+       are recorded in untagged (absolute path -> ids), to be indexed again once they are.'''
+    texts = []
+    for track_id, path in tracks:
+        meta = library.get_cached_metadata(path)
+        if meta is None:
+            untagged.setdefault(os.path.abspath(path), []).append(track_id)
+        texts.append((track_id, search.get_track_text(path, meta)))
+    return texts
+
+
+def get_playlist_tracks(ids):
+    '''Returns the (id, path) of the specified playlist tracks'''
+    return [(track_id, __playlist__.get_path(track_id)) for track_id in ids]
+
+
+def get_playlist_track_path(track_id):
+    '''Returns the path of the playlist track with the specified id'''
+    return __playlist__.get_path(track_id)
+
+
+def get_playlist_track_idx(track_id):
+    '''Returns the (0-based) index of the playlist track with the specified id'''
+    return __playlist__.index_of(track_id)
+
+
+# -----------------------------------------
+# Functions - Up next queue
+# -----------------------------------------
+
+def enqueue(indices):
+    '''Queues the playlist tracks at the specified (1-based) indices to play next, in order, after the tracks already
+       queued. The first queued tracks are prefetched like the tracks that follow in the playlist.'''
+    global __up_next_version__
+    ids = [__playlist__.get_id(int(index) - 1) for index in indices if int(index) > 0]
+    __up_next__.extend(ids)
+    __up_next_version__ = __up_next_version__ + 1
+    update_prefetch()
+    return len(ids)
+
+
+def dequeue(positions):
+    '''Removes the tracks at the specified (1-based) positions of the up next queue. Returns the number removed.
+       Positions are counted as shown by get_up_next, so the tracks removed from the playlist are dropped first.'''
+    global __up_next__, __up_next_version__
+    queued = [track_id for track_id in __up_next__ if __playlist__.has_id(track_id)]
+    positions = set(int(position) - 1 for position in positions)
+    kept = collections.deque(track_id for position, track_id in enumerate(queued) if position not in positions)
+    removed = len(queued) - len(kept)
+    __up_next__ = kept
+    __up_next_version__ = __up_next_version__ + 1
+    update_prefetch()
+    return removed
+
+
+def clear_up_next():
+    global __up_next_version__
+    __up_next__.clear()
+    __up_next_version__ = __up_next_version__ + 1
+    update_prefetch()
+
+
+def get_up_next(count = None):
+    '''Returns the (id, path) of the first count tracks of the up next queue (all of them if count is None).
+       Tracks removed from the playlist are left out.'''
+    prune_up_next()
+    up_next = []
+    for track_id in __up_next__:
+        if count is not None and len(up_next) >= count:
+            break
+        if __playlist__.has_id(track_id):
+            up_next.append((track_id, __playlist__.get_path(track_id)))
+    return up_next
+
+
+def get_up_next_positions(count):
+    '''Returns the (1-based) positions in the up next queue of the tracks among its first count, by id'''
+    positions = {}
+    for position, (track_id, path) in enumerate(get_up_next(count)):
+        positions.setdefault(track_id, position + 1)
+    return positions
+
+
+def prune_up_next():
+    '''Drops the tracks at the front of the up next queue that have been removed from the playlist or could not be
+       loaded. Tracks further back are dropped once they reach the front.'''
+    global __up_next_version__
+    failed = get_failed_loads()
+    while len(__up_next__) > 0 and (not __playlist__.has_id(__up_next__[0]) or __playlist__.get_path(__up_next__[0]) in failed):
+        __up_next__.popleft()
+        __up_next_version__ = __up_next_version__ + 1
+
+
+def set_next_track(track_id):
+    '''Makes the track that plays next the current track, taking it off the up next queue if it was queued'''
+    global __current_track_id__, __up_next_version__
+    prune_up_next()
+    if len(__up_next__) > 0 and __up_next__[0] == track_id:
+        __up_next__.popleft()
+        __up_next_version__ = __up_next_version__ + 1
+    __current_track_id__ = track_id
 
 
 # -----------------------------------------
@@ -147,29 +470,96 @@ def clear_playlist():
 # -----------------------------------------
 
 def sel_next_track():
-    '''Advances the current track index to the next track in the playlist'''
-    if len(__playlist__) > 0:
-        global __current_track_idx__
-        __current_track_idx__ = (__current_track_idx__ + 1) % len(__playlist__)
+    '''Advances the current track to the next track in the up next queue, the playlist or the shuffled order.
+       Selecting the next track by hand moves on from the end of the playlist (or of a round of the shuffle) whatever
+       the repeat mode.'''
+    global __current_track_id__
+    if len(__playlist__) == 0:
+        return
+    up_next = get_up_next(1)
+    if len(up_next) > 0:
+        set_next_track(up_next[0][0])
+    elif __shuffle__ is not None:
+        following = get_shuffle_order().get_following(1, True)
+        if len(following) > 0:
+            __current_track_id__ = following[0]
+    else:
+        set_current_track_idx((get_current_track_idx() + 1) % len(__playlist__))
 
 
 def sel_prev_track():
-    '''Returns the current track index to the previous track in the playlist'''
-    if len(__playlist__) > 0:
-        global __current_track_idx__
-        __current_track_idx__ = (__current_track_idx__ - 1) % len(__playlist__)
+    '''Returns the current track to the previous track in the playlist, or to the track played before it when shuffled'''
+    global __current_track_id__
+    if len(__playlist__) == 0:
+        return
+    if __shuffle__ is not None:
+        previous = get_shuffle_order().get_previous()
+        if previous is not None:
+            __current_track_id__ = previous
+    else:
+        set_current_track_idx((get_current_track_idx() - 1) % len(__playlist__))
+
+
+def set_shuffle(enabled):
+    '''Turns shuffle on or off. Each time it is turned on a new order is shuffled, starting from the current track.'''
+    global __shuffle__
+    if enabled and __shuffle__ is None:
+        __shuffle__ = shuffle.ShuffleOrder(__playlist__)
+    elif not enabled:
+        __shuffle__ = None
+    update_prefetch()
+
+
+def set_repeat_mode(mode):
+    global __repeat_mode__
+    __repeat_mode__ = mode
+    update_prefetch()
+
+
+def set_current_track_idx(index):
+    '''Makes the track at the specified index the current track'''
+    global __current_track_id__
+    __current_track_id__ = __playlist__.get_id(index)
         
 
 def play_current():
     '''Plays the current song'''
-    if __current_track_idx__ < len(__playlist__):
-        play(__playlist__[__current_track_idx__])
+    if get_current_track_idx() < len(__playlist__):
+        start_playback(get_current_track(), True)
     
 
 def play_playlist_no(playlist_no):
     '''Plays the song at the specified index in the playlist'''
-    global __current_track_idx__
-    __current_track_idx__ = playlist_no - 1
+    if playlist_no < 1:
+        raise IndexError('Playlist index out of range')
+    set_current_track_idx(playlist_no - 1)
+    play_current()
+
+
+def play_next():
+    '''Plays the next track in the playlist. If it has already been queued on the player, playback switches to it immediately.'''
+    global __playback_state__
+    # When repeating one track, the track queued is the current track itself unless tracks are queued to play next
+    repeating = __repeat_mode__ is RepeatMode.ONE and len(get_up_next(1)) == 0
+    if __player__ is not None and len(__queued__) > 0 and is_queued_track_valid(__queued__[0]) and not repeating:
+        start = stats.start()
+        track_id, path = __queued__.pop(0)
+        backend.next_source(__player__)
+        __sources__.pop(0).close()
+        __player__.play()
+        set_playing_track(path)
+        set_next_track(track_id)
+        __playback_state__ = PlaybackState.PLAYING
+        update_prefetch()
+        stats.stop('audio.play_next_queued', start)
+    else:
+        sel_next_track()
+        play_current()
+
+
+def play_prev():
+    '''Plays the previous track in the playlist'''
+    sel_prev_track()
     play_current()
 
 
@@ -177,10 +567,12 @@ def play_pause():
     '''Toggles between playing and pausing of the current playback'''
     global __playback_state__
     if __playback_state__ is PlaybackState.PLAYING:
-        __player__.pause()
+        if __player__ is not None:
+            __player__.pause()
         __playback_state__ = PlaybackState.PAUSED
     elif __playback_state__ is PlaybackState.PAUSED:
-        __player__.play()
+        if __player__ is not None:
+            __player__.play()
         __playback_state__ = PlaybackState.PLAYING
     else:
         play_current()
@@ -188,34 +580,334 @@ def play_pause():
 
 def play(audio_file_path):
     '''Begins playback of the specified file'''
+    start_playback(audio_file_path, False)
 
-    global __player__, __playback_state__
+
+def start_playback(audio_file_path, from_playlist):
+    '''Begins playback of the specified file once it has been loaded. Loading happens on the loader thread, so this returns immediately.
+       Tracks played from the playlist have the tracks that follow them prefetched and queued on the same player for gapless transitions.'''
+    global __pending_play__, __pending_since__, __playing_from_playlist__, __playback_state__
 
     if __playback_state__ is not PlaybackState.STOPPED:
         stop()
 
-    # Create new player
-    __player__ = pyglet.media.Player()
-    __player__.push_handlers(on_eos=sel_next_track)
-        
-    source = pyglet.media.load(audio_file_path)
-    __player__.queue(source)
-    __player__.play()
+    __pending_play__ = audio_file_path
+    __pending_since__ = stats.start()
+    __playing_from_playlist__ = from_playlist
     __playback_state__ = PlaybackState.PLAYING
 
+    request_load(audio_file_path)
+    service_loads()
+
+
+def resume(position):
+    '''Loads the current track paused at the specified position (in seconds), as playback was left by a restored session'''
+    global __playback_state__, __resume_position__
+    play_current()
+    if __playback_state__ is not PlaybackState.STOPPED:
+        __playback_state__ = PlaybackState.PAUSED
+        if __player__ is not None:
+            # The track was loaded at once
+            __player__.pause()
+            seek(position)
+        else:
+            __resume_position__ = position
+
 
 def stop():
-    '''Discards the current player'''
-    global __player__, __playback_state__
+    '''Stops playback, releasing the player to be reused by the next track'''
+    global __player__, __playback_state__, __pending_play__, __resume_position__
     if __player__ is not None:
-        __player__.pause()
-        # Discard. Pyglet doesn't support stopping - this is the recommended way of handling it
+        backend.release_player(__player__)
         __player__ = None
+    for source in __sources__:
+        source.close()
+    __sources__.clear()
+    __queued__.clear()
+    __pending_play__ = None
+    __resume_position__ = None
+    set_playing_track(None)
     __playback_state__ = PlaybackState.STOPPED
 
 
 def seek(timestamp):
-    '''Seeks to the provided timestamp'''
-    global __player__, __playback_state__
+    '''Seeks to the provided timestamp (in seconds) of the current track. The decoder thread performs the seek, so this returns immediately.'''
+    if __player__ is not None and len(__sources__) > 0:
+        timestamp = max(0, timestamp)
+        if __sources__[0].duration:
+            timestamp = min(timestamp, __sources__[0].duration)
+        __player__.seek(timestamp)
+
+
+def seek_relative(offset):
+    '''Seeks forwards (or backwards, for negative offsets) by the provided number of seconds'''
+    if __player__ is not None:
+        seek(__player__.time + offset)
+
+
+def set_volume(percent):
+    '''Sets the volume, in percent of full volume'''
+    dsp.set_volume(percent)
+    if __player__ is not None:
+        __player__.volume = dsp.get_player_volume()
+
+
+def step_volume(steps):
+    '''Raises (or lowers, for negative steps) the volume by the specified number of steps'''
+    dsp.step_volume(steps)
     if __player__ is not None:
-        __player__.source.seek(timestamp)
+        __player__.volume = dsp.get_player_volume()
+
+
+# -----------------------------------------
+# Functions - Loading / prefetching
+# -----------------------------------------
+
+def request_load(audio_file_path):
+    '''Starts loading the specified file on the loader thread, unless it is already loaded or being loaded'''
+    global __loader__
+    if audio_file_path not in __prefetch__:
+        if __loader__ is None:
+            __loader__ = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        __prefetch__[audio_file_path] = __loader__.submit(load_source, audio_file_path)
+
+
+def load_source(audio_file_path):
+    '''Loads the specified file, and its ReplayGain so that the gain is fixed from the start of the track (see
+       dsp.get_track_replaygain). Runs on the loader thread, which also loads the backend if it has not been loaded
+       yet, and reads the file's tags. A gain that must be measured is applied from the next time it plays.'''
+    pyglet = backend.get_pyglet()
+    start = stats.start()
+    source = pyglet.media.load(audio_file_path)
+    stats.stop('audio.load', start)
+
+    if dsp.get_replaygain_mode() is not dsp.ReplayGainMode.OFF:
+        replaygain.get_replaygain(audio_file_path, read_tags_now=True)
+    return source
+
+
+def service_loads():
+    '''Starts pending playback once its source has loaded, and queues any loaded upcoming tracks on the player'''
+    global __player__, __pending_play__, __playback_state__, __resume_position__
+
+    if __pending_play__ is not None:
+        future = __prefetch__[__pending_play__]
+        if not future.done():
+            return
+
+        del __prefetch__[__pending_play__]
+        path, __pending_play__ = __pending_play__, None
+        try:
+            source = future.result()
+        except Exception as e:
+            fail_load(path, e)
+            # Playing the playlist moves on to the tracks that follow, unless none of them can be played
+            upcoming = get_upcoming_tracks(1) if __playing_from_playlist__ else []
+            if len(upcoming) == 0:
+                stop()
+                return
+            set_next_track(upcoming[0][0])
+            play_current()
+            return
+
+        set_playing_track(path, source)
+        __player__ = backend.acquire_player(on_eos)
+        __player__.volume = dsp.get_player_volume()
+        queue_source(source, path)
+        if __resume_position__ is not None:
+            seek(__resume_position__)
+            __resume_position__ = None
+        if __playback_state__ is PlaybackState.PLAYING:
+            __player__.play()
+        stats.stop('audio.start_playback', __pending_since__)
+
+    update_prefetch()
+
+
+def update_prefetch():
+    '''Loads the tracks that follow the current track and queues them, in order, on the player once they are ready'''
+    if __player__ is None or not __playing_from_playlist__ or len(__playlist__) == 0:
+        return
+
+    # Drop queued tracks that no longer follow the current track (e.g. the playlist or the up next queue was edited).
+    # Pyglet cannot unqueue sources, so these are skipped over when they are reached instead. The tracks that now
+    # follow are still loaded, so that they start without waiting for a load.
+    upcoming = get_upcoming_tracks(__PREFETCH_DEPTH__)
+    if __queued__ != upcoming[:len(__queued__)]:
+        for track_id, path in upcoming:
+            request_load(path)
+        return
+
+    for track_id, path in upcoming[len(__queued__):]:
+        request_load(path)
+        future = __prefetch__[path]
+        if not future.done():
+            break
+        del __prefetch__[path]
+        try:
+            source = future.result()
+        except Exception as e:
+            # The track is skipped from now on, so the tracks that follow it are loaded in its place
+            fail_load(path, e)
+            update_prefetch()
+            return
+        library.store_source_metadata(path, source)
+        queue_source(source, path)
+        __queued__.append((track_id, path))
+
+    # Discard loads that are no longer needed
+    wanted = [path for track_id, path in upcoming]
+    for path in list(__prefetch__.keys()):
+        if path not in wanted and path != __pending_play__:
+            discard_load(__prefetch__.pop(path))
+
+
+def get_upcoming_tracks(count):
+    '''Returns the (id, path) of up to count tracks that will play after the current track: those queued to play next,
+       or else those that follow it in the playlist or the shuffled order, or the current track itself when it is
+       repeated. The playlist only starts again from its beginning (or a new round of the shuffle starts) when the
+       whole playlist is repeated. Tracks that could not be loaded are skipped.'''
+    if len(__playlist__) == 0:
+        return []
+    # Enough tracks are taken that count are left once those that could not be loaded are skipped
+    failed = get_failed_loads()
+    wanted = count + len(failed)
+    up_next = [track for track in get_up_next(wanted) if track[1] not in failed]
+    if len(up_next) > 0:
+        return up_next[:count]
+    if __repeat_mode__ is RepeatMode.ONE:
+        ids = [get_current_track_id()]
+    elif __shuffle__ is not None:
+        ids = get_shuffle_order().get_following(wanted, __repeat_mode__ is RepeatMode.ALL)
+    else:
+        current_idx = get_current_track_idx()
+        if __repeat_mode__ is RepeatMode.ALL:
+            indices = [(current_idx + i) % len(__playlist__) for i in range(1, min(wanted, len(__playlist__) - 1) + 1)]
+        else:
+            indices = range(current_idx + 1, min(current_idx + 1 + wanted, len(__playlist__)))
+        ids = [__playlist__.get_id(index) for index in indices]
+    tracks = [(track_id, __playlist__.get_path(track_id)) for track_id in ids]
+    return [track for track in tracks if track[1] not in failed][:count]
+
+
+def get_current_track_id():
+    '''Returns the id of the current playlist track (the first track, if none has been selected)'''
+    if __current_track_id__ is None:
+        return __playlist__.get_id(0)
+    return __current_track_id__
+
+
+def get_shuffle_order():
+    '''Returns the shuffled order, with the current track selected in it. The current track is not followed as it
+       changes, but found again in the order when it is next used.'''
+    if len(__playlist__) > 0:
+        __shuffle__.select(get_current_track_id())
+    return __shuffle__
+
+
+def is_queued_track_valid(queued):
+    '''Returns whether a track queued on the player still follows the current track in the playlist'''
+    upcoming = get_upcoming_tracks(1)
+    return len(upcoming) > 0 and upcoming[0] == queued
+
+
+def discard_load(future):
+    '''Cancels a load that is no longer needed. If the source has already been loaded (or is being loaded) it is
+       deleted once it is ready, rather than left to be collected with its file open.'''
+    future.cancel()
+    future.add_done_callback(delete_loaded_source)
+
+
+def delete_loaded_source(future):
+    if not future.cancelled() and future.exception() is None:
+        backend.get_decoder().delete_source(future.result())
+
+
+def fail_load(path, error):
+    '''Records that the specified track could not be loaded, so that it is skipped until the playlist changes and
+       the error is reported (see take_load_errors)'''
+    get_failed_loads().add(path)
+    __load_errors__.append('Could not play {}: {}'.format(path, error))
+
+
+def get_failed_loads():
+    '''Returns the paths of the tracks that could not be loaded since the playlist last changed'''
+    global __failed_loads_version__
+    if __failed_loads_version__ != __playlist__.version:
+        __failed_loads__.clear()
+        __failed_loads_version__ = __playlist__.version
+    return __failed_loads__
+
+
+def take_load_errors():
+    '''Returns the messages about the tracks that could not be loaded since they were last taken'''
+    errors = list(__load_errors__)
+    __load_errors__.clear()
+    return errors
+
+
+def has_pending_loads():
+    '''Returns whether any track is currently being loaded'''
+    for future in __prefetch__.values():
+        if not future.done():
+            return True
+    return False
+
+
+def queue_source(source, path):
+    '''Queues a loaded source on the player, to be decoded ahead of playback by its own decoder thread'''
+    buffered = backend.get_decoder().BufferedSource(source, dsp.get_track_replaygain(path))
+    __sources__.append(buffered)
+    __player__.queue(buffered)
+
+
+def get_buffer_fill():
+    '''Returns the fraction of the current source's decode buffer that is filled, or None if nothing is playing'''
+    if len(__sources__) == 0:
+        return None
+    return __sources__[0].get_buffer_fill()
+
+
+def set_playing_track(path, source = None):
+    '''Records the track loaded into the player, adding its metadata to the library if it has just been loaded'''
+    global __playing_path__
+    __playing_path__ = path
+    if source is not None:
+        library.store_source_metadata(path, source)
+
+
+def on_eos():
+    '''Called by the player when a source finishes. If the next track was queued the player has already moved on to it.'''
+    if len(__sources__) > 0:
+        __sources__.pop(0).close()
+
+    if not __playing_from_playlist__:
+        stop()
+        return
+
+    if len(__queued__) > 0:
+        queued = __queued__.pop(0)
+        if is_queued_track_valid(queued):
+            stats.count('audio.gapless_transitions')
+            set_playing_track(queued[1])
+            set_next_track(queued[0])
+            update_prefetch()
+            return
+
+    # Nothing valid was queued, so the next track must be loaded. Without repeat, playback stops at the end.
+    upcoming = get_upcoming_tracks(1)
+    if len(upcoming) == 0:
+        stop()
+        return
+    set_next_track(upcoming[0][0])
+    play_current()
+
+
+# -----------------------------------------
+# Helpers
+# -----------------------------------------
+
+@functools.lru_cache(maxsize=__DURATION_CACHE_SIZE__)
+def get_duration(totalseconds):
+    '''Returns the shared Duration of the specified number of whole seconds'''
+    return Duration(seconds = totalseconds)
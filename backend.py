@@ -0,0 +1,210 @@
+'''
+Deferred loading of the audio backend. Importing pyglet (and the codecs it loads, such as AVbin) is slow, so rather
+than when the player starts it is imported in the background by preload(), or on first use. So is NumPy, which the
+audio processing modules (dsp, replaygain and waveform) use if it is installed.
+Audio is output through pyglet, or to one of the sinks (see sink), selected by set_output(). Either way pyglet
+decodes the audio, but the sinks need no sound device.
+A single player is reused for every track: a released player is emptied and kept, rather than discarded with the
+native resources it holds.
+'''
+
+import importlib
+import importlib.util
+import threading
+import time
+
+import sink
+import stats
+
+
+# -----------------------------------------
+# Global constants
+# -----------------------------------------
+
+__OUTPUTS__ = ('pyglet', 'wav', 'null')
+
+
+# -----------------------------------------
+# Global variables
+# -----------------------------------------
+
+__lock__ = threading.Lock()
+__pyglet__ = None
+__decoder__ = None
+__numpy__ = None
+__has_numpy__ = None            # Whether NumPy is installed, once it has been checked
+__load_time__ = None            # Seconds that importing the backend took, once it has been loaded
+__output__ = 'pyglet'
+__idle_player__ = None          # Released player, kept for reuse
+__players_created__ = 0
+
+
+# -----------------------------------------
+# Functions
+# -----------------------------------------
+
+def get_pyglet():
+    '''Returns the pyglet module, loading the backend if it has not been loaded yet'''
+    if __pyglet__ is None:
+        load()
+    return __pyglet__
+
+
+def get_decoder():
+    '''Returns the decoder module (which depends on pyglet), loading the backend if it has not been loaded yet'''
+    if __decoder__ is None:
+        load()
+    return __decoder__
+
+
+def has_numpy():
+    '''Returns whether NumPy is installed, without importing it'''
+    global __has_numpy__
+    if __has_numpy__ is None:
+        __has_numpy__ = importlib.util.find_spec('numpy') is not None
+    return __has_numpy__
+
+
+def get_numpy():
+    '''Returns the numpy module, or None if it is not installed, loading the backend if it has not been loaded yet'''
+    if __decoder__ is None:
+        load()
+    return __numpy__
+
+
+def is_loaded():
+    return __decoder__ is not None
+
+
+def get_load_time():
+    '''Returns the time (in seconds) that loading the backend took, or None if it has not been loaded yet'''
+    return __load_time__
+
+
+def load():
+    '''Imports pyglet and the modules that depend on it, and NumPy if it is installed. Waits for a load already in
+       progress on another thread.'''
+    global __pyglet__, __decoder__, __numpy__, __load_time__
+    with __lock__:
+        if __decoder__ is not None:
+            return
+        start = time.perf_counter()
+        pyglet = importlib.import_module('pyglet')
+        importlib.import_module('pyglet.media')
+        decoder = importlib.import_module('decoder')
+        __numpy__ = importlib.import_module('numpy') if has_numpy() else None
+        __load_time__ = time.perf_counter() - start
+        stats.record('backend.load', __load_time__)
+        __pyglet__, __decoder__ = pyglet, decoder
+
+
+def set_output(output, path = None):
+    '''Selects where audio is output: 'pyglet' (a sound device), 'wav' (a WAV file at path) or 'null' (discarded).
+       Raises ValueError for any other output.'''
+    global __output__
+    if output not in __OUTPUTS__:
+        raise ValueError('Unknown output: {} (expected one of {})'.format(output, ', '.join(__OUTPUTS__)))
+    discard_idle_player()
+    if output != 'pyglet':
+        sink.open_sink(output, path)
+    __output__ = output
+
+
+def get_output():
+    return __output__
+
+
+def acquire_player(on_eos):
+    '''Returns a player with nothing queued, reusing the one released last if there is one. A new player is created
+       (loading the backend if it has not been loaded yet) only when there is none, with on_eos as its end of stream
+       handler.'''
+    global __idle_player__, __players_created__
+    player, __idle_player__ = __idle_player__, None
+    if player is not None:
+        stats.count('backend.players_reused')
+        return player
+
+    pyglet = get_pyglet()
+    player = pyglet.media.Player() if __output__ == 'pyglet' else sink.create_player()
+    player.push_handlers(on_eos=on_eos)
+    __players_created__ = __players_created__ + 1
+    stats.count('backend.players_created')
+    return player
+
+
+def release_player(player):
+    '''Stops a player that is no longer in use, and empties it to be reused by acquire_player()'''
+    global __idle_player__
+    player.pause()
+    while player.source is not None:
+        source = player.source
+        next_source(player)
+        if player.source is source:
+            break
+    if __idle_player__ is not None and __idle_player__ is not player:
+        delete_player(__idle_player__)
+    __idle_player__ = player
+
+
+def get_players_created():
+    '''Returns the number of players created since the player started'''
+    return __players_created__
+
+
+def next_source(player):
+    '''Skips the player to its next queued source (the method was renamed in pyglet 1.4)'''
+    if hasattr(player, 'next_source'):
+        player.next_source()
+    else:
+        player.next()
+
+
+def dispatch_events():
+    '''Runs any due pyglet clock callbacks and dispatches pending player events (e.g. end of stream) on the calling
+       thread. Pyglet only delivers these events from within its own event loop, which we do not run.'''
+    if __output__ != 'pyglet':
+        sink.dispatch_events()
+    # Until the backend is loaded there is no player, and nothing to dispatch
+    elif is_loaded():
+        __pyglet__.clock.tick(poll=True)
+        __pyglet__.app.platform_event_loop.dispatch_posted_events()
+
+
+def get_event_timeout():
+    '''Returns the time (in seconds) until player events should next be dispatched, or None if there is nothing to wait for'''
+    if __output__ != 'pyglet':
+        return sink.get_event_timeout()
+    return __pyglet__.clock.get_sleep_time(True) if is_loaded() else None
+
+
+def close():
+    '''Deletes the idle player, and stops output to the sink, if one is selected, closing its file'''
+    discard_idle_player()
+    if __output__ != 'pyglet':
+        sink.close()
+
+
+def preload():
+    '''Loads the backend on a background thread, so that it is ready by the time the first track is played'''
+    threading.Thread(target=try_load, name='backend-preload', daemon=True).start()
+
+
+def discard_idle_player():
+    global __idle_player__
+    if __idle_player__ is not None:
+        delete_player(__idle_player__)
+        __idle_player__ = None
+
+
+def delete_player(player):
+    '''Releases the resources of a player (players can be deleted from pyglet 1.4)'''
+    if hasattr(player, 'delete'):
+        player.delete()
+
+
+def try_load():
+    '''Loads the backend, ignoring failures. Failures are raised again when the backend is first used.'''
+    try:
+        load()
+    except Exception:
+        pass
@@ -0,0 +1,3 @@
+'''
+Benchmarks of the player's hot paths, run against a fake audio backend and a virtual screen
+'''
@@ -0,0 +1,324 @@
+'''
+Stand-ins for pyglet and curses, so that the player can be benchmarked without an audio device or a terminal.
+install() must be called before any of the player's modules are imported.
+'''
+
+import os
+import sys
+import time
+import types
+
+
+# -----------------------------------------
+# Global constants
+# -----------------------------------------
+
+__SCREEN_LINES__ = 50
+__SCREEN_COLS__ = 200
+__TRACK_DURATION__ = 180.0      # Seconds, for every fake source
+
+
+# -----------------------------------------
+# Global variables
+# -----------------------------------------
+
+__load_delay__ = 0.0            # Seconds that loading a source takes, to simulate opening and probing a file
+__load_attempts__ = {}          # Path -> number of times loading it was attempted
+__screen__ = None               # The virtual screen, created by initscr()
+__panels__ = []                 # Panels, from bottom to top
+
+
+# -----------------------------------------
+# Types - pyglet
+# -----------------------------------------
+
+class AudioFormat(object):
+    def __init__(self, channels = 2, sample_size = 16, sample_rate = 44100):
+        self.channels = channels
+        self.sample_size = sample_size
+        self.sample_rate = sample_rate
+        self.bytes_per_second = channels * sample_size // 8 * sample_rate
+
+
+class SourceInfo(object):
+    def __init__(self, title):
+        self.title = title
+        self.author = b'Artist'
+        self.album = b'Album'
+        self.year = 2000
+        self.track = 1
+        self.genre = b'Genre'
+
+
+class AudioData(object):
+    def __init__(self, data, length, timestamp, duration, events):
+        self.data = data
+        self.length = length
+        self.timestamp = timestamp
+        self.duration = duration
+        self.events = events
+
+
+class Source(object):
+    audio_format = None
+    video_format = None
+    info = None
+    _duration = None
+
+    @property
+    def duration(self):
+        return self._duration
+
+    def get_queue_source(self):
+        return self
+
+
+class StreamingSource(Source):
+    pass
+
+
+class SilentSource(StreamingSource):
+    '''A source that decodes to silence'''
+    def __init__(self, path):
+        self.audio_format = AudioFormat()
+        self.info = SourceInfo(os.path.basename(path).encode())
+        self._duration = __TRACK_DURATION__
+        self.__position = 0
+
+    def seek(self, timestamp):
+        self.__position = int(timestamp * self.audio_format.bytes_per_second) & ~3
+
+    def get_audio_data(self, num_bytes, compensation_time = 0.0):
+        total = int(self._duration * self.audio_format.bytes_per_second)
+        num_bytes = min(num_bytes, total - self.__position)
+        if num_bytes <= 0:
+            return None
+        timestamp = self.__position / self.audio_format.bytes_per_second
+        self.__position = self.__position + num_bytes
+        return AudioData(bytes(num_bytes), num_bytes, timestamp, num_bytes / self.audio_format.bytes_per_second, [])
+
+
+class Player(object):
+    '''A player that keeps time with the wall clock, without consuming its sources'''
+    def __init__(self):
+        self.playing = False
+        self.__queue = []
+        self.__start = 0.0
+        self.__time = 0.0
+
+    @property
+    def source(self):
+        return self.__queue[0] if len(self.__queue) > 0 else None
+
+    @property
+    def time(self):
+        return time.perf_counter() - self.__start if self.playing else self.__time
+
+    def push_handlers(self, **handlers):
+        pass
+
+    def queue(self, source):
+        self.__queue.append(source)
+
+    def play(self):
+        self.__start = time.perf_counter() - self.__time
+        self.playing = True
+
+    def pause(self):
+        self.__time = self.time
+        self.playing = False
+
+    def seek(self, timestamp):
+        self.__time = timestamp
+        self.__start = time.perf_counter() - timestamp
+
+    def next_source(self):
+        if len(self.__queue) > 0:
+            self.__queue.pop(0)
+        self.seek(0.0)
+
+    def delete(self):
+        self.__queue = []
+
+
+class EventLoop(object):
+    def dispatch_posted_events(self):
+        pass
+
+
+# -----------------------------------------
+# Types - curses
+# -----------------------------------------
+
+class CursesError(Exception):
+    pass
+
+
+class Window(object):
+    '''A window of the virtual screen, holding the characters written to it.
+       Writes outside of the window raise an error, as they do in curses.'''
+    def __init__(self, lines, cols, y, x):
+        self.lines = lines
+        self.cols = cols
+        self.y = y
+        self.x = x
+        self.rows = [[' '] * cols for i in range(lines)]
+
+    def getmaxyx(self):
+        return self.lines, self.cols
+
+    def erase(self):
+        for row in self.rows:
+            row[:] = ' ' * self.cols
+
+    def clear(self):
+        self.erase()
+
+    def box(self):
+        self.border(0)
+
+    def border(self, *chars):
+        for row in self.rows:
+            row[0] = row[-1] = '|'
+        self.rows[0][:] = '-' * self.cols
+        self.rows[-1][:] = '-' * self.cols
+
+    def addstr(self, y, x, text, attr = 0):
+        self.addnstr(y, x, text, len(text), attr)
+
+    def addnstr(self, y, x, text, n, attr = 0):
+        if y < 0 or y >= self.lines or x < 0 or x >= self.cols:
+            raise CursesError('addnstr() returned ERR')
+        text = text[:max(0, min(n, self.cols - x))]
+        self.rows[y][x:x + len(text)] = text
+
+    def hline(self, y, x, char, n):
+        self.addnstr(y, x, char * n, n)
+
+    def noutrefresh(self):
+        pass
+
+    def refresh(self):
+        doupdate()
+
+    def keypad(self, flag):
+        pass
+
+    def nodelay(self, flag):
+        pass
+
+    def getkey(self):
+        raise CursesError('no input')
+
+    def getch(self):
+        return -1
+
+    def getstr(self, *args):
+        return b''
+
+
+class Panel(object):
+    def __init__(self, window):
+        self.__window = window
+
+    def window(self):
+        return self.__window
+
+
+# -----------------------------------------
+# Functions - curses
+# -----------------------------------------
+
+def initscr():
+    global __screen__
+    __screen__ = Window(__SCREEN_LINES__, __SCREEN_COLS__, 0, 0)
+    return __screen__
+
+
+def newwin(lines, cols, y, x):
+    return Window(lines, cols, y, x)
+
+
+def new_panel(window):
+    # Windows are rebuilt on every full redraw, so panels of windows that are no longer on screen are dropped
+    __panels__[:] = [panel for panel in __panels__ if panel.window().y != window.y or panel.window().x != window.x]
+    panel = Panel(window)
+    __panels__.append(panel)
+    return panel
+
+
+def doupdate():
+    '''Composes the panels onto the screen, as curses does when it updates the terminal'''
+    if __screen__ is None:
+        return
+    for panel in __panels__:
+        win = panel.window()
+        cols = max(0, min(win.cols, __screen__.cols - win.x))
+        for i, row in enumerate(win.rows[:max(0, __screen__.lines - win.y)]):
+            __screen__.rows[win.y + i][win.x:win.x + cols] = row[:cols]
+
+
+def get_screen_text():
+    '''Returns the lines of the virtual screen, as last updated'''
+    return [''.join(row) for row in __screen__.rows]
+
+
+# -----------------------------------------
+# Functions - pyglet
+# -----------------------------------------
+
+def load(filename, file = None, streaming = True):
+    __load_attempts__[filename] = __load_attempts__.get(filename, 0) + 1
+    if __load_delay__ > 0:
+        time.sleep(__load_delay__)
+    if not os.path.isfile(filename):
+        raise IOError('No such file: {}'.format(filename))
+    return SilentSource(filename)
+
+
+def set_load_delay(seconds):
+    '''Sets the time (in seconds) that loading a source takes'''
+    global __load_delay__
+    __load_delay__ = seconds
+
+
+# -----------------------------------------
+# Installation
+# -----------------------------------------
+
+def install():
+    '''Registers the stand-ins as the pyglet and curses modules'''
+    pyglet = types.ModuleType('pyglet')
+    media = types.ModuleType('pyglet.media')
+    codecs = types.ModuleType('pyglet.media.codecs')
+    clock = types.ModuleType('pyglet.clock')
+    app = types.ModuleType('pyglet.app')
+
+    for name in ['AudioFormat', 'SourceInfo', 'Source', 'StreamingSource', 'Player']:
+        setattr(media, name, globals()[name])
+    media.load = load
+    media.codecs = codecs
+    codecs.AudioData = AudioData
+    clock.tick = lambda poll = False: 0
+    clock.get_sleep_time = lambda sleep_idle: None
+    app.platform_event_loop = EventLoop()
+    pyglet.media, pyglet.clock, pyglet.app = media, clock, app
+
+    curses = types.ModuleType('curses')
+    panel = types.ModuleType('curses.panel')
+    curses.LINES, curses.COLS = __SCREEN_LINES__, __SCREEN_COLS__
+    curses.A_NORMAL, curses.A_REVERSE, curses.A_BOLD = 0, 1, 2
+    curses.error = CursesError
+    curses.initscr = initscr
+    curses.newwin = newwin
+    curses.doupdate = doupdate
+    for name in ['update_lines_cols', 'echo', 'noecho', 'cbreak', 'nocbreak', 'endwin', 'beep']:
+        setattr(curses, name, lambda *args: None)
+    panel.new_panel = new_panel
+    panel.update_panels = lambda: None
+    curses.panel = panel
+
+    sys.modules.update({
+        'pyglet': pyglet, 'pyglet.media': media, 'pyglet.media.codecs': codecs, 'pyglet.clock': clock, 'pyglet.app': app,
+        'curses': curses, 'curses.panel': panel,
+    })
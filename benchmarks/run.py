@@ -0,0 +1,392 @@
+'''
+Runs the benchmarks and prints their results as JSON.
+
+Usage: python3 -m benchmarks.run [-sizes n[,n ...]] [-tree dirs files] [-repeat n] [-load-delay seconds] [-output file]
+'''
+
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import fakes
+
+fakes.install()
+
+import audio
+import backend
+import dsp
+import input_listener
+import library
+import scanner
+import ui
+
+
+# -----------------------------------------
+# Global constants
+# -----------------------------------------
+
+___HELP__ = __doc__.strip().splitlines()[-1]
+
+__DEFAULT_SIZES__ = [1000, 10000, 100000]
+__DEFAULT_TREE__ = (50, 200)    # Directories, and files per directory, of the synthetic tree that is scanned
+__DEFAULT_REPEAT__ = 5
+__REMOVALS__ = 1000             # Tracks removed by the removal benchmarks
+__SEARCH_PAGE__ = 50            # Matches put in order per keystroke by the search benchmark, about a screen of them
+__SWITCH_TIMEOUT__ = 10.0       # Seconds to wait for a track to start playing before giving up
+__FAILED_LOAD_WAIT__ = 1.0      # Seconds of playback during which a track that cannot be loaded must not be loaded again
+__RENDER_TRACKS__ = 3           # Tracks played through by the render benchmarks
+__RENDER_TIMEOUT__ = 60.0       # Seconds to wait for the tracks to be rendered before giving up
+__SEED__ = 0
+
+
+# -----------------------------------------
+# Measurement
+# -----------------------------------------
+
+def measure(func, repeat, number = 1):
+    '''Calls func number times in each of repeat rounds, with the garbage collector disabled (as timeit does).
+       Returns statistics of the time, in seconds, that a single call took.'''
+    samples = []
+    gc.collect()
+    gc.disable()
+    try:
+        for i in range(repeat):
+            start = time.perf_counter()
+            for j in range(number):
+                func()
+            samples.append((time.perf_counter() - start) / number)
+    finally:
+        gc.enable()
+    return summarize(samples)
+
+
+def summarize(samples):
+    return {'min': min(samples), 'median': statistics.median(samples), 'max': max(samples)}
+
+
+def run_event_loop(until, timeout):
+    '''Services audio events as the input listener does, until the condition holds. Returns False if it timed out.'''
+    deadline = time.perf_counter() + timeout
+    while not until():
+        if time.perf_counter() > deadline:
+            return False
+        event_timeout = audio.get_event_timeout()
+        time.sleep(event_timeout if event_timeout is not None else 0)
+        audio.dispatch_events()
+    return True
+
+
+def reset_playlist(paths):
+    audio.stop()
+    audio.clear_playlist()
+    audio.add_to_playlist(paths, False)
+
+
+def make_paths(count):
+    '''Returns the paths of count tracks, spread across directories as a music library would be'''
+    return ['/music/artist {:04d}/album/{:02d} track {}.mp3'.format(i // 100, i % 100, i) for i in range(count)]
+
+
+def make_tree(root, dirs, files):
+    '''Creates a tree of empty audio files (and a few other files, which scans skip) two directories deep'''
+    paths = []
+    for d in range(dirs):
+        directory = os.path.join(root, 'artist {:03d}'.format(d // 10), 'album {:02d}'.format(d % 10))
+        os.makedirs(directory, exist_ok=True)
+        for f in range(files):
+            paths.append(os.path.join(directory, '{:03d} track.mp3'.format(f)))
+            open(paths[-1], 'wb').close()
+        open(os.path.join(directory, 'cover.jpg'), 'wb').close()
+    return paths
+
+
+# -----------------------------------------
+# Benchmarks
+# -----------------------------------------
+
+def bench_refresh(sizes, repeat):
+    '''Cost of ui.refresh: redrawing everything, refreshing when nothing changed, and scrolling the playlist by a page'''
+    results = []
+    for size in sizes:
+        reset_playlist(make_paths(size))
+        ui.refresh(force=True)
+
+        results.append({
+            'playlist_size': size,
+            'full_redraw': measure(lambda: ui.refresh(force=True), repeat, 20),
+            'unchanged': measure(ui.refresh, repeat, 200),
+            'page_scroll': measure(lambda: (ui.page_playlist(1), ui.refresh()), repeat, 20),
+            'select_next': measure(lambda: (audio.sel_next_track(), ui.refresh()), repeat, 20),
+        })
+    return results
+
+
+def bench_playlist_edits(sizes, repeat):
+    '''Throughput of add_to_playlist and rem_from_playlist, in tracks per second'''
+    rng = random.Random(__SEED__)
+    results = []
+    for size in sizes:
+        paths = make_paths(size)
+        add = measure(lambda: reset_playlist(paths), repeat)
+
+        removals = min(__REMOVALS__, size // 2)
+        single = []
+        batch = []
+        for i in range(repeat):
+            reset_playlist(paths)
+            indices = [rng.randint(1, size - j) for j in range(removals)]
+            start = time.perf_counter()
+            for index in indices:
+                audio.rem_from_playlist([index])
+            single.append((time.perf_counter() - start) / removals)
+
+            reset_playlist(paths)
+            indices = rng.sample(range(1, size + 1), removals)
+            start = time.perf_counter()
+            audio.rem_from_playlist(indices)
+            batch.append((time.perf_counter() - start) / removals)
+
+        results.append({
+            'playlist_size': size,
+            'add_tracks_per_sec': size / add['median'],
+            'remove_one_at_a_time_tracks_per_sec': 1 / statistics.median(single),
+            'remove_batch_tracks_per_sec': 1 / statistics.median(batch),
+        })
+    return results
+
+
+def bench_search(sizes, repeat):
+    '''Cost of searching the playlist: building the index on the first search, and each keystroke of a query
+       (from one matching most of the playlist to one matching a single track)'''
+    query = 'artist 0012 track 1234'
+    results = []
+    for size in sizes:
+        paths = make_paths(size)
+        def build():
+            reset_playlist(paths)
+            audio.search_playlist('', wait=True)
+        index = measure(build, repeat)
+
+        # Typing a query repeats the searches of its prefixes, so the cache of query words is cleared between rounds.
+        # Each keystroke orders a page of the matches, as the UI shows them.
+        prefixes = [query[:i] for i in range(1, len(query) + 1)]
+        def type_query():
+            audio.add_to_playlist([], False)
+            for prefix in prefixes:
+                audio.order_search_matches(audio.search_playlist(prefix) or set(), __SEARCH_PAGE__)
+        keystroke = measure(type_query, repeat)
+
+        results.append({
+            'playlist_size': size,
+            'build_index': index,
+            'keystroke_mean': {key: value / len(prefixes) for key, value in keystroke.items()},
+            'add_tracks_per_sec_while_indexed': size / measure(lambda: audio.add_to_playlist(paths, False), 1)['median'],
+        })
+    return results
+
+
+def bench_dsp(repeat):
+    '''Cost of processing a buffer of decoded audio (a tenth of a second of CD audio), as the player requests it'''
+    if not dsp.is_available():
+        return None
+    audio_format = fakes.AudioFormat()
+    rng = random.Random(__SEED__)
+    data = bytes(rng.getrandbits(8) for i in range(audio_format.bytes_per_second // 10))
+    volume = dsp.get_volume()
+    try:
+        dsp.set_volume(volume // 2)
+        return {
+            'buffer_bytes': len(data),
+            'process': measure(lambda: dsp.process(data, audio_format, None), repeat, 1000),
+        }
+    finally:
+        dsp.set_volume(volume)
+
+
+def bench_scan(root, files, repeat):
+    '''Rate of "add -r" over the synthetic tree: from starting the scan until every file found is in the playlist'''
+    samples = []
+    for i in range(repeat):
+        reset_playlist([])
+        start = time.perf_counter()
+        input_listener.process_input('add -r {}'.format(root), respond=lambda message: None)
+        while scanner.is_scanning():
+            input_listener.collect_scans()
+            time.sleep(0.001)
+        samples.append(time.perf_counter() - start)
+
+        if len(audio.get_playlist()) != len(files):
+            raise RuntimeError('Scan found {} of {} files'.format(len(audio.get_playlist()), len(files)))
+
+    return {
+        'files': len(files),
+        'seconds': summarize(samples),
+        'files_per_sec': len(files) / statistics.median(samples),
+    }
+
+
+def bench_track_switch(files, repeat):
+    '''Latency of switching tracks: from the call until the player is playing the new track'''
+    cold = []
+    gapless = []
+    for i in range(repeat):
+        path = files[i % len(files)]
+        reset_playlist([])
+        start = time.perf_counter()
+        audio.play(path)
+        if not run_event_loop(lambda: audio.get_playing_track() == path, __SWITCH_TIMEOUT__):
+            raise RuntimeError('Track did not start playing: {}'.format(path))
+        cold.append(time.perf_counter() - start)
+
+        # Once the following track has been prefetched, play_next switches to it without loading
+        reset_playlist(files[:3])
+        audio.play_playlist_no(1)
+        if not run_event_loop(lambda: audio.get_playing_track() == files[0] and not audio.has_pending_loads(), __SWITCH_TIMEOUT__):
+            raise RuntimeError('Playlist did not start playing')
+        start = time.perf_counter()
+        audio.play_next()
+        if not run_event_loop(lambda: audio.get_playing_track() == files[1], __SWITCH_TIMEOUT__):
+            raise RuntimeError('Next track did not start playing')
+        gapless.append(time.perf_counter() - start)
+
+    # Every switch reuses the same player, and every source is released once it is stopped
+    audio.stop()
+    decoder = backend.get_decoder()
+    run_event_loop(lambda: decoder.get_open_sources() == 0, __SWITCH_TIMEOUT__)
+    return {
+        'load_delay': fakes.__load_delay__,
+        'play_file': summarize(cold),
+        'play_next_prefetched': summarize(gapless),
+        'players_created': backend.get_players_created(),
+        'open_sources_after_stop': decoder.get_open_sources(),
+    }
+
+
+def bench_failed_load(files):
+    '''Loads of a track that cannot be loaded (a missing file), which follows the playing track: it is loaded once
+       and skipped, rather than loaded again whenever the player looks for the next track to queue. Starting it
+       reports the error and moves on to the following track.'''
+    missing = os.path.join(os.path.dirname(files[0]), 'missing.mp3')
+    reset_playlist([files[0], missing, files[1]])
+    audio.take_load_errors()
+    attempts = fakes.__load_attempts__.get(missing, 0)
+    audio.play_playlist_no(1)
+    if not run_event_loop(lambda: audio.get_playing_track() == files[0], __SWITCH_TIMEOUT__):
+        raise RuntimeError('Playlist did not start playing')
+    run_event_loop(lambda: False, __FAILED_LOAD_WAIT__)
+    loads = fakes.__load_attempts__.get(missing, 0) - attempts
+    if loads != 1:
+        raise RuntimeError('Missing track was loaded {} times rather than once'.format(loads))
+    if audio.has_pending_loads():
+        raise RuntimeError('Loads were still pending after the missing track failed')
+
+    # The track that follows the missing track was queued in its place
+    audio.play_next()
+    if not run_event_loop(lambda: audio.get_playing_track() == files[1], __SWITCH_TIMEOUT__):
+        raise RuntimeError('Track following the missing track did not play')
+
+    audio.play_playlist_no(2)
+    if not run_event_loop(lambda: audio.get_playing_track() == files[1], __SWITCH_TIMEOUT__):
+        raise RuntimeError('Playback did not move past the missing track')
+    errors = audio.take_load_errors()
+    if len(errors) == 0:
+        raise RuntimeError('Missing track was not reported')
+    audio.stop()
+    return {'load_attempts': loads, 'errors_reported': len(errors)}
+
+
+def bench_render(files, workdir, repeat):
+    '''Throughput of playing a playlist to the sinks, which play as fast as audio is decoded: seconds of audio
+       rendered per second, for the null output and the wav output'''
+    results = {}
+    for output in ('null', 'wav'):
+        factors = []
+        for i in range(repeat):
+            backend.set_output(output, os.path.join(workdir, 'render.wav'))
+            reset_playlist(files[:__RENDER_TRACKS__ + 1])
+            start = time.perf_counter()
+            audio.play_playlist_no(1)
+            # The last track only marks the end of the ones before it
+            if not run_event_loop(lambda: audio.get_playing_track() == files[__RENDER_TRACKS__], __RENDER_TIMEOUT__):
+                raise RuntimeError('Playlist was not rendered')
+            factors.append(__RENDER_TRACKS__ * fakes.__TRACK_DURATION__ / (time.perf_counter() - start))
+            audio.stop()
+            backend.close()
+        results[output] = {'realtime_factor': summarize(factors)}
+    backend.set_output('pyglet')
+    return results
+
+
+# -----------------------------------------
+# Entry point
+# -----------------------------------------
+
+def get_arg(name, count = 1):
+    '''Returns the value(s) following the specified command line argument, or None if the argument is not present'''
+    if name in sys.argv and sys.argv.index(name) + count < len(sys.argv):
+        start = sys.argv.index(name) + 1
+        return sys.argv[start] if count == 1 else sys.argv[start:start + count]
+    return None
+
+
+def main():
+    if '-h' in sys.argv or '-help' in sys.argv:
+        print(___HELP__)
+        return
+
+    sizes = [int(size) for size in get_arg('-sizes').split(',')] if '-sizes' in sys.argv else __DEFAULT_SIZES__
+    dirs, files_per_dir = [int(value) for value in get_arg('-tree', 2)] if '-tree' in sys.argv else __DEFAULT_TREE__
+    repeat = int(get_arg('-repeat')) if '-repeat' in sys.argv else __DEFAULT_REPEAT__
+    if '-load-delay' in sys.argv:
+        fakes.set_load_delay(float(get_arg('-load-delay')))
+
+    workdir = tempfile.mkdtemp(prefix='argon-bench-')
+    try:
+        # The library is kept apart from the user's own
+        library.__DATA_DIR__ = os.path.join(workdir, 'data')
+        root = os.path.join(workdir, 'music')
+        files = make_tree(root, dirs, files_per_dir)
+
+        ui.init()
+        results = {
+            'environment': {
+                'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'platform': platform.platform(),
+                'screen': [fakes.__SCREEN_LINES__, fakes.__SCREEN_COLS__],
+                'repeat': repeat,
+            },
+            'refresh': bench_refresh(sizes, repeat),
+            'playlist_edits': bench_playlist_edits(sizes, repeat),
+            'search': bench_search(sizes, repeat),
+            'dsp': bench_dsp(repeat),
+            'scan': bench_scan(root, files, repeat),
+            'track_switch': bench_track_switch(files, repeat),
+            'failed_load': bench_failed_load(files),
+            'render': bench_render(files, workdir, repeat),
+        }
+    finally:
+        scanner.cancel_all()
+        audio.stop()
+        library.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if '-output' in sys.argv:
+        with open(get_arg('-output'), 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+'''
+Runs commands (typed on the command line, or sent to a headless player) on a worker thread, so that slow commands do
+not freeze the UI or hold up playback. Commands run one at a time, in the order they were submitted.
+
+The state of the player (the audio, UI and session modules) is shared by the input thread and the worker, so each
+holds the state lock while it uses that state: the input thread while it handles events and keys and redraws, except
+while the user types a command (see released), and the worker while it runs a command, except while the command waits
+for I/O (see unlocked).
+'''
+
+import concurrent.futures
+import contextlib
+import queue
+import threading
+
+
+# -----------------------------------------
+# Types
+# -----------------------------------------
+
+class CommandCancelled(Exception):
+    '''Raised within a command that has been cancelled, at the next point where it checks'''
+    pass
+
+
+class Command(object):
+    '''A command submitted to the worker. Its messages and status are written by the worker and taken by the thread
+       that shows them. Its future completes with the result of the command once it has run.'''
+
+    def __init__(self, text, execute):
+        self.text = text
+        self.future = concurrent.futures.Future()
+        self.__execute = execute
+        self.__cancelled = threading.Event()
+        self.__lock = threading.Lock()
+        self.__messages = []
+        self.__status = None
+        self.__status_set = False
+
+    def respond(self, message):
+        with self.__lock:
+            self.__messages.append(message)
+
+    def set_status(self, message):
+        '''Sets the progress of the command, replacing its previous progress (None clears it)'''
+        with self.__lock:
+            self.__status = message
+            self.__status_set = True
+
+    def take_messages(self):
+        '''Returns the messages written since they were last taken'''
+        with self.__lock:
+            messages, self.__messages = self.__messages, []
+        return messages
+
+    def take_status(self):
+        '''Returns whether the status has been set since it was last taken, and the status'''
+        with self.__lock:
+            status_set, self.__status_set = self.__status_set, False
+            return status_set, self.__status
+
+    def cancel(self):
+        self.__cancelled.set()
+
+    def is_cancelled(self):
+        return self.__cancelled.is_set()
+
+    def run(self):
+        '''Runs the command on the worker, holding the state lock'''
+        try:
+            with __lock__:
+                self.check_cancelled()
+                self.future.set_result(self.__execute(self))
+        except BaseException as e:
+            self.future.set_exception(e)
+
+    def check_cancelled(self):
+        if self.is_cancelled():
+            raise CommandCancelled(self.text)
+
+
+# -----------------------------------------
+# Global constants
+# -----------------------------------------
+
+__SHUTDOWN_TIMEOUT__ = 2.0      # Seconds to wait at shutdown for the running command to stop
+
+
+# -----------------------------------------
+# Global variables
+# -----------------------------------------
+
+__lock__ = threading.Lock()     # The state lock
+__queue__ = queue.Queue()       # Commands waiting for the worker
+__pending__ = []                # Commands submitted that have not finished
+__current__ = threading.local() # The command running on the calling thread, if any
+__worker__ = None
+
+
+# -----------------------------------------
+# Functions
+# -----------------------------------------
+
+def get_lock():
+    '''Returns the state lock'''
+    return __lock__
+
+
+@contextlib.contextmanager
+def unlocked():
+    '''Releases the state lock for the duration of a slow operation that does not use the player's state, such as
+       reading files, so that the input thread carries on meanwhile. Only the worker releases the lock, so a command
+       run directly (e.g. by a benchmark) runs as usual.'''
+    if getattr(__current__, 'command', None) is None:
+        yield
+        return
+    with released():
+        yield
+
+
+@contextlib.contextmanager
+def released():
+    '''Releases the state lock, which the calling thread must hold, for the duration of a wait that does not use the
+       player's state. Used by the input thread while the user types a command, so that the running and queued
+       commands carry on meanwhile.'''
+    __lock__.release()
+    try:
+        yield
+    finally:
+        __lock__.acquire()
+
+
+def submit(text, execute):
+    '''Queues a command for the worker, starting the worker if needed. execute is called on the worker with the
+       command, and its result completes the command's future. Returns the command.'''
+    global __worker__
+    command = Command(text, execute)
+    __pending__.append(command)
+    command.future.add_done_callback(lambda future: __pending__.remove(command))
+    if __worker__ is None:
+        __worker__ = threading.Thread(target=run_worker, name='commands', daemon=True)
+        __worker__.start()
+    __queue__.put(command)
+    return command
+
+
+def is_running():
+    '''Returns whether any command is running or waiting to run'''
+    return len(__pending__) > 0
+
+
+def cancel_all():
+    '''Cancels the running command (at its next check) and those waiting to run'''
+    for command in list(__pending__):
+        command.cancel()
+
+
+def check_cancelled():
+    '''Raises CommandCancelled if the command running on the calling thread has been cancelled'''
+    command = getattr(__current__, 'command', None)
+    if command is not None:
+        command.check_cancelled()
+
+
+def iterate(items, interval = 1000):
+    '''Yields the items, checking every interval items whether the running command has been cancelled'''
+    for i, item in enumerate(items):
+        if i % interval == 0:
+            check_cancelled()
+        yield item
+
+
+def shutdown(timeout = __SHUTDOWN_TIMEOUT__):
+    '''Cancels all commands, and takes the state lock for good so that no command uses the state while the player
+       shuts down. Waits up to timeout seconds for a running command to release the lock.'''
+    cancel_all()
+    __lock__.acquire(timeout=timeout)
+
+
+# -----------------------------------------
+# Helpers
+# -----------------------------------------
+
+def run_worker():
+    '''Worker thread: runs the submitted commands in turn'''
+    while True:
+        command = __queue__.get()
+        __current__.command = command
+        try:
+            command.run()
+        finally:
+            __current__.command = None
@@ -0,0 +1,311 @@
+'''
+Decodes sources ahead of playback on background threads, into fixed-size ring buffers. The storage of the ring
+buffers is pooled, and each source's resources are released as soon as its decoder stops, so switching tracks does
+not grow memory or leave files open.
+'''
+
+import threading
+
+import pyglet
+
+import dsp
+import stats
+
+
+# -----------------------------------------
+# Global constants
+# -----------------------------------------
+
+__BUFFER_SECONDS__ = 4          # Seconds of decoded audio held ahead of playback
+__DECODE_CHUNK__ = 16384        # Bytes requested from the underlying source at a time
+__UNDERRUN_WAIT__ = 0.1         # Seconds the player waits for decoded audio before it is given silence
+__POOLED_BUFFERS__ = 4          # Ring buffer storage kept for reuse once its source is closed
+
+
+# -----------------------------------------
+# Global variables
+# -----------------------------------------
+
+__underruns__ = 0               # Number of reads that found the buffer empty, across all sources
+__pool_lock__ = threading.Lock()
+__free_storage__ = []           # Storage (bytearrays) of closed ring buffers, for reuse
+__open_sources__ = 0            # Number of sources whose decoder has not stopped yet
+
+
+# -----------------------------------------
+# Types
+# -----------------------------------------
+
+class RingBuffer(object):
+    '''A fixed-size byte buffer written by one thread and read by another.
+       The storage is taken from the pool, and written through a memoryview without intermediate copies.
+       Clearing the buffer starts a new generation, and writes from an earlier generation are discarded.'''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.generation = 0
+        self.__data = acquire_storage(capacity)
+        self.__view = memoryview(self.__data)[:capacity]
+        self.__read_pos = 0
+        self.__fill = 0
+        self.__eof = False
+        self.__closed = False
+        self.__condition = threading.Condition()
+
+    def get_fill(self):
+        '''Returns the number of bytes waiting to be read'''
+        return self.__fill
+
+    def write(self, data, generation):
+        '''Copies the data (a byte memoryview) into the buffer, waiting for space as needed.
+           Returns False if the buffer was cleared or closed before all of the data was written.'''
+        written = 0
+        with self.__condition:
+            while written < len(data):
+                self.__condition.wait_for(lambda: self.__fill < self.capacity or self.__closed or self.generation != generation)
+                if self.__closed or self.generation != generation:
+                    return False
+
+                start = (self.__read_pos + self.__fill) % self.capacity
+                count = min(len(data) - written, self.capacity - self.__fill, self.capacity - start)
+                self.__view[start:start + count] = data[written:written + count]
+                self.__fill = self.__fill + count
+                written = written + count
+                self.__condition.notify_all()
+        return True
+
+    def read(self, num_bytes, timeout):
+        '''Returns up to num_bytes from the buffer, waiting up to timeout seconds for data if it is empty.
+           Returns an empty result if nothing is available, and None once the end of the stream has been read.'''
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__fill > 0 or self.__eof or self.__closed, timeout)
+            # Once closed, the storage may already be in use by another buffer
+            if self.__closed:
+                return None
+            if self.__fill == 0:
+                return None if self.__eof else b''
+
+            count = min(num_bytes, self.__fill)
+            first = min(count, self.capacity - self.__read_pos)
+            data = bytes(self.__view[self.__read_pos:self.__read_pos + first]) + bytes(self.__view[0:count - first])
+            self.__read_pos = (self.__read_pos + count) % self.capacity
+            self.__fill = self.__fill - count
+            self.__condition.notify_all()
+            return data
+
+    def mark_eof(self, generation):
+        '''Marks the end of the stream, once the remaining data has been read'''
+        with self.__condition:
+            if self.generation == generation:
+                self.__eof = True
+                self.__condition.notify_all()
+
+    def clear(self):
+        '''Discards the buffered data, and starts a new generation'''
+        with self.__condition:
+            self.generation = self.generation + 1
+            self.__read_pos = 0
+            self.__fill = 0
+            self.__eof = False
+            self.__condition.notify_all()
+
+    def close(self):
+        '''Releases any thread waiting on the buffer'''
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+    def release(self):
+        '''Closes the buffer, and returns its storage to the pool. Only the writer may release it, once it has
+           stopped writing.'''
+        self.close()
+        with self.__condition:
+            data, self.__data = self.__data, None
+            self.__view.release()
+        if data is not None:
+            release_storage(data)
+
+
+class BufferedSource(pyglet.media.StreamingSource):
+    '''A source that plays a loaded source through a ring buffer, filled by its own decoder thread.
+       Decoding starts as soon as it is created, so sources queued ahead of time are ready to play immediately.'''
+
+    def __init__(self, source, replaygain = None):
+        global __open_sources__
+        self.audio_format = source.audio_format
+        self.video_format = None
+        self.info = source.info
+        self._duration = source.duration
+
+        self.__bytes_per_frame = max(1, self.audio_format.channels * self.audio_format.sample_size // 8)
+        capacity = int(self.audio_format.bytes_per_second * __BUFFER_SECONDS__)
+        self.__buffer = RingBuffer(capacity - capacity % self.__bytes_per_frame)
+        self.__source = source
+        self.__replaygain = replaygain              # Fixed for as long as the source plays (see dsp.get_track_replaygain)
+        self.__seek_lock = threading.Lock()         # Makes requesting a seek and clearing the buffer atomic for the decoder
+        self.__seek_target = None                   # Timestamp of a seek the decoder has yet to perform
+        self.__wake = threading.Event()              # Wakes the decoder after it reached the end of the stream
+        self.__stopped = False
+        self.__timestamp = 0.0
+        self.underruns = 0
+
+        with __pool_lock__:
+            __open_sources__ = __open_sources__ + 1
+        self.__thread = threading.Thread(target=self.__decode, daemon=True)
+        self.__thread.start()
+
+    def get_buffer_fill(self):
+        '''Returns the fraction of the ring buffer holding decoded audio'''
+        return self.__buffer.get_fill() / self.__buffer.capacity
+
+    def get_audio_data(self, num_bytes, compensation_time = 0.0):
+        '''Returns the next decoded audio for the player, processed by the DSP stage. Processing happens here rather
+           than as the audio is decoded, so that volume changes are heard without waiting for the buffered audio.
+           If the decoder has fallen behind, silence is returned rather than nothing, as the player would otherwise
+           treat the source as finished.'''
+        global __underruns__
+        num_bytes = num_bytes - num_bytes % self.__bytes_per_frame
+        data = self.__buffer.read(num_bytes, __UNDERRUN_WAIT__)
+        if data is None:
+            return None
+        if len(data) == 0:
+            # Waiting for a seek to complete is expected, and not counted as an underrun
+            if self.__seek_target is None:
+                self.underruns = self.underruns + 1
+                __underruns__ = __underruns__ + 1
+                stats.count('decoder.underruns')
+            return self.__to_audio_data(bytes(num_bytes))
+        return self.__to_audio_data(dsp.process(data, self.audio_format, self.__replaygain))
+
+    def read_audio_data(self, num_bytes):
+        '''Returns the next decoded audio like get_audio_data, but waits for the decoder when it has fallen behind
+           rather than returning silence. Used by the sinks (see sink), which play as fast as audio is decoded.'''
+        num_bytes = num_bytes - num_bytes % self.__bytes_per_frame
+        while True:
+            data = self.__buffer.read(num_bytes, __UNDERRUN_WAIT__)
+            if data is None:
+                return None
+            if len(data) > 0:
+                return self.__to_audio_data(dsp.process(data, self.audio_format, self.__replaygain))
+
+    def _get_audio_data(self, num_bytes):
+        '''Returns the next decoded audio for the player (the method was renamed in pyglet 1.4)'''
+        return self.get_audio_data(num_bytes)
+
+    def __to_audio_data(self, data):
+        '''Wraps audio read from the buffer, advancing the timestamp of the source past it'''
+        timestamp = self.__timestamp
+        duration = len(data) / self.audio_format.bytes_per_second
+        self.__timestamp = timestamp + duration
+        return get_audio_data_type()(data, len(data), timestamp, duration, [])
+
+    def seek(self, timestamp):
+        '''Discards the audio already decoded and has the decoder thread seek the underlying source, so this returns immediately'''
+        with self.__seek_lock:
+            self.__seek_target = timestamp
+            self.__buffer.clear()
+        self.__timestamp = timestamp
+        self.__wake.set()
+
+    def close(self):
+        '''Stops the decoder thread, which then releases the buffer and the underlying source'''
+        self.__stopped = True
+        self.__buffer.close()
+        self.__wake.set()
+
+    def __decode(self):
+        '''Decoder thread: fills the ring buffer from the underlying source, waiting whenever it is full'''
+        try:
+            self.__fill_buffer()
+        finally:
+            self.__release()
+
+    def __fill_buffer(self):
+        while not self.__stopped:
+            with self.__seek_lock:
+                target, self.__seek_target = self.__seek_target, None
+                generation = self.__buffer.generation
+            if target is not None:
+                self.__source.seek(target)
+
+            start = stats.start()
+            data = read_source(self.__source, __DECODE_CHUNK__)
+            stats.stop('decoder.read', start)
+            if data is None or data.length == 0:
+                self.__buffer.mark_eof(generation)
+                self.__wake.wait()
+                self.__wake.clear()
+                continue
+
+            self.__buffer.write(as_byte_view(data.data)[:data.length], generation)
+
+    def __release(self):
+        '''Releases the buffer and the underlying source, once the decoder thread has stopped using them'''
+        global __open_sources__
+        self.__buffer.release()
+        delete_source(self.__source)
+        with __pool_lock__:
+            __open_sources__ = __open_sources__ - 1
+
+
+# -----------------------------------------
+# Functions
+# -----------------------------------------
+
+def get_underruns():
+    '''Returns the number of times playback found a ring buffer empty'''
+    return __underruns__
+
+
+def get_open_sources():
+    '''Returns the number of sources whose decoder threads are still running'''
+    return __open_sources__
+
+
+def acquire_storage(capacity):
+    '''Returns storage for a ring buffer of the given capacity, reusing pooled storage that is large enough'''
+    with __pool_lock__:
+        for i, data in enumerate(__free_storage__):
+            if len(data) >= capacity:
+                del __free_storage__[i]
+                stats.count('decoder.buffers_reused')
+                return data
+    stats.count('decoder.buffers_allocated')
+    return bytearray(capacity)
+
+
+def release_storage(data):
+    '''Returns the storage of a ring buffer to the pool, discarding the smallest storage once the pool is full'''
+    with __pool_lock__:
+        __free_storage__.append(data)
+        if len(__free_storage__) > __POOLED_BUFFERS__:
+            __free_storage__.remove(min(__free_storage__, key=len))
+
+
+def delete_source(source):
+    '''Releases the file and codec of a pyglet source (sources can be deleted from pyglet 1.4, and are otherwise
+       released once they are collected)'''
+    if hasattr(source, 'delete'):
+        source.delete()
+
+
+def read_source(source, num_bytes):
+    '''Reads decoded audio from a pyglet source (the method was renamed in pyglet 1.4)'''
+    if hasattr(source, 'get_audio_data'):
+        return source.get_audio_data(num_bytes)
+    return source._get_audio_data(num_bytes)
+
+
+def as_byte_view(data):
+    '''Returns a flat byte memoryview of decoded audio, which pyglet provides as bytes or as a ctypes buffer'''
+    view = memoryview(data)
+    if view.format in ('B', 'b', 'c') and view.ndim == 1:
+        return view.cast('B')
+    return memoryview(bytes(data))
+
+
+def get_audio_data_type():
+    '''Returns pyglet's AudioData class (it moved to pyglet.media.codecs in pyglet 1.4)'''
+    if hasattr(pyglet.media, 'AudioData'):
+        return pyglet.media.AudioData
+    return pyglet.media.codecs.AudioData
@@ -0,0 +1,164 @@
+'''
+Processing of decoded audio between the decoder and the player: software volume, ReplayGain and clipping protection.
+Processing requires NumPy, which is optional: without it the volume is set on the player instead, and ReplayGain is
+not applied.
+'''
+
+from enum import Enum
+
+import backend
+import replaygain
+import stats
+
+
+# -----------------------------------------
+# Types
+# -----------------------------------------
+
+class ReplayGainMode(Enum):
+    OFF = 1
+    TRACK = 2
+    ALBUM = 3                   # Falls back to the track gain for tracks without an album gain
+
+
+# -----------------------------------------
+# Global constants
+# -----------------------------------------
+
+__MAX_VOLUME__ = 100            # Percent. The volume only attenuates, while ReplayGain may also amplify.
+__VOLUME_STEP__ = 5
+__READ_BYTES__ = 65536          # Bytes of decoded audio requested at a time by read_frames
+
+
+# -----------------------------------------
+# Global variables
+# -----------------------------------------
+
+__volume__ = __MAX_VOLUME__
+__mode__ = ReplayGainMode.TRACK
+__version__ = 0                 # Incremented whenever the volume or mode changes
+
+
+# -----------------------------------------
+# Functions
+# -----------------------------------------
+
+def is_available():
+    '''Returns whether audio can be processed, i.e. whether NumPy is installed'''
+    return backend.has_numpy()
+
+
+def get_version():
+    return __version__
+
+
+def get_volume():
+    return __volume__
+
+
+def set_volume(percent):
+    '''Sets the volume, in percent of full volume'''
+    global __volume__, __version__
+    __volume__ = max(0, min(int(percent), __MAX_VOLUME__))
+    __version__ = __version__ + 1
+
+
+def step_volume(steps):
+    '''Raises (or lowers, for negative steps) the volume by the specified number of steps'''
+    set_volume(__volume__ + steps * __VOLUME_STEP__)
+
+
+def get_replaygain_mode():
+    return __mode__
+
+
+def set_replaygain_mode(mode):
+    global __mode__, __version__
+    if isinstance(mode, ReplayGainMode):
+        __mode__ = mode
+        __version__ = __version__ + 1
+
+
+def get_player_volume():
+    '''Returns the volume to set on the player (0.0 to 1.0). Audio is attenuated here when it can be processed.'''
+    return 1.0 if is_available() else __volume__ / __MAX_VOLUME__
+
+
+def get_track_replaygain(path):
+    '''Returns the ReplayGain to apply to a track for as long as it plays, or None if it is not known (yet).
+       The gain is fixed when the track starts, so that a gain measured while it plays does not change its level
+       partway through, and is only applied the next time it is played.'''
+    if __mode__ is ReplayGainMode.OFF:
+        return None
+    return replaygain.get_replaygain(path)
+
+
+def get_gain(track):
+    '''Returns the linear gain to apply to the audio of a track with the specified ReplayGain (see
+       get_track_replaygain): the volume and its ReplayGain, lowered if needed so that its peak is not clipped'''
+    gain = __volume__ / __MAX_VOLUME__
+    if __mode__ is ReplayGainMode.OFF or track is None:
+        return gain
+    db, peak = track.track_gain, track.track_peak
+    if __mode__ is ReplayGainMode.ALBUM and track.album_gain is not None:
+        db, peak = track.album_gain, track.album_peak
+    if db is None:
+        return gain
+
+    gain = gain * 10 ** (db / 20)
+    if peak is not None and peak > 0:
+        gain = min(gain, 1.0 / peak)
+    return gain
+
+
+def read_frames(source):
+    '''Decodes a loaded source, yielding its audio as arrays of frames (one column per channel) scaled to +/-1.0.
+       Yields nothing if its sample format cannot be processed.'''
+    decoder = backend.get_decoder()
+    numpy = backend.get_numpy()
+    audiof = source.audio_format
+    if audiof is None or audiof.sample_size not in (8, 16):
+        return
+    dtype = numpy.uint8 if audiof.sample_size == 8 else numpy.int16
+    full_scale = 128.0 if audiof.sample_size == 8 else 32768.0
+    frame_bytes = audiof.sample_size // 8 * audiof.channels
+
+    data = decoder.read_source(source, __READ_BYTES__)
+    while data is not None and data.length > 0:
+        view = decoder.as_byte_view(data.data)[:data.length - data.length % frame_bytes]
+        frames = numpy.frombuffer(view, dtype=dtype).astype(numpy.float32).reshape(-1, audiof.channels)
+        if audiof.sample_size == 8:
+            frames -= 128.0
+        frames /= full_scale
+        yield frames
+        data = decoder.read_source(source, __READ_BYTES__)
+
+
+def process(data, audio_format, track):
+    '''Returns the decoded audio (bytes) of a track with the specified ReplayGain with its gain applied. The buffer
+       is processed as a whole, and returned unchanged when its gain is unity (or it cannot be processed).'''
+    if not is_available() or audio_format.sample_size not in (8, 16):
+        return data
+    gain = get_gain(track)
+    if gain == 1.0:
+        return data
+
+    numpy = backend.get_numpy()
+    start = stats.start()
+    if audio_format.sample_size == 16:
+        samples = numpy.frombuffer(data, dtype=numpy.int16).astype(numpy.float32)
+        samples *= gain
+        low, high, offset, dtype = -32768, 32767, 0, numpy.int16
+    else:
+        samples = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.float32) - 128
+        samples *= gain
+        low, high, offset, dtype = -128, 127, 128, numpy.uint8
+
+    # Gains above unity clip samples whose peak was not known, so they are limited to full scale rather than wrapped
+    if gain > 1.0:
+        numpy.clip(samples, low, high, out=samples)
+    if offset:
+        samples += offset
+    data = samples.astype(dtype).tobytes()
+    stats.stop('dsp.process', start)
+    return data
@@ -1,14 +1,26 @@
 import os
+import selectors
+import signal
+import sys
+import time
 
+import analyzer
 import audio
+import commands
+import dsp
+import library
+import playlist_file
+import scanner
+import session
+import stats
 import ui
 
-import pyglet
 # -----------------------------------------
 # Global
 # -----------------------------------------
 
 __INPUT_TRIGGER__ = ':'
+__SEARCH_TRIGGER__ = '/'
 
 __PLAY_PAUSE__ = [' ', 'p', '\n']
 __STOP__ = ['s']
@@ -17,6 +29,44 @@ __PLAY_NEXT__ = ['N']
 __SEL_PREV__ = ['b']
 __PLAY_PREV__ = ['B']
 
+__SCROLL_UP__ = ['KEY_UP']
+__SCROLL_DOWN__ = ['KEY_DOWN']
+__PAGE_UP__ = ['KEY_PPAGE']
+__PAGE_DOWN__ = ['KEY_NPAGE']
+__SCROLL_TOP__ = ['KEY_HOME']
+__SCROLL_BOTTOM__ = ['KEY_END']
+__SCROLL_CURRENT__ = ['c']
+
+__SEEK_BACK__ = ['KEY_LEFT']
+__SEEK_FORWARD__ = ['KEY_RIGHT']
+__SEEK_BACK_FAR__ = ['KEY_SLEFT']
+__SEEK_FORWARD_FAR__ = ['KEY_SRIGHT']
+__SEEK_STEP__ = 5               # Seconds skipped by the seek keys
+__SEEK_FAR_STEP__ = 60          # Seconds skipped by the seek keys while holding shift
+
+__VOLUME_UP__ = ['+', '=']
+__VOLUME_DOWN__ = ['-']
+
+__TOGGLE_SHUFFLE__ = ['z']
+__CYCLE_REPEAT__ = ['r']
+__REPEAT_CYCLE__ = [audio.RepeatMode.OFF, audio.RepeatMode.ALL, audio.RepeatMode.ONE]    # Order in which the repeat key steps through the modes
+
+__SEARCH_PLAY__ = ['\n', 'KEY_ENTER']
+__SEARCH_CANCEL__ = ['\x1b']
+__SEARCH_BACKSPACE__ = ['KEY_BACKSPACE', '\x7f', '\b']
+__FIND_LIMIT__ = 10             # Matches listed by the find command when running headless
+__CANCEL_COMMANDS__ = ['cancel']    # Commands that cancel the commands before them, rather than waiting their turn
+
+__IDLE_TICK_INTERVAL__ = 1.0    # Seconds between UI ticks when nothing is playing
+__SCAN_POLL_INTERVAL__ = 0.1    # Seconds between collecting the files found by directory scans
+__ANALYSIS_POLL_INTERVAL__ = 0.5    # Seconds between reports of the progress of an analysis
+__SESSION_INTERVAL__ = 5.0      # Seconds between recordings of the state of the session (e.g. the playback position)
+__COMMAND_POLL_INTERVAL__ = 0.05    # Seconds between collecting the messages and progress of running commands
+
+__tick_interval__ = 0.25        # Seconds between UI ticks during playback
+__next_session_save__ = 0.0     # Time (monotonic) at which the state of the session is next recorded
+__commands__ = []               # Commands typed on the command line whose results have not yet been shown
+
 
 # -----------------------------------------
 # Methods
@@ -31,37 +81,318 @@ def listen():
     #audio.add_to_playlist(['test.flac'])
     #audio.add_to_playlist(['test.m4a'])
     #audio.play_playlist_no(1)
-    
-    # Enter infinite (blocking) loop waiting for input.
-    # We refresh to clear previous input / output, then await input trigger, at which point we capture input (terminated with ENTER) and process it.
+
+    # Enter the event loop, sleeping until keyboard input arrives, the next UI tick is due or pyglet has scheduled work.
+    # On every wake-up we service pending audio events (e.g. end of stream), process all pending keys and refresh the UI.
+    # Only regions whose state has changed are redrawn, so ticks where nothing has changed are cheap.
     # NOTE: Resizing the terminal window is processed as input. This causes the loop to execute and refreshes the UI to match the new window size.
+    # Commands run on a worker thread (see commands), so the loop holds the state lock whenever it is not waiting.
+    selector = selectors.DefaultSelector()
+    selector.register(sys.stdin, selectors.EVENT_READ)
+    lock = commands.get_lock()
+    interrupt_handler = signal.signal(signal.SIGINT, lambda signum, frame: cancel())
+
     quit_app = False
-    while not quit_app:
+    next_tick = time.monotonic()
+    try:
+        while not quit_app:
+            with lock:
+                timeout = limit_timeout(next_tick - time.monotonic())
+            if timeout > 0:
+                selector.select(timeout)
+
+            with lock:
+                service_events()
+                quit_app = collect_commands()
+
+                # Keys are read one at a time, as command input consumes the keys that follow the input trigger
+                key = ui.read_key() if not quit_app else None
+                while key is not None and not quit_app:
+                    quit_app = process_key(key)
+                    key = ui.read_key() if not quit_app else None
+
+                if time.monotonic() >= next_tick:
+                    next_tick = time.monotonic() + get_tick_interval()
+
+                if not quit_app:
+                    update()
+    finally:
+        signal.signal(signal.SIGINT, interrupt_handler)
+        selector.close()
+
+
+def process_key(key):
+    '''Processes a single key press, executing the matching quick control or entering command input.
+       Returns True if the app should be terminated.'''
+
+    # Any key dismisses the message shown on the command line, and is then processed as usual
+    if key != 'KEY_RESIZE':
+        ui.dismiss_cmd_line()
+
+    if key == __INPUT_TRIGGER__:
+        ui.set_status(None)
         update()
-        key = ui.__stdscr.getkey()
-
-        if key in __PLAY_PAUSE__:
-            audio.play_pause()
-        elif key in __STOP__:
-            audio.stop()
-        elif key in __SEL_NEXT__:
-            audio.sel_next_track()
-        elif key in __PLAY_NEXT__:
-            audio.sel_next_track()
-            audio.play_current()
-        elif key in __SEL_PREV__:
-            audio.sel_prev_track()
-        elif key in __PLAY_PREV__:
-            audio.sel_prev_track()
-            audio.play_current()
-
-        elif key == __INPUT_TRIGGER__:
+        # The state lock is released while the command is typed, so that running and queued commands carry on
+        with commands.released():
             cmd = ui.read_cmd_line()
+        __commands__.append(submit_command(cmd))
+        return False
 
-            try:
-                quit_app = process_input(cmd)
-            except:
-                update("Invalid input")
+    start = stats.start()
+    if ui.is_searching():
+        process_search_key(key)
+    elif key == __SEARCH_TRIGGER__:
+        ui.set_status(None)
+        ui.start_search()
+    else:
+        process_quick_control(key)
+    stats.stop('input.key', start)
+    return False
+
+
+def process_search_key(key):
+    '''Edits the search query, or moves or plays the selected match, as the keys typed while searching the playlist direct'''
+
+    if key in __SEARCH_PLAY__:
+        index = ui.get_search_selection()
+        ui.end_search()
+        if index is not None:
+            if audio.get_playback_state() is not audio.PlaybackState.STOPPED:
+                audio.stop()
+            audio.play_playlist_no(index + 1)
+            ui.follow_current_track()
+    elif key in __SEARCH_CANCEL__:
+        ui.end_search()
+    elif key in __SEARCH_BACKSPACE__:
+        ui.set_search_query(ui.get_search_query()[:-1])
+
+    elif key in __SCROLL_UP__:
+        ui.move_search_selection(-1)
+    elif key in __SCROLL_DOWN__:
+        ui.move_search_selection(1)
+    elif key in __PAGE_UP__:
+        ui.page_search_selection(-1)
+    elif key in __PAGE_DOWN__:
+        ui.page_search_selection(1)
+
+    # Named keys (e.g. KEY_RESIZE) are not part of the query
+    elif len(key) == 1 and key.isprintable():
+        ui.set_search_query(ui.get_search_query() + key)
+
+
+def process_quick_control(key):
+    '''Executes the quick control bound to a key, if any'''
+
+    if key in __PLAY_PAUSE__:
+        audio.play_pause()
+    elif key in __STOP__:
+        audio.stop()
+    elif key in __SEL_NEXT__:
+        audio.sel_next_track()
+    elif key in __PLAY_NEXT__:
+        audio.play_next()
+    elif key in __SEL_PREV__:
+        audio.sel_prev_track()
+    elif key in __PLAY_PREV__:
+        audio.play_prev()
+
+    elif key in __SCROLL_UP__:
+        ui.scroll_playlist(-1)
+    elif key in __SCROLL_DOWN__:
+        ui.scroll_playlist(1)
+    elif key in __PAGE_UP__:
+        ui.page_playlist(-1)
+    elif key in __PAGE_DOWN__:
+        ui.page_playlist(1)
+    elif key in __SCROLL_TOP__:
+        ui.scroll_playlist_to(0)
+    elif key in __SCROLL_BOTTOM__:
+        ui.scroll_playlist_to(len(audio.get_playlist()))
+    elif key in __SCROLL_CURRENT__:
+        ui.follow_current_track()
+
+    elif key in __SEEK_BACK__:
+        audio.seek_relative(-__SEEK_STEP__)
+    elif key in __SEEK_FORWARD__:
+        audio.seek_relative(__SEEK_STEP__)
+    elif key in __SEEK_BACK_FAR__:
+        audio.seek_relative(-__SEEK_FAR_STEP__)
+    elif key in __SEEK_FORWARD_FAR__:
+        audio.seek_relative(__SEEK_FAR_STEP__)
+
+    elif key in __VOLUME_UP__:
+        audio.step_volume(1)
+    elif key in __VOLUME_DOWN__:
+        audio.step_volume(-1)
+
+    elif key in __TOGGLE_SHUFFLE__:
+        audio.set_shuffle(not audio.is_shuffled())
+    elif key in __CYCLE_REPEAT__:
+        audio.set_repeat_mode(__REPEAT_CYCLE__[(__REPEAT_CYCLE__.index(audio.get_repeat_mode()) + 1) % len(__REPEAT_CYCLE__)])
+
+
+def service_events():
+    '''Dispatches pending audio events, reports tracks that could not be played, collects the results of directory
+       scans, reports the progress of analyses and brings the search index up to date'''
+    audio.dispatch_events()
+    for message in audio.take_load_errors():
+        ui.write_cmd_line(message)
+    audio.update_search_index()
+    collect_scans()
+    collect_analysis()
+    if session.is_open() and time.monotonic() >= __next_session_save__:
+        try:
+            save_session()
+        except OSError:
+            # Recorded again at the next interval
+            pass
+
+
+def limit_timeout(timeout):
+    '''Limits the time to wait for input to when audio events, directory scans, analyses or commands next need to be serviced'''
+    event_timeout = audio.get_event_timeout()
+    if event_timeout is not None:
+        timeout = min(timeout, event_timeout)
+    if scanner.is_scanning() or audio.is_indexing():
+        timeout = min(timeout, __SCAN_POLL_INTERVAL__)
+    if analyzer.is_analyzing():
+        timeout = min(timeout, __ANALYSIS_POLL_INTERVAL__)
+    if commands.is_running() or len(__commands__) > 0:
+        timeout = min(timeout, __COMMAND_POLL_INTERVAL__)
+    return timeout
+
+
+def submit_command(cmd):
+    '''Submits a command to run on the worker (see commands), returning it. Its messages and progress are taken from
+       the command as it runs (see collect_commands), and its result once it is done (see get_command_result).
+       A cancel command first cancels the commands submitted before it, and the background work that is running.'''
+    if cmd.split()[:1] in [[name] for name in __CANCEL_COMMANDS__]:
+        cancel()
+    return commands.submit(cmd, lambda command: process_input(cmd, command.respond, command.set_status))
+
+
+def collect_commands():
+    '''Shows the messages and progress of the commands typed on the command line, and their results once they are done.
+       Returns True if a command has terminated the app.'''
+    quit_app = False
+    for command in list(__commands__):
+        # Check whether the command is done before collecting, so that no message is missed
+        done = command.future.done()
+        for message in command.take_messages():
+            ui.write_cmd_line(message)
+        status_set, status = command.take_status()
+        if status_set:
+            ui.set_status(status)
+
+        if done:
+            __commands__.remove(command)
+            quit_app = get_command_result(command, ui.write_cmd_line) or quit_app
+    return quit_app
+
+
+def get_command_result(command, respond):
+    '''Returns the result of a command that is done (whether the app should be terminated), reporting with respond
+       why it did not complete if it did not'''
+    try:
+        return command.future.result()
+    except commands.CommandCancelled:
+        respond('Cancelled: {}'.format(command.text.strip()))
+    except Exception:
+        respond('Invalid input')
+    return False
+
+
+def cancel():
+    '''Cancels the running commands, directory scans and analysis. Called when Ctrl-C is pressed, so it takes no lock.'''
+    commands.cancel_all()
+    scanner.cancel_all()
+    if analyzer.is_analyzing():
+        analyzer.cancel()
+    ui.set_status('Cancelled')
+
+
+def collect_scans():
+    '''Adds the files found by directory scans to the playlist, and reports the progress of the scans'''
+    for scan in list(scanner.get_scans()):
+        # Check whether the scan is done before collecting, so that no batch is missed
+        done = scan.done
+        for batch in scan.take_batches():
+            audio.add_to_playlist(batch, False)
+
+        if done:
+            scanner.finish_scan(scan)
+            ui.set_status('Added {} file(s) from directory: {}'.format(scan.found, os.path.abspath(scan.directory)))
+        else:
+            ui.set_status('Scanning directory: {} ({} file(s) found in {} directories)'.format(os.path.abspath(scan.directory), scan.found, scan.dirs_scanned))
+
+
+def collect_analysis():
+    '''Reports the progress of the running analysis, and its results once it is done'''
+    analysis = analyzer.get_analysis()
+    if analysis is None:
+        return
+    if analysis.done:
+        analyzer.forget_analysis()
+    ui.set_status(get_analysis_status(analysis))
+
+
+def get_analysis_status(analysis):
+    '''Returns the progress of an analysis, or its results once it is done'''
+    if not analysis.done:
+        return 'Analyzing: {} of {} file(s)'.format(analysis.get_progress(), analysis.total)
+    return '{} {} file(s) ({} already analyzed, {} failed), total length {}'.format(
+        'Analysis cancelled after' if analysis.is_cancelled() else 'Analyzed', analysis.analyzed, analysis.skipped, analysis.failed,
+        ui.format_duration(analysis.seconds))
+
+
+def restore_session():
+    '''Restores the playlist, current track, playback position, main panel mode and volume saved by the last run.
+       A track that was playing is loaded paused at its position, ready to resume.'''
+    try:
+        state = audio.restore_playlist(session.load)
+    except OSError:
+        # The session cannot be saved either, so the player runs without one
+        return
+    if state.playback == 0:
+        # No session was saved
+        return
+
+    if 0 <= state.current < len(audio.get_playlist()):
+        audio.set_current_track_idx(state.current)
+    if state.mode in [mode.value for mode in ui.MainPanelMode]:
+        ui.set_mode(ui.MainPanelMode(state.mode))
+    if state.replaygain in [mode.value for mode in dsp.ReplayGainMode]:
+        dsp.set_replaygain_mode(dsp.ReplayGainMode(state.replaygain))
+    audio.set_volume(state.volume)
+    if state.playback != audio.PlaybackState.STOPPED.value and len(audio.get_playlist()) > 0:
+        audio.resume(state.position)
+
+
+def save_session(snapshot = False):
+    '''Records the state of the session. The whole session (including the playlist) is saved as a snapshot when
+       snapshot is set, or when the journal of playlist edits has grown large.'''
+    global __next_session_save__
+    __next_session_save__ = time.monotonic() + __SESSION_INTERVAL__
+    state = session.SessionState(audio.get_current_track_idx() if len(audio.get_playlist()) > 0 else -1, audio.get_position(),
+                                 audio.get_playback_state().value, ui.get_mode().value, dsp.get_volume(), dsp.get_replaygain_mode().value)
+    if snapshot or session.needs_snapshot():
+        session.save(state, audio.get_playlist())
+    else:
+        session.record_state(state)
+
+
+def get_tick_interval():
+    '''Returns the time to wait between UI ticks. Nothing advances while playback is stopped or paused, so we tick less often.'''
+    if audio.get_playback_state() is audio.PlaybackState.PLAYING:
+        return __tick_interval__
+    return max(__tick_interval__, __IDLE_TICK_INTERVAL__)
+
+
+def set_tick_interval(seconds):
+    '''Sets the time (in seconds) to wait between UI ticks during playback'''
+    global __tick_interval__
+    if seconds > 0:
+        __tick_interval__ = seconds
 
 
 def update(message = None):
@@ -71,8 +402,54 @@ def update(message = None):
         ui.write_cmd_line(message)
 
 
-def process_input(cmd):
-    '''Processes the provided input command, executing appropriate logic.'''
+def parse_indices(args):
+    '''Returns the indices given as command arguments, expanding ranges (e.g. 5-9, inclusive). Raises ValueError if
+       an argument is not an index or a range.'''
+    indices = []
+    for arg in args:
+        first, sep, last = arg.partition('-')
+        if sep:
+            indices.extend(range(int(first), int(last) + 1))
+        else:
+            indices.append(int(arg))
+    return indices
+
+
+def process_input(cmd, respond = None, status = None):
+    '''Processes the provided input command, executing appropriate logic.
+       Messages are written to the command line, or passed to respond if it is provided (e.g. when running headless).
+       Progress is shown in the status line, or passed to status (or respond, without status) if respond is provided.
+       Returns True if the app should be terminated.'''
+    if status is None and respond is not None:
+        # Progress is passed to respond, other than the clearing of it
+        status = lambda message: respond(message) if message is not None else None
+    status = status or ui.set_status
+    respond = update if respond is None else respond
+
+    start = stats.start()
+    if start is None:
+        return execute_input(cmd, respond, status)
+
+    # The latency of a command is the time until its result is shown, as showing it may wait for the user to dismiss it
+    shown = []
+    def timed(show):
+        def show_timed(message):
+            if len(shown) == 0:
+                shown.append(message)
+                stats.stop('input.command', start)
+            show(message)
+        return show_timed
+
+    try:
+        return execute_input(cmd, timed(respond), timed(status))
+    finally:
+        if len(shown) == 0:
+            stats.stop('input.command', start)
+
+
+def execute_input(cmd, respond, status):
+    '''Executes the provided input command (see process_input), writing its result with respond, or with status for
+       progress that should not interrupt the user'''
 
     cmd_list = cmd.split()
 
@@ -99,11 +476,22 @@ def process_input(cmd):
 
         # Basic commands without args
         if is_command(['help', 'h']):
-            show_help()
+            show_help(respond)
         elif is_command(['refresh', 'rf']):
-            ui.refresh()
+            if ui.is_active():
+                ui.request_full_refresh()
         elif is_command(['quit', 'q']):
             return True
+        elif is_command(__CANCEL_COMMANDS__):
+            # The commands before it were cancelled when it was submitted (see submit_command)
+            respond('Cancelled running commands, scans and analysis')
+        elif is_command(['stats']):
+            # The stats view shows them in the UI. Otherwise (e.g. when running headless) they are listed in the response.
+            if ui.is_active():
+                ui.set_mode(ui.MainPanelMode.STATS)
+            else:
+                for line in stats.get_lines():
+                    respond(line)
 
 
 
@@ -116,35 +504,87 @@ def process_input(cmd):
                         audio.stop()         
                 if has_arg(['-file', '-f']):                                            # play filename
                     audio.play(cmd_list[2])
-                    update('Playing file {}'.format(cmd_list[2]))
+                    respond('Playing file {}'.format(cmd_list[2]))
                 else:                                                                   # play playlist index
                     audio.play_playlist_no( int(cmd_list[1]) )
-                    update('Playing playlist item {}'.format(cmd_list[1]))
+                    respond('Playing playlist item {}'.format(cmd_list[1]))
             else:
                 audio.play_pause()
-                update('Playing/pausing current track')
+                respond('Playing/pausing current track')
 
 
 
         # Stops playback
         elif is_command(['stop', 's']):
             audio.stop()
-            update('Stopped current track')
+            respond('Stopped current track')
+
+
+
+        # Seek within the current track, to a timestamp or relative to the current position
+        elif is_command(['seek', 'sk']):
+            if cmd_list[1][0] in '+-':
+                audio.seek_relative(parse_timestamp(cmd_list[1][1:]) * (-1 if cmd_list[1][0] == '-' else 1))
+            else:
+                audio.seek(parse_timestamp(cmd_list[1]))
+            respond('Seeked to {}'.format(cmd_list[1]))
 
 
 
         # Add all files listed to the playlist
         elif is_command(['add', 'a']):
-            if has_arg(["-dir"]):
-                count = 0
-                directory = os.fsencode(os.getcwd())
-                for filename in os.listdir(directory):
-                    filen = os.fsdecode(filename)
-                    count = count + audio.add_to_playlist([filen])
-                update('Added {} file(s) from directory: {}'.format(count, os.getcwd()))
+            if has_arg(['-dir', '-r']):
+                # Directories are scanned in the background. Files are added as they are found (see collect_scans).
+                args = [arg for arg in cmd_list[1:len(cmd_list)] if arg not in ['-dir', '-r']]
+                directory = args[0] if len(args) > 0 else os.curdir
+                if os.path.isdir(directory):
+                    scanner.start_scan(directory, has_arg(['-r']))
+                    status('Scanning directory: {}'.format(os.path.abspath(directory)))
+                else:
+                    respond('Directory not found: {}'.format(directory))
             else:
-                count = audio.add_to_playlist(cmd_list[1:len(cmd_list)])
-                update('Added {} file(s) to playlist: {}'.format(count, cmd_list[1:len(cmd_list)]))
+                # The files are checked without holding the state lock (see commands)
+                with commands.unlocked():
+                    tracks = audio.validate_tracks(cmd_list[1:len(cmd_list)])
+                count = audio.add_to_playlist(tracks, False)
+                respond('Added {} file(s) to playlist: {}'.format(count, cmd_list[1:len(cmd_list)]))
+
+
+
+        # Add the tracks of a playlist file to the playlist. The file is read and its tracks are added a batch at a time.
+        # Batches are read without holding the state lock, and the load can be cancelled between them.
+        elif is_command(['load', 'ld']):
+            path = ' '.join(cmd_list[1:len(cmd_list)])
+            try:
+                count = 0
+                batches = playlist_file.read_batches(path)
+                while True:
+                    with commands.unlocked():
+                        batch = next(batches, None)
+                    if batch is None:
+                        break
+                    commands.check_cancelled()
+                    count = count + audio.add_to_playlist(batch, False)
+                    status('Loading playlist: {} file(s) added'.format(count))
+                respond('Added {} file(s) from playlist: {}'.format(count, path))
+            except (OSError, ValueError) as e:
+                respond('Could not load playlist: {}'.format(e))
+            finally:
+                status(None)
+
+
+
+        # Save the playlist to a playlist file, in the format given by its extension. The file is written from a copy
+        # of the playlist without holding the state lock, and the save can be cancelled.
+        elif is_command(['save', 'sv']):
+            path = ' '.join(cmd_list[1:len(cmd_list)])
+            try:
+                tracks = list(audio.get_playlist())
+                with commands.unlocked():
+                    playlist_file.write(path, commands.iterate(tracks))
+                respond('Saved {} file(s) to playlist: {}'.format(len(tracks), path))
+            except (OSError, ValueError) as e:
+                respond('Could not save playlist: {}'.format(e))
 
 
 
@@ -152,10 +592,117 @@ def process_input(cmd):
         elif is_command(['remove', 'r']):
             if has_arg(['-all', '-a']):
                 audio.clear_playlist()
-                update('Playlist cleared')
+                respond('Playlist cleared')
             else:
                 audio.rem_from_playlist(cmd_list[1:len(cmd_list)])
-                update('Removed from playlist: {}'.format(cmd_list[1:len(cmd_list)]))
+                respond('Removed from playlist: {}'.format(cmd_list[1:len(cmd_list)]))
+
+
+
+        # Move a playlist item to another position
+        elif is_command(['move', 'mv']):
+            audio.move_in_playlist(int(cmd_list[1]), int(cmd_list[2]))
+            respond('Moved playlist item {} to {}'.format(cmd_list[1], cmd_list[2]))
+
+
+
+        # Set the volume, to a percentage or relative to the current volume
+        elif is_command(['volume', 'v']):
+            if len(cmd_list) > 1:
+                if cmd_list[1][0] in '+-':
+                    audio.set_volume(dsp.get_volume() + int(cmd_list[1]))
+                else:
+                    audio.set_volume(int(cmd_list[1]))
+            respond('Volume: {}%'.format(dsp.get_volume()))
+
+
+
+        # Set the ReplayGain mode
+        elif is_command(['replaygain', 'rg']):
+            if len(cmd_list) > 1:
+                dsp.set_replaygain_mode(dsp.ReplayGainMode[cmd_list[1].upper()])
+            note = '' if dsp.is_available() else ' (requires NumPy, which is not installed)'
+            respond('ReplayGain: {}{}'.format(dsp.get_replaygain_mode().name.lower(), note))
+
+
+
+        # Queue playlist tracks to play next, by index or by range of indices (e.g. 5-9)
+        elif is_command(['enqueue', 'eq']):
+            count = audio.enqueue(parse_indices(cmd_list[1:len(cmd_list)]))
+            respond('Queued {} track(s) to play next'.format(count))
+
+
+
+        # Remove tracks from the up next queue, by their position in it
+        elif is_command(['dequeue', 'dq']):
+            if has_arg(['-all', '-a']):
+                audio.clear_up_next()
+                respond('Cleared the up next queue')
+            else:
+                count = audio.dequeue(parse_indices(cmd_list[1:len(cmd_list)]))
+                respond('Removed {} track(s) from the up next queue'.format(count))
+
+
+
+        # List the up next queue. The playlist UI element marks the queued tracks, so only the first is named in the UI.
+        elif is_command(['queue', 'qu']):
+            up_next = audio.get_up_next()
+            if ui.is_active():
+                first = ': {}'.format(ui.get_track_label(up_next[0][1])) if len(up_next) > 0 else ''
+                respond('{} track(s) up next{}'.format(len(up_next), first))
+            else:
+                for position, (track_id, path) in enumerate(up_next[:__FIND_LIMIT__]):
+                    respond('{}. {} (playlist {})'.format(position + 1, ui.get_track_label(path), audio.get_playlist_track_idx(track_id) + 1))
+                respond('{} track(s) up next'.format(len(up_next)))
+
+
+
+        # Turn shuffle on or off, or toggle it
+        elif is_command(['shuffle', 'sh']):
+            if len(cmd_list) > 1:
+                audio.set_shuffle(cmd_list[1].lower() == 'on')
+            else:
+                audio.set_shuffle(not audio.is_shuffled())
+            respond('Shuffle: {}'.format('on' if audio.is_shuffled() else 'off'))
+
+
+
+        # Set the repeat mode
+        elif is_command(['repeat', 'rp']):
+            if len(cmd_list) > 1:
+                audio.set_repeat_mode(audio.RepeatMode[cmd_list[1].upper()])
+            respond('Repeat: {}'.format(audio.get_repeat_mode().name.lower()))
+
+
+
+        # Search the playlist. The UI shows the matches in place of the playlist, otherwise the first few are listed.
+        elif is_command(['find', 'f']):
+            query = ' '.join(cmd_list[1:len(cmd_list)])
+            if ui.is_active():
+                ui.start_search()
+                ui.set_search_query(query)
+            else:
+                matches = audio.search_playlist(query, wait=True) or set()
+                for track_id in audio.order_search_matches(matches, __FIND_LIMIT__):
+                    respond('{}. {}'.format(audio.get_playlist_track_idx(track_id) + 1, ui.get_track_label(audio.get_playlist_track_path(track_id))))
+                respond('{} match(es) for: {}'.format(len(matches), query))
+
+
+
+        # Analyze the playlist (or the whole library) in the background. Progress is reported by collect_analysis.
+        elif is_command(['analyze', 'an']):
+            if has_arg(['-cancel', '-c']):
+                if analyzer.is_analyzing():
+                    analyzer.cancel()
+                    respond('Cancelling analysis')
+                else:
+                    respond('No analysis is running')
+            elif analyzer.is_analyzing():
+                respond(get_analysis_status(analyzer.get_analysis()))
+            else:
+                paths = library.get_paths() if has_arg(['-library', '-l']) else list(audio.get_playlist())
+                analyzer.start_analysis(paths)
+                status('Analyzing: 0 of {} file(s)'.format(len(paths)))
 
 
 
@@ -165,17 +712,27 @@ def process_input(cmd):
                 ui.set_mode(ui.MainPanelMode.HELP)
             if has_arg(['details']):
                 ui.set_mode(ui.MainPanelMode.DETAILS)
-            update('Changed mode to {}'.format(cmd_list[1]))
+            if has_arg(['stats']):
+                ui.set_mode(ui.MainPanelMode.STATS)
+            respond('Changed mode to {}'.format(cmd_list[1]))
 
 
         # Unrecognized command
         else:
-           update('Unrecognized command.')
+           respond('Unrecognized command.')
 
     return False
 
 
-def show_help():
+def parse_timestamp(text):
+    '''Converts a timestamp in the format [[hh:]mm:]ss to seconds'''
+    seconds = 0.0
+    for part in text.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def show_help(respond):
     '''Shows help text to the user'''
-    ui.write_cmd_line('For detailed help, type \':\' to enter input mode and type \'mode help\'')
+    respond('For detailed help, type \':\' to enter input mode and type \'mode help\'')
 
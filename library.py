@@ -0,0 +1,277 @@
+'''
+Persistent index of track metadata (tags, audio format and duration), shared across runs
+'''
+
+import concurrent.futures
+import os
+import sqlite3
+import threading
+
+import backend
+
+
+# -----------------------------------------
+# Types
+# -----------------------------------------
+
+class TrackMetadata(object):
+    '''Stores the tags, audio format and duration of a track. The metadata of every track displayed is kept in memory,
+       so the fields are stored in slots rather than in a dictionary per track.'''
+    __slots__ = ('title', 'author', 'album', 'year', 'track', 'genre', 'channels', 'sample_rate', 'sample_size', 'duration')
+
+    def __init__(self, title = None, author = None, album = None, year = None, track = None, genre = None,
+                 channels = None, sample_rate = None, sample_size = None, duration = None):
+        self.title = title
+        self.author = author
+        self.album = album
+        self.year = year
+        self.track = track
+        self.genre = genre
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.sample_size = sample_size
+        self.duration = duration
+
+    @staticmethod
+    def from_source(source):
+        '''Creates the metadata of a loaded pyglet source'''
+        meta = TrackMetadata(duration = source.duration)
+        info = source.info
+        if info is not None:
+            meta.title = decode_tag(info.title)
+            meta.author = decode_tag(info.author)
+            meta.album = decode_tag(info.album)
+            meta.year = info.year or None
+            meta.track = info.track or None
+            meta.genre = decode_tag(info.genre)
+        audiof = source.audio_format
+        if audiof is not None:
+            meta.channels = audiof.channels
+            meta.sample_rate = audiof.sample_rate
+            meta.sample_size = audiof.sample_size
+        return meta
+
+
+# -----------------------------------------
+# Global constants
+# -----------------------------------------
+
+__DATA_DIR__ = os.path.join(os.path.expanduser('~'), '.argon')
+__DB_NAME__ = 'library.db'
+__PROBE_WORKERS__ = 2
+__UNREADABLE_KIND__ = 'unreadable'  # Blob kind marking a file whose metadata could not be read (see probe)
+
+__FIELDS__ = ['title', 'author', 'album', 'year', 'track', 'genre', 'channels', 'sample_rate', 'sample_size', 'duration']
+__SCHEMA__ = '''CREATE TABLE IF NOT EXISTS tracks (
+                    path TEXT PRIMARY KEY, mtime REAL, size INTEGER,
+                    title TEXT, author TEXT, album TEXT, year INTEGER, track INTEGER, genre TEXT,
+                    channels INTEGER, sample_rate INTEGER, sample_size INTEGER, duration REAL)'''
+__BLOB_SCHEMA__ = '''CREATE TABLE IF NOT EXISTS blobs (
+                    kind TEXT, path TEXT, mtime REAL, size INTEGER, data BLOB,
+                    PRIMARY KEY (kind, path))'''
+
+
+# -----------------------------------------
+# Global variables
+# -----------------------------------------
+
+__connection__ = None
+__lock__ = threading.Lock()     # Guards the connection and the in-memory cache, which are shared with the probe threads
+
+__cache__ = {}                  # Absolute path -> TrackMetadata of tracks validated during this run (None if it cannot be read)
+__probing__ = set()             # Absolute paths currently being probed
+__prober__ = None               # Executor that reads metadata off the input thread
+__library_version__ = 0         # Incremented whenever metadata becomes available
+__stored__ = []                 # Absolute paths in the order their metadata became available, indexed by library version
+
+
+# -----------------------------------------
+# Functions
+# -----------------------------------------
+
+def get_data_dir():
+    '''Returns the directory in which the library and other caches are stored'''
+    return __DATA_DIR__
+
+
+def get_version():
+    return __library_version__
+
+
+def get_metadata(path):
+    '''Returns the metadata of the specified file, or None if it is not yet known.
+       Unknown (or modified) files are probed in the background, and become available once get_version() changes.'''
+    if path is None:
+        return None
+
+    key = os.path.abspath(path)
+    with __lock__:
+        if key in __cache__:
+            return __cache__[key]
+        # Redraws ask again until the probe is done, which need not read the library each time
+        if key in __probing__:
+            return None
+
+    try:
+        stat = os.stat(key)
+    except OSError:
+        return None
+
+    meta = lookup(key, stat)
+    if meta is not None or lookup_blob(__UNREADABLE_KIND__, key, stat) is not None:
+        # A file that could not be read is not probed again until it changes
+        with __lock__:
+            __cache__[key] = meta
+        return meta
+
+    request_probe(key, stat)
+    return None
+
+
+def get_stored_since(version):
+    '''Returns the absolute paths of the files whose metadata has become available since the specified library
+       version, and the current version'''
+    with __lock__:
+        return __stored__[version:], __library_version__
+
+
+def get_cached_metadata(path):
+    '''Returns the metadata of the specified file if it is already in memory, without reading the library or probing the file'''
+    with __lock__:
+        return __cache__.get(os.path.abspath(path))
+
+
+def prime(path, stat):
+    '''Loads the stored metadata of a file into memory if it is still valid, and returns it (None if it is not).
+       Used when the file's stat is already at hand.'''
+    key = os.path.abspath(path)
+    with __lock__:
+        if __cache__.get(key) is not None:
+            return __cache__[key]
+    meta = lookup(key, stat)
+    if meta is not None:
+        with __lock__:
+            __cache__[key] = meta
+    return meta
+
+
+def get_paths():
+    '''Returns the paths of all the files in the library'''
+    with __lock__:
+        return [row[0] for row in get_connection().execute('SELECT path FROM tracks ORDER BY path')]
+
+
+def store_source_metadata(path, source):
+    '''Stores the metadata of a source that has already been loaded, saving a separate probe of the file'''
+    key = os.path.abspath(path)
+    with __lock__:
+        if __cache__.get(key) is not None:
+            return
+    try:
+        stat = os.stat(key)
+    except OSError:
+        return
+    store(key, stat, TrackMetadata.from_source(source))
+
+
+def request_probe(key, stat):
+    '''Reads the metadata of the specified file on a probe thread'''
+    global __prober__
+    with __lock__:
+        if key in __probing__:
+            return
+        __probing__.add(key)
+        if __prober__ is None:
+            __prober__ = concurrent.futures.ThreadPoolExecutor(max_workers=__PROBE_WORKERS__)
+    __prober__.submit(probe, key, stat)
+
+
+def probe(key, stat):
+    '''Loads the specified file to read its metadata and stores it in the library. A file that cannot be read is
+       stored as such, so that it is not probed again (on every redraw) until it changes.'''
+    try:
+        store(key, stat, TrackMetadata.from_source(backend.get_pyglet().media.load(key, streaming=True)))
+    except Exception:
+        store_blob(__UNREADABLE_KIND__, key, stat, b'')
+        with __lock__:
+            __cache__[key] = None
+    finally:
+        with __lock__:
+            __probing__.discard(key)
+
+
+def lookup(key, stat):
+    '''Returns the stored metadata of the specified file, or None if it is not stored or the file has changed since'''
+    with __lock__:
+        row = get_connection().execute('SELECT mtime, size, {} FROM tracks WHERE path = ?'.format(', '.join(__FIELDS__)), (key,)).fetchone()
+    if row is None or row[0] != stat.st_mtime or row[1] != stat.st_size:
+        return None
+    return TrackMetadata(*row[2:])
+
+
+def store(key, stat, meta):
+    '''Stores the metadata of the specified file, both in memory and in the library'''
+    global __library_version__
+    values = [key, stat.st_mtime, stat.st_size] + [getattr(meta, field) for field in __FIELDS__]
+    with __lock__:
+        connection = get_connection()
+        connection.execute('INSERT OR REPLACE INTO tracks VALUES ({})'.format(', '.join('?' * len(values))), values)
+        connection.commit()
+        __cache__[key] = meta
+        __stored__.append(key)
+        __library_version__ = __library_version__ + 1
+
+
+def lookup_blob(kind, key, stat):
+    '''Returns the data of the specified kind (e.g. a waveform) cached for a file, or None if it is not cached or the file has changed since'''
+    with __lock__:
+        row = get_connection().execute('SELECT mtime, size, data FROM blobs WHERE kind = ? AND path = ?', (kind, key)).fetchone()
+    if row is None or row[0] != stat.st_mtime or row[1] != stat.st_size:
+        return None
+    return bytes(row[2])
+
+
+def store_blob(kind, key, stat, data):
+    '''Caches data of the specified kind for a file'''
+    with __lock__:
+        connection = get_connection()
+        connection.execute('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?)', (kind, key, stat.st_mtime, stat.st_size, data))
+        connection.commit()
+
+
+def get_connection():
+    '''Returns the connection to the library database, opening it on first use. Must be called with the lock held.'''
+    global __connection__
+    if __connection__ is None:
+        os.makedirs(__DATA_DIR__, exist_ok=True)
+        __connection__ = sqlite3.connect(os.path.join(__DATA_DIR__, __DB_NAME__), check_same_thread=False)
+        __connection__.execute('PRAGMA journal_mode=WAL')
+        __connection__.execute('PRAGMA synchronous=NORMAL')
+        __connection__.execute(__SCHEMA__)
+        __connection__.execute(__BLOB_SCHEMA__)
+    return __connection__
+
+
+def close():
+    '''Stops probing and closes the library'''
+    global __connection__, __prober__
+    if __prober__ is not None:
+        __prober__.shutdown(wait=True, cancel_futures=True)
+        __prober__ = None
+    with __lock__:
+        if __connection__ is not None:
+            __connection__.close()
+            __connection__ = None
+
+
+# -----------------------------------------
+# Helpers
+# -----------------------------------------
+
+def decode_tag(value):
+    '''Returns a tag as a string (pyglet provides most tags as utf-8 encoded bytes), or None if it is empty'''
+    if not value:
+        return None
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return str(value)
@@ -5,38 +5,64 @@
 A light-weight music player.
 '''
 
+import os
 import sys
-import threading
+import time
 
+startup_time = time.perf_counter()
+
+import analyzer
 import audio
+import backend
+import commands
 import input_listener
+import library
+import replaygain
+import scanner
+import server
+import session
+import stats
 import ui
+import waveform
 
 # -----------------------------------------
 # Global constants / variables
 # -----------------------------------------
 
-___HELP__ = "This is some help text"
+___HELP__ = """Usage: main.py [-nosplash] [-nosession] [-tick seconds] [-output pyglet|null|wav [file]] [-stats [file]] [-startup-profile]
+       main.py -headless [-nosession] [-socket path] [-output pyglet|null|wav [file]] [-stats [file]] [-startup-profile]
+       main.py -send command [-socket path]"""
+
+__DEFAULT_OUTPUT_FILE__ = 'output.wav'
 
 app_started = False
+startup_phases = [('imports', time.perf_counter() - startup_time)]     # (name, seconds) of each phase of startup
 
 # -----------------------------------------
 # Methods
 # -----------------------------------------
 
 def start_app():
-    '''Starts the main application'''
+    '''Starts the main application. The UI comes up first, while the audio backend loads in the background.'''
+    start = time.perf_counter()
     ui.init()
+    backend.preload()
 
     global app_started
     app_started = True
+    start = record_phase('ui init', start)
+
+    if "-nosession" not in sys.argv:
+        input_listener.restore_session()
+        start = record_phase('session restore', start)
 
     if "-nosplash" not in sys.argv:
         ui.display_splash()
+        start = record_phase('splash', start)
 
     ui.refresh()
-
-    #threading._start_new_thread(ui.refresh_thread, ())
+    record_phase('first refresh', start)
+    startup_phases.append(('time to first frame', time.perf_counter() - startup_time))
 
     # Start listening for user input
     input_listener.listen()
@@ -45,29 +71,112 @@ def start_app():
 def main():
     '''Start terminal screen and set up'''
 
+    if "-tick" in sys.argv:
+        input_listener.set_tick_interval(float(get_arg("-tick")))
+
+    if "-stats" in sys.argv:
+        stats.enable()
+
+    if "-output" in sys.argv:
+        backend.set_output(get_arg("-output"), get_output_path())
+
     if "-h" in sys.argv or "-help" in sys.argv:
         print (___HELP__);
 
+    elif "-headless" in sys.argv:
+        backend.preload()
+        if "-nosession" not in sys.argv:
+            input_listener.restore_session()
+        server.serve(get_arg("-socket"))
+
+    elif "-send" in sys.argv:
+        print(server.send(get_arg("-send"), get_arg("-socket")))
+
     else:
         start_app()
 
 
+def record_phase(name, start):
+    '''Records the time taken by a phase of startup that began at start, and returns the current time'''
+    now = time.perf_counter()
+    startup_phases.append((name, now - start))
+    return now
+
+
+def print_startup_profile():
+    '''Prints the time taken by each phase of startup, and by loading the backend in the background'''
+    load_time = backend.get_load_time()
+    phases = startup_phases + [('backend load (background)', load_time)]
+    print("Startup profile:")
+    for name, seconds in phases:
+        print("  {:<28}{}".format(name, "{:9.1f} ms".format(seconds * 1000) if seconds is not None else "      not loaded"))
+
+
+def get_stats_path():
+    '''Returns the file to write statistics to: the one following -stats, or the default'''
+    path = get_arg("-stats")
+    if path is None or path.startswith("-"):
+        return stats.get_default_path()
+    return path
+
+
+def get_output_path():
+    '''Returns the file that the wav output writes to: the one following -output wav, or the default'''
+    index = sys.argv.index("-output") + 2
+    if index < len(sys.argv) and not sys.argv[index].startswith("-"):
+        return sys.argv[index]
+    os.makedirs(library.get_data_dir(), exist_ok=True)
+    return os.path.join(library.get_data_dir(), __DEFAULT_OUTPUT_FILE__)
+
+
+def get_arg(name):
+    '''Returns the value following the specified command line argument, or None if the argument is not present'''
+    if name in sys.argv and sys.argv.index(name) + 1 < len(sys.argv):
+        return sys.argv[sys.argv.index(name) + 1]
+    return None
+
+
 # -----------------------------------------
 # Entry point
 # -----------------------------------------
 
-failure = False
-failure_msg = ''
-
-try:
-    main()
-except BaseException as e:
-    failure = True
-    failure_msg = str(e)
-finally:
-    if app_started:
-        ui.deinit()
-    audio.stop()
-
-    if failure:
-        print("Unexpected failure! Safely handled.\nException:{}".format(failure_msg))
+# Analysis workers (see analyzer) import this module afresh, so the application only runs when it is the script
+if __name__ == '__main__':
+    failure = False
+    failure_msg = ''
+
+    try:
+        main()
+    except BaseException as e:
+        failure = True
+        failure_msg = str(e)
+    finally:
+        if app_started:
+            ui.deinit()
+        # No command may use the state from here on
+        commands.shutdown()
+        scanner.cancel_all()
+        analyzer.cancel()
+        if session.is_open():
+            try:
+                input_listener.save_session(snapshot=True)
+            except OSError as e:
+                print("Could not save the session: {}".format(e))
+            session.close()
+        audio.stop()
+        backend.close()
+        waveform.close()
+        replaygain.close()
+        library.close()
+
+        if "-startup-profile" in sys.argv:
+            print_startup_profile()
+
+        if stats.is_enabled():
+            try:
+                stats.dump(get_stats_path())
+            except OSError as e:
+                print("Could not write statistics: {}".format(e))
+
+        if failure:
+            print("Unexpected failure! Safely handled.\nException:{}".format(failure_msg))
@@ -0,0 +1,376 @@
+'''
+Playlist container supporting fast edits of very large playlists
+'''
+
+import array
+import itertools
+import os
+
+# -----------------------------------------
+# Global constants
+# -----------------------------------------
+
+__CHUNK_SIZE__ = 512            # Target number of tracks per chunk. Chunks are split once they reach twice this size.
+__SORT_SCAN_THRESHOLD__ = 16    # Number of ids within a chunk from which sorting them scans the chunk, rather than finding each
+__SORT_SCAN_RATIO__ = 32        # Sorting ids scans the whole playlist once they number at least 1 / __SORT_SCAN_RATIO__ of it
+
+
+# -----------------------------------------
+# Types
+# -----------------------------------------
+
+class Playlist(object):
+    '''An ordered list of track paths. Each track is given an id when added, which stays valid until it is removed.
+       Tracks are stored in chunks, with a Fenwick tree of the chunk lengths, so that finding, inserting or removing
+       a track at any position is O(log n) (plus a bounded amount of work within its chunk) and appending is O(1).
+       The version is incremented on every edit.
+
+       To keep large playlists small in memory, ids are numbered consecutively and the tracks' fields are stored in
+       columns indexed by id rather than in an object per track. A track's path is split into its directory, which
+       is shared by all the tracks in that directory, and its file name.'''
+
+    def __init__(self):
+        self.version = 0
+        self.__next_id = 0
+        self.__base_id = 0          # Id of the first entry in the columns
+        self.__count = 0
+        self.__in_id_order = True   # Whether the tracks are in the order of their ids, i.e. none was inserted or moved
+        self.__dirs = []            # Directories of the tracks, each stored once
+        self.__dir_index = {}       # Directory -> its index in __dirs
+        self.__track_dirs = array.array('L')    # Track id - base id -> index of the track's directory
+        self.__track_names = []     # Track id - base id -> file name of the track (None once removed)
+        self.__chunk_of = []        # Track id - base id -> the chunk that contains it (None while it has none)
+        self.__chunks = []          # Lists of track ids, in playlist order
+        self.__positions = {}       # id() of a chunk -> its position in __chunks
+        self.__tree = [0]           # Fenwick tree (1-based) of the chunk lengths
+
+    def __len__(self):
+        return self.__count
+
+    def __iter__(self):
+        for chunk in self.__chunks:
+            for track_id in chunk:
+                yield self.get_path(track_id)
+
+    def __getitem__(self, index):
+        '''Returns the path at the specified index, or a list of paths for a slice (with a step of 1)'''
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('Playlist slices do not support steps')
+            return [self.get_path(track_id) for track_id in self.iter_ids(start, stop)]
+        return self.get_path(self.get_id(index))
+
+    # -----------------------------------------
+    # Lookup
+    # -----------------------------------------
+
+    def get_id(self, index):
+        '''Returns the id of the track at the specified index'''
+        if index < 0:
+            index = index + len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('Playlist index out of range')
+        pos, offset = self.__locate(index)
+        return self.__chunks[pos][offset]
+
+    def get_path(self, track_id):
+        '''Returns the path of the track with the specified id'''
+        if not self.has_id(track_id):
+            raise KeyError(track_id)
+        slot = track_id - self.__base_id
+        return self.__dirs[self.__track_dirs[slot]] + self.__track_names[slot]
+
+    def get_id_range(self):
+        '''Returns the range of the ids of the tracks added since the playlist was last cleared, as (first, stop).
+           Ids of tracks removed since remain in the range.'''
+        return self.__base_id, self.__next_id
+
+    def has_id(self, track_id):
+        slot = track_id - self.__base_id
+        return 0 <= slot < len(self.__track_names) and self.__track_names[slot] is not None
+
+    def index_of(self, track_id):
+        '''Returns the current index of the track with the specified id'''
+        slot = track_id - self.__base_id
+        chunk = self.__chunk_of[slot] if 0 <= slot < len(self.__chunk_of) else None
+        if chunk is None:
+            raise KeyError(track_id)
+        return self.__prefix(self.__positions[id(chunk)]) + chunk.index(track_id)
+
+    def sort_ids(self, ids, limit = None):
+        '''Returns the specified ids (a set) in playlist order, leaving out those of tracks that are no longer in the playlist.
+           Only the first limit ids are returned if limit is given.
+           Few ids are sorted directly if no track has been inserted or moved, or else grouped by chunk so that only the
+           chunks containing them are searched. Otherwise the chunks are scanned, up to the last id returned.'''
+        if len(ids) * __SORT_SCAN_RATIO__ >= len(self):
+            return list(itertools.islice((track_id for chunk in self.__chunks for track_id in chunk if track_id in ids), limit))
+        if self.__in_id_order:
+            return [track_id for track_id in sorted(ids) if self.has_id(track_id)][:limit]
+
+        groups = {}
+        for track_id in ids:
+            slot = track_id - self.__base_id
+            chunk = self.__chunk_of[slot] if 0 <= slot < len(self.__chunk_of) else None
+            if chunk is not None:
+                groups.setdefault(id(chunk), (chunk, []))[1].append(track_id)
+
+        ordered = []
+        for key in sorted(groups, key=self.__positions.__getitem__):
+            chunk, members = groups[key]
+            if len(members) < __SORT_SCAN_THRESHOLD__:
+                members.sort(key=chunk.index)
+                ordered.extend(members)
+            else:
+                members = set(members)
+                ordered.extend(track_id for track_id in chunk if track_id in members)
+            if limit is not None and len(ordered) >= limit:
+                break
+        return ordered[:limit]
+
+    def get_columns(self):
+        '''Returns the tracks as columns, in playlist order: the directories, the index of each track's directory and
+           each track's file name. Used to store the playlist compactly (see extend_columns).'''
+        dir_indices, names = array.array('L'), []
+        for chunk in self.__chunks:
+            for track_id in chunk:
+                slot = track_id - self.__base_id
+                dir_indices.append(self.__track_dirs[slot])
+                names.append(self.__track_names[slot])
+        return self.__dirs, dir_indices, names
+
+    def iter_ids(self, start = 0, stop = None):
+        '''Iterates over the ids of the tracks from index start up to (but excluding) index stop'''
+        stop = len(self) if stop is None else min(stop, len(self))
+        if start >= stop:
+            return
+        pos, offset = self.__locate(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = self.__chunks[pos][offset:offset + remaining]
+            yield from chunk
+            remaining = remaining - len(chunk)
+            pos, offset = pos + 1, 0
+
+    # -----------------------------------------
+    # Editing
+    # -----------------------------------------
+
+    def append(self, path):
+        '''Appends a track, returning its id'''
+        return self.extend([path])[0]
+
+    def extend(self, paths):
+        '''Appends the specified tracks, returning their ids'''
+        ids = self.__create_ids(paths)
+        self.__attach(len(self) - len(ids), ids)
+        return ids
+
+    def extend_columns(self, dirs, dir_indices, names):
+        '''Appends tracks given as columns (see get_columns), returning their ids. Their paths are not split again,
+           so this is much faster than extend() for large numbers of tracks.'''
+        mapping = [self.__get_dir_index(directory) for directory in dirs]
+        if mapping != list(range(len(mapping))):
+            dir_indices = array.array('L', [mapping[index] for index in dir_indices])
+        ids = self.__create_entries(dir_indices, names)
+        self.__attach(len(self) - len(ids), ids)
+        return ids
+
+    def insert(self, index, paths):
+        '''Inserts the specified tracks before the specified index, returning their ids'''
+        index = max(0, min(index, len(self)))
+        if index < len(self) and len(paths) > 0:
+            self.__in_id_order = False
+        ids = self.__create_ids(paths)
+        self.__attach(index, ids)
+        return ids
+
+    def remove_indices(self, indices):
+        '''Removes the tracks at the specified indices, returning their ids'''
+        ids = [self.get_id(index) for index in indices]
+        self.remove_ids(ids)
+        return ids
+
+    def remove_ids(self, ids):
+        '''Removes the tracks with the specified ids'''
+        self.__detach(ids)
+        for track_id in ids:
+            if self.has_id(track_id):
+                self.__track_names[track_id - self.__base_id] = None
+                self.__count = self.__count - 1
+
+    def move(self, src, dst):
+        '''Moves the track at index src so that it ends up at index dst'''
+        track_id = self.get_id(src)
+        self.__detach([track_id])
+        self.__attach(max(0, min(dst, len(self) - 1)), [track_id])
+        self.__in_id_order = self.__in_id_order and src == dst
+
+    def clear(self):
+        '''Removes all tracks. Ids are not reused, so ids of removed tracks never refer to new ones.'''
+        self.__base_id = self.__next_id
+        self.__count = 0
+        self.__in_id_order = True
+        self.__dirs = []
+        self.__dir_index = {}
+        self.__track_dirs = array.array('L')
+        self.__track_names = []
+        self.__chunk_of = []
+        self.__chunks = []
+        self.__rebuild()
+        self.version = self.version + 1
+
+    # -----------------------------------------
+    # Internals
+    # -----------------------------------------
+
+    def __create_ids(self, paths):
+        '''Assigns ids to the specified paths and records their fields (they are not yet part of the playlist order)'''
+        # Tracks are usually added a directory at a time, so the previous track's directory is checked first
+        last_dir, index = None, None
+        dir_indices, names = array.array('L'), []
+        for path in paths:
+            head, sep, name = path.rpartition(os.sep)
+            if head != last_dir:
+                last_dir = head
+                index = self.__get_dir_index(head + sep)
+            dir_indices.append(index)
+            names.append(name)
+        return self.__create_entries(dir_indices, names)
+
+    def __create_entries(self, dir_indices, names):
+        '''Assigns ids to tracks given by the indices of their directories and their file names, and records their fields'''
+        ids = list(range(self.__next_id, self.__next_id + len(names)))
+        self.__next_id = self.__next_id + len(ids)
+        self.__track_dirs.extend(dir_indices)
+        self.__track_names.extend(names)
+        self.__chunk_of.extend([None] * len(ids))
+        self.__count = self.__count + len(ids)
+        return ids
+
+    def __get_dir_index(self, directory):
+        '''Returns the index of a directory in __dirs, adding it if it is new'''
+        index = self.__dir_index.get(directory)
+        if index is None:
+            index = self.__dir_index[directory] = len(self.__dirs)
+            self.__dirs.append(directory)
+        return index
+
+    def __attach(self, index, ids):
+        '''Places the specified ids into the playlist order, before the specified index'''
+        if len(ids) == 0:
+            return
+
+        # The tracks' fields have already been recorded, so the current length of the order excludes them
+        count = self.__prefix(len(self.__tree) - 1)
+        if index >= count:
+            self.__append(ids)
+        else:
+            pos, offset = self.__locate(index)
+            chunk = self.__chunks[pos]
+            chunk[offset:offset] = ids
+            self.__set_chunk(chunk, ids)
+            if len(chunk) >= 2 * __CHUNK_SIZE__:
+                self.__rebuild()
+            else:
+                self.__add(pos, len(ids))
+        self.version = self.version + 1
+
+    def __append(self, ids):
+        '''Appends ids to the playlist order, filling the last chunk and then adding chunks of __CHUNK_SIZE__ ids'''
+        start = 0
+        if len(self.__chunks) > 0 and len(self.__chunks[-1]) < __CHUNK_SIZE__:
+            start = __CHUNK_SIZE__ - len(self.__chunks[-1])
+            self.__chunks[-1].extend(ids[:start])
+            self.__set_chunk(self.__chunks[-1], ids[:start])
+            self.__add(len(self.__chunks) - 1, len(ids[:start]))
+
+        if start < len(ids):
+            # Chunks are built whole, so large appends are not split into chunks afterwards
+            for first in range(start, len(ids), __CHUNK_SIZE__):
+                chunk = ids[first:first + __CHUNK_SIZE__]
+                self.__set_chunk(chunk, chunk)
+                self.__chunks.append(chunk)
+            self.__rebuild()
+
+    def __set_chunk(self, chunk, ids):
+        '''Records the chunk that contains the specified ids'''
+        if len(ids) > 1 and ids == list(range(ids[0], ids[0] + len(ids))):
+            # Ids of tracks added together are consecutive, so their slots are set at once
+            slot = ids[0] - self.__base_id
+            self.__chunk_of[slot:slot + len(ids)] = [chunk] * len(ids)
+        else:
+            for track_id in ids:
+                self.__chunk_of[track_id - self.__base_id] = chunk
+
+    def __detach(self, ids):
+        '''Removes the specified ids from the playlist order'''
+        removed = {}
+        for track_id in ids:
+            slot = track_id - self.__base_id
+            chunk = self.__chunk_of[slot] if 0 <= slot < len(self.__chunk_of) else None
+            if chunk is not None:
+                self.__chunk_of[slot] = None
+                removed.setdefault(id(chunk), (chunk, set()))[1].add(track_id)
+
+        emptied = False
+        for chunk, chunk_ids in removed.values():
+            chunk[:] = [track_id for track_id in chunk if track_id not in chunk_ids]
+            self.__add(self.__positions[id(chunk)], -len(chunk_ids))
+            emptied = emptied or len(chunk) == 0
+
+        if emptied:
+            self.__rebuild()
+        if len(removed) > 0:
+            self.version = self.version + 1
+
+    def __rebuild(self):
+        '''Splits oversized chunks, drops empty ones and rebuilds the positions and the Fenwick tree'''
+        chunks = []
+        for chunk in self.__chunks:
+            if len(chunk) >= 2 * __CHUNK_SIZE__:
+                for start in range(0, len(chunk), __CHUNK_SIZE__):
+                    piece = chunk[start:start + __CHUNK_SIZE__]
+                    for track_id in piece:
+                        self.__chunk_of[track_id - self.__base_id] = piece
+                    chunks.append(piece)
+            elif len(chunk) > 0:
+                chunks.append(chunk)
+        self.__chunks = chunks
+        self.__positions = {id(chunk): pos for pos, chunk in enumerate(chunks)}
+
+        tree = [0] * (len(chunks) + 1)
+        for i in range(1, len(tree)):
+            tree[i] = tree[i] + len(chunks[i - 1])
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] = tree[parent] + tree[i]
+        self.__tree = tree
+
+    def __add(self, pos, delta):
+        '''Adds delta to the length of the chunk at the specified position'''
+        i = pos + 1
+        while i < len(self.__tree):
+            self.__tree[i] = self.__tree[i] + delta
+            i = i + (i & -i)
+
+    def __prefix(self, pos):
+        '''Returns the number of tracks in the chunks before the specified position'''
+        total = 0
+        i = pos
+        while i > 0:
+            total = total + self.__tree[i]
+            i = i - (i & -i)
+        return total
+
+    def __locate(self, index):
+        '''Returns the position of the chunk containing the specified index, and the offset of the index within it'''
+        pos = 0
+        remaining = index
+        step = 1 << (len(self.__tree) - 1).bit_length()
+        while step > 0:
+            if pos + step < len(self.__tree) and self.__tree[pos + step] <= remaining:
+                pos = pos + step
+                remaining = remaining - self.__tree[pos]
+            step = step >> 1
+        return pos, remaining
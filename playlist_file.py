@@ -0,0 +1,246 @@
+'''
+Reading and writing playlist files: M3U (and M3U8), PLS and XSPF. Playlist files are read and written as streams of
+paths, so even playlists of hundreds of thousands of tracks are handled in bounded memory.
+'''
+
+import collections
+import os
+import re
+import urllib.parse
+
+import audio
+import library
+
+
+# -----------------------------------------
+# Types
+# -----------------------------------------
+
+class DirectoryListings(object):
+    '''Checks whether files exist by listing their directories, rather than by a system call per file. The tracks of
+       a playlist are mostly grouped by directory, so only the listings of the directories seen last are kept.'''
+
+    def __init__(self):
+        self.__listings = collections.OrderedDict()     # Directory -> set of the names of the files it contains
+        self.__last = (None, None)  # The directory of the last path checked, and its files
+
+    def is_file(self, path):
+        directory, _, name = path.rpartition(os.sep)
+        if not directory:
+            directory = os.sep if path.startswith(os.sep) else os.curdir
+        # Consecutive tracks are mostly in the same directory
+        last_directory, files = self.__last
+        if directory != last_directory:
+            files = self.get_files(directory)
+            self.__last = (directory, files)
+        return name in files
+
+    def get_files(self, directory):
+        '''Returns the names of the files in a directory (empty if it cannot be listed)'''
+        files = self.__listings.get(directory)
+        if files is not None:
+            self.__listings.move_to_end(directory)
+            return files
+
+        files = set()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file():
+                            files.add(entry.name)
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+
+        self.__listings[directory] = files
+        if len(self.__listings) > __LISTING_CACHE_SIZE__:
+            self.__listings.popitem(last=False)
+        return files
+
+
+# -----------------------------------------
+# Global constants
+# -----------------------------------------
+
+__FORMATS__ = {'.m3u': 'm3u', '.m3u8': 'm3u', '.pls': 'pls', '.xspf': 'xspf'}
+__BATCH_SIZE__ = 1000           # Paths validated and added to the playlist at a time
+__LISTING_CACHE_SIZE__ = 64     # Directory listings kept while validating paths
+__URI_PATTERN__ = re.compile(r'^[A-Za-z][A-Za-z0-9+.-]*://')
+__FILE_URI_PREFIX__ = 'file://'
+__PLS_FILE_PATTERN__ = re.compile(r'^File\d+=(.*)$', re.IGNORECASE)
+__XSPF_NAMESPACE__ = 'http://xspf.org/ns/0/'
+__ENCODING__ = 'utf-8'
+__ENCODING_ERRORS__ = 'surrogateescape'     # File names that are not valid UTF-8 are read and written unchanged
+
+
+# -----------------------------------------
+# Functions
+# -----------------------------------------
+
+def get_format(path):
+    '''Returns the format of a playlist file ('m3u', 'pls' or 'xspf') from its extension, or None if it is not supported'''
+    return __FORMATS__.get(os.path.splitext(path)[1].lower())
+
+
+def read_batches(path, batch_size = __BATCH_SIZE__):
+    '''Reads a playlist file, yielding its tracks in lists of up to batch_size paths. Only the tracks that exist and
+       are of a supported format are yielded. Raises ValueError if the format of the file is not supported.'''
+    listings = DirectoryListings()
+    batch = []
+    for track in read_paths(path):
+        if audio.is_supported_format(track) and listings.is_file(track):
+            batch.append(track)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def read_paths(path):
+    '''Reads a playlist file, yielding the paths of its tracks. Paths relative to the playlist are resolved against
+       its directory, and tracks that are not local files (e.g. streams) are skipped.'''
+    playlist_format = get_format(path)
+    if playlist_format is None:
+        raise ValueError('Unsupported playlist format: {}'.format(path))
+
+    base = os.path.dirname(path)
+    with open(path, 'rb') as f:
+        if playlist_format == 'xspf':
+            entries = read_xspf(f)
+        else:
+            lines = (line.decode(__ENCODING__, __ENCODING_ERRORS__).strip().lstrip('\ufeff') for line in f)
+            entries = read_m3u(lines) if playlist_format == 'm3u' else read_pls(lines)
+
+        for entry in entries:
+            track = resolve_entry(entry, base)
+            if track is not None:
+                yield track
+
+
+def write(path, tracks):
+    '''Writes the tracks (an iterable of paths) to a playlist file, in the format given by its extension. Tracks are
+       written by absolute path, with their title and duration when their metadata is known. The file is replaced
+       only once it has been written in full. Raises ValueError if the format is not supported.'''
+    playlist_format = get_format(path)
+    if playlist_format is None:
+        raise ValueError('Unsupported playlist format: {}'.format(path))
+    writer = {'m3u': write_m3u, 'pls': write_pls, 'xspf': write_xspf}[playlist_format]
+
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'w', encoding=__ENCODING__, errors=__ENCODING_ERRORS__, newline='\n') as f:
+            writer(f, ((os.path.abspath(track), library.get_cached_metadata(track)) for track in tracks))
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+# -----------------------------------------
+# Helpers
+# -----------------------------------------
+
+def read_m3u(lines):
+    '''Yields the entries of an M3U playlist. Lines starting with # are directives (e.g. #EXTINF) or comments.'''
+    for line in lines:
+        if line and not line.startswith('#'):
+            yield line
+
+
+def read_pls(lines):
+    '''Yields the entries of a PLS playlist, in the order they appear'''
+    for line in lines:
+        match = __PLS_FILE_PATTERN__.match(line)
+        if match is not None:
+            yield match.group(1).strip()
+
+
+def read_xspf(f):
+    '''Yields the locations of the tracks of an XSPF playlist. Each track is discarded once it has been read, so the
+       document is never held in memory as a whole.'''
+    # The XML modules (which import urllib.request) are only imported when they are needed, as they are slow to import
+    import xml.etree.ElementTree as ElementTree
+    track_list = None
+    try:
+        for event, element in ElementTree.iterparse(f, events=('start', 'end')):
+            tag = element.tag.rpartition('}')[2]
+            if event == 'start':
+                if tag == 'trackList':
+                    track_list = element
+            elif tag == 'track':
+                location = element.find('{' + __XSPF_NAMESPACE__ + '}location')
+                if location is None:
+                    location = element.find('location')
+                if location is not None and location.text:
+                    yield location.text.strip()
+                if track_list is not None:
+                    track_list.clear()
+    except ElementTree.ParseError as e:
+        raise ValueError('Invalid XSPF playlist: {}'.format(e))
+
+
+def resolve_entry(entry, base):
+    '''Returns the path of a playlist entry (a path, or a file URI), or None if it is not a local file'''
+    if entry.startswith(__FILE_URI_PREFIX__):
+        # The host (if any, e.g. localhost) is followed by the path
+        return urllib.parse.unquote(entry[entry.find('/', len(__FILE_URI_PREFIX__)):])
+    if __URI_PATTERN__.match(entry):
+        return None
+    return os.path.normpath(os.path.join(base, entry))
+
+
+def write_m3u(f, tracks):
+    f.write('#EXTM3U\n')
+    for path, meta in tracks:
+        if meta is not None:
+            f.write('#EXTINF:{},{}\n'.format(round(meta.duration) if meta.duration else -1, get_title(path, meta)))
+        f.write(path + '\n')
+
+
+def write_pls(f, tracks):
+    f.write('[playlist]\n')
+    count = 0
+    for path, meta in tracks:
+        count = count + 1
+        f.write('File{}={}\n'.format(count, path))
+        if meta is not None:
+            f.write('Title{}={}\n'.format(count, get_title(path, meta)))
+            f.write('Length{}={}\n'.format(count, round(meta.duration) if meta.duration else -1))
+    # The number of entries is only known once they have all been written, which players accept at the end
+    f.write('NumberOfEntries={}\nVersion=2\n'.format(count))
+
+
+def write_xspf(f, tracks):
+    from xml.sax.saxutils import escape
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n<playlist version="1" xmlns="{}">\n  <trackList>\n'.format(__XSPF_NAMESPACE__))
+    for path, meta in tracks:
+        f.write('    <track>\n      <location>{}</location>\n'.format(escape(get_file_uri(path))))
+        if meta is not None:
+            if meta.title:
+                f.write('      <title>{}</title>\n'.format(escape(meta.title)))
+            if meta.author:
+                f.write('      <creator>{}</creator>\n'.format(escape(meta.author)))
+            if meta.album:
+                f.write('      <album>{}</album>\n'.format(escape(meta.album)))
+            if meta.duration:
+                f.write('      <duration>{}</duration>\n'.format(round(meta.duration * 1000)))
+        f.write('    </track>\n')
+    f.write('  </trackList>\n</playlist>\n')
+
+
+def get_title(path, meta):
+    '''Returns the title of a track as written to M3U and PLS playlists: its artist and title, or its file name'''
+    if not meta.title:
+        return os.path.splitext(os.path.basename(path))[0]
+    if meta.author:
+        return '{} - {}'.format(meta.author, meta.title)
+    return meta.title
+
+
+def get_file_uri(path):
+    '''Returns the file URI of an absolute path'''
+    return __FILE_URI_PREFIX__ + urllib.parse.quote(path)
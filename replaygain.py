@@ -0,0 +1,369 @@
+'''
+ReplayGain of tracks: read from their tags, or otherwise measured as the EBU R128 integrated loudness of the
+decoded track. Measuring requires NumPy, which is optional (and loaded with the backend, see backend.get_numpy).
+'''
+
+import concurrent.futures
+import math
+import os
+import struct
+import threading
+
+import backend
+import dsp
+import library
+import stats
+
+
+# -----------------------------------------
+# Types
+# -----------------------------------------
+
+class ReplayGain(object):
+    '''Gains (in dB) and peaks (linear, 1.0 being full scale) of a track and of its album. Unknown values are None.'''
+    __slots__ = ('track_gain', 'track_peak', 'album_gain', 'album_peak')
+
+    def __init__(self, track_gain = None, track_peak = None, album_gain = None, album_peak = None):
+        self.track_gain = track_gain
+        self.track_peak = track_peak
+        self.album_gain = album_gain
+        self.album_peak = album_peak
+
+    def to_bytes(self):
+        return struct.pack('<4d', *[value if value is not None else math.nan for value in self.get_values()])
+
+    def get_values(self):
+        return [self.track_gain, self.track_peak, self.album_gain, self.album_peak]
+
+    @staticmethod
+    def from_bytes(data):
+        return ReplayGain(*[value if not math.isnan(value) else None for value in struct.unpack('<4d', data)])
+
+
+class LoudnessMeter(object):
+    '''Measures the EBU R128 integrated loudness and the sample peak of a track, as its frames are added.
+
+       Frames are cut into 100 ms segments, which are K-weighted and measured together: the segments of each batch
+       of frames added are transformed with a single FFT, and their mean squares are summed from the weighted
+       spectra. This approximates the time-domain filter of BS.1770, as each segment is filtered on its own.'''
+
+    def __init__(self, audio_format):
+        numpy = backend.get_numpy()
+        self.__channels = audio_format.channels
+        self.__segment = max(1, int(audio_format.sample_rate * __SEGMENT_SECONDS__))
+        self.__weights = get_k_weights(self.__segment, audio_format.sample_rate)
+        self.__powers = []          # Arrays of the mean squares of segments, summed across channels
+        self.__pending = numpy.empty((0, self.__channels), dtype=numpy.float32)     # Frames that do not fill a segment yet
+        self.__peak = 0.0
+
+    def add(self, frames):
+        '''Adds an array of frames (see dsp.read_frames)'''
+        numpy = backend.get_numpy()
+        if len(frames) == 0:
+            return
+        self.__peak = max(self.__peak, float(numpy.abs(frames).max()))
+
+        frames = numpy.concatenate((self.__pending, frames))
+        whole = len(frames) - len(frames) % self.__segment
+        if whole > 0:
+            spectra = numpy.fft.rfft(frames[:whole].reshape(-1, self.__segment, self.__channels), axis=1)
+            self.__powers.append((numpy.abs(spectra) ** 2 * self.__weights[None, :, None]).sum(axis=(1, 2)))
+        self.__pending = frames[whole:]
+
+    def get_replaygain(self):
+        '''Returns the ReplayGain of the frames added, or None if they are too short or quiet to measure'''
+        if len(self.__powers) == 0:
+            return None
+        loudness = get_integrated_loudness(backend.get_numpy().concatenate(self.__powers))
+        if loudness is None:
+            return None
+        return ReplayGain(track_gain = __REFERENCE_LOUDNESS__ - loudness, track_peak = self.__peak)
+
+
+# -----------------------------------------
+# Global constants
+# -----------------------------------------
+
+__CACHE_KIND__ = 'replaygain'
+__TAGS__ = {
+    'REPLAYGAIN_TRACK_GAIN': 'track_gain',
+    'REPLAYGAIN_TRACK_PEAK': 'track_peak',
+    'REPLAYGAIN_ALBUM_GAIN': 'album_gain',
+    'REPLAYGAIN_ALBUM_PEAK': 'album_peak',
+}
+__TAG_READ_BYTES__ = 1 << 20    # Most of an ID3 tag that is read, as large tags are mostly cover art
+
+__REFERENCE_LOUDNESS__ = -18.0  # LUFS that ReplayGain 2.0 brings tracks to
+__SEGMENT_SECONDS__ = 0.1       # Loudness is measured over segments of 100 ms, four of which make a gating block
+__SEGMENTS_PER_BLOCK__ = 4
+__ABSOLUTE_GATE__ = -70.0       # LUFS below which blocks are ignored
+__RELATIVE_GATE__ = -10.0       # LU below the loudness of the blocks above the absolute gate, below which blocks are ignored
+
+# K-weighting filter of ITU-R BS.1770 (a high shelf followed by a high pass), as biquads designed for 48 kHz
+__K_FILTERS__ = [
+    ([1.53512485958697, -2.69169618940638, 1.19839281085285], [1.0, -1.69065929318241, 0.73248077421585]),
+    ([1.0, -2.0, 1.0], [1.0, -1.99004745483398, 0.99007225036621]),
+]
+__K_FILTER_RATE__ = 48000
+
+
+# -----------------------------------------
+# Global variables
+# -----------------------------------------
+
+__lock__ = threading.Lock()
+__gains__ = {}                  # Absolute path -> ReplayGain, or None if the track has no tags and cannot be measured
+__pending__ = set()             # Absolute paths whose gain is being read or measured
+__worker__ = None               # Executor that reads tags and measures tracks off the input thread
+__version__ = 0                 # Incremented whenever the gain of a track becomes available
+
+
+# -----------------------------------------
+# Functions
+# -----------------------------------------
+
+def get_version():
+    return __version__
+
+
+def get_replaygain(path, read_tags_now = False):
+    '''Returns the ReplayGain of the specified file, or None if it is not yet known or cannot be found.
+       Gains are read from the library, or otherwise from the file's tags (or by measuring it) in the background
+       once per file, and become available once get_version() changes. With read_tags_now, the tags are read on the
+       calling thread instead, so that a gain that is tagged is known on return and only measuring is left to the
+       background.'''
+    if path is None:
+        return None
+
+    key = os.path.abspath(path)
+    with __lock__:
+        if key in __gains__:
+            return __gains__[key]
+        if key in __pending__ and not read_tags_now:
+            return None
+
+    try:
+        stat = os.stat(key)
+    except OSError:
+        return None
+
+    data = library.lookup_blob(__CACHE_KIND__, key, stat)
+    if data is not None:
+        gain = ReplayGain.from_bytes(data) if len(data) > 0 else None
+        with __lock__:
+            __gains__[key] = gain
+        return gain
+
+    if read_tags_now:
+        try:
+            gain = read_tags(key)
+        except Exception:
+            gain = None
+        if gain is not None:
+            store_replaygain(key, stat, gain)
+            return gain
+
+    request_replaygain(key, stat)
+    return None
+
+
+def request_replaygain(key, stat):
+    '''Reads or measures the gain of the specified file on the worker thread'''
+    global __worker__
+    with __lock__:
+        if key in __pending__:
+            return
+        __pending__.add(key)
+        if __worker__ is None:
+            __worker__ = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    __worker__.submit(find_replaygain, key, stat)
+
+
+def find_replaygain(key, stat):
+    '''Reads the gain of the specified file from its tags, measuring it if it has none, and stores it in the library'''
+    try:
+        gain = read_tags(key)
+        if gain is None and dsp.is_available():
+            start = stats.start()
+            gain = measure(key)
+            stats.stop('replaygain.measure', start)
+    except Exception:
+        gain = None
+
+    try:
+        store_replaygain(key, stat, gain)
+    finally:
+        with __lock__:
+            __pending__.discard(key)
+
+
+def store_replaygain(key, stat, gain):
+    '''Stores the gain of the specified file (None if it has none), both in memory and in the library'''
+    global __version__
+    try:
+        library.store_blob(__CACHE_KIND__, key, stat, gain.to_bytes() if gain is not None else b'')
+    finally:
+        with __lock__:
+            __gains__[key] = gain
+            __version__ = __version__ + 1
+
+
+def close():
+    '''Stops reading and measuring gains'''
+    global __worker__
+    if __worker__ is not None:
+        __worker__.shutdown(wait=True, cancel_futures=True)
+        __worker__ = None
+
+
+# -----------------------------------------
+# Tags
+# -----------------------------------------
+
+def read_tags(path):
+    '''Returns the ReplayGain stored in the tags of the specified file, or None if it has none.
+       Tags are read from ID3v2 TXXX frames (MP3) and from Vorbis comments (FLAC).'''
+    with open(path, 'rb') as f:
+        header = f.read(10)
+        if header[0:3] == b'ID3':
+            tags = read_id3_tags(header, f)
+        elif header[0:4] == b'fLaC':
+            f.seek(4)
+            tags = read_flac_tags(f)
+        else:
+            return None
+
+    gain = ReplayGain()
+    for name, field in __TAGS__.items():
+        if name in tags:
+            setattr(gain, field, parse_tag_value(tags[name]))
+    if gain.track_gain is None and gain.album_gain is None:
+        return None
+    return gain
+
+
+def read_id3_tags(header, f):
+    '''Returns the user defined text (TXXX) frames of an ID3v2.3 or ID3v2.4 tag, as a dictionary of upper case descriptions to values'''
+    version = header[3]
+    size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+    data = f.read(min(size, __TAG_READ_BYTES__))
+    if version not in (3, 4):
+        return {}
+
+    # Skip the extended header, if any
+    pos = 0
+    if header[5] & 0x40 and len(data) >= 4:
+        pos = decode_syncsafe(data[0:4]) if version == 4 else struct.unpack_from('>I', data)[0] + 4
+
+    tags = {}
+    while pos + 10 <= len(data) and data[pos] != 0:
+        frame_id = data[pos:pos + 4]
+        frame_size = decode_syncsafe(data[pos + 4:pos + 8]) if version == 4 else struct.unpack_from('>I', data, pos + 4)[0]
+        body = data[pos + 10:pos + 10 + frame_size]
+        pos = pos + 10 + frame_size
+        if frame_id == b'TXXX' and len(body) > 1:
+            encoding = {0: 'latin-1', 1: 'utf-16', 2: 'utf-16-be', 3: 'utf-8'}.get(body[0], 'latin-1')
+            # The description and the value are separated by a null character, and each UTF-16 string has its own BOM
+            text = body[1:].decode(encoding, 'replace')
+            if '\0' in text:
+                description, value = text.split('\0', 1)
+                tags[description.upper()] = value.strip('\0\ufeff')
+    return tags
+
+
+def read_flac_tags(f):
+    '''Returns the Vorbis comments of a FLAC file (positioned after its signature), as a dictionary of upper case names to values'''
+    tags = {}
+    last = False
+    while not last:
+        header = f.read(4)
+        if len(header) < 4:
+            break
+        last = header[0] & 0x80 != 0
+        length = int.from_bytes(header[1:4], 'big')
+        if header[0] & 0x7F != 4:           # Not VORBIS_COMMENT
+            f.seek(length, os.SEEK_CUR)
+            continue
+
+        block = f.read(length)
+        pos = 4 + struct.unpack_from('<I', block)[0]
+        count = struct.unpack_from('<I', block, pos)[0]
+        pos = pos + 4
+        for i in range(count):
+            comment_length = struct.unpack_from('<I', block, pos)[0]
+            comment = block[pos + 4:pos + 4 + comment_length].decode('utf-8', 'replace')
+            pos = pos + 4 + comment_length
+            if '=' in comment:
+                name, value = comment.split('=', 1)
+                tags[name.upper()] = value
+        break
+    return tags
+
+
+# -----------------------------------------
+# Measurement
+# -----------------------------------------
+
+def measure(path):
+    '''Decodes the specified file and returns its ReplayGain (see LoudnessMeter), or None if it cannot be measured'''
+    source = backend.get_pyglet().media.load(path, streaming=True)
+    meter = LoudnessMeter(source.audio_format)
+    for frames in dsp.read_frames(source):
+        meter.add(frames)
+    return meter.get_replaygain()
+
+
+def get_integrated_loudness(powers):
+    '''Returns the gated loudness (in LUFS) of a track from the mean squares of its segments, or None if it is silent.
+       Gating blocks are four segments long, overlapping by three.'''
+    if len(powers) < __SEGMENTS_PER_BLOCK__:
+        return None
+    numpy = backend.get_numpy()
+    blocks = numpy.convolve(powers, numpy.full(__SEGMENTS_PER_BLOCK__, 1.0 / __SEGMENTS_PER_BLOCK__), mode='valid')
+
+    blocks = blocks[blocks > get_power(__ABSOLUTE_GATE__)]
+    if len(blocks) == 0:
+        return None
+    blocks = blocks[blocks > blocks.mean() * 10 ** (__RELATIVE_GATE__ / 10)]
+    if len(blocks) == 0:
+        return None
+    return -0.691 + 10 * math.log10(blocks.mean())
+
+
+def get_k_weights(segment, sample_rate):
+    '''Returns the weights of the FFT bins of a segment, which sum its weighted spectrum to the mean square of the
+       K-weighted segment (by Parseval's theorem)'''
+    numpy = backend.get_numpy()
+    freqs = numpy.minimum(numpy.fft.rfftfreq(segment, 1.0 / sample_rate), __K_FILTER_RATE__ / 2)
+    z = numpy.exp(-2j * numpy.pi * freqs / __K_FILTER_RATE__)
+    response = numpy.ones(len(freqs))
+    for b, a in __K_FILTERS__:
+        response = response * numpy.abs((b[0] + b[1] * z + b[2] * z * z) / (a[0] + a[1] * z + a[2] * z * z)) ** 2
+
+    # The bins between the DC and Nyquist bins stand for both positive and negative frequencies
+    counts = numpy.full(len(freqs), 2.0)
+    counts[0] = 1.0
+    if segment % 2 == 0:
+        counts[-1] = 1.0
+    return response * counts / (segment * segment)
+
+
+# -----------------------------------------
+# Helpers
+# -----------------------------------------
+
+def get_power(loudness):
+    '''Returns the mean square that has the specified loudness (in LUFS)'''
+    return 10 ** ((loudness + 0.691) / 10)
+
+
+def decode_syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def parse_tag_value(text):
+    '''Returns the number in a ReplayGain tag (e.g. "-6.48 dB"), or None if it has none'''
+    try:
+        return float(text.strip().split()[0])
+    except (ValueError, IndexError):
+        return None
@@ -0,0 +1,149 @@
+'''
+Scans directories for supported audio files in the background
+'''
+
+import concurrent.futures
+import os
+import queue
+import threading
+
+import audio
+import library
+
+
+# -----------------------------------------
+# Types
+# -----------------------------------------
+
+class Scan(object):
+    '''A scan of a directory (and optionally its subdirectories) running on a pool of worker threads.
+       Files are reported in batches, one batch per directory, which are collected with take_batches().'''
+    def __init__(self, directory, recursive):
+        self.directory = directory
+        self.recursive = recursive
+        self.found = 0
+        self.dirs_scanned = 0
+        self.done = False
+        self.__batches = queue.Queue()
+        self.__cancelled = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+
+    def start(self):
+        self.__thread.start()
+
+    def cancel(self):
+        '''Stops the scan. Directories already being scanned are finished, but their files are discarded.'''
+        self.__cancelled.set()
+
+    def is_cancelled(self):
+        return self.__cancelled.is_set()
+
+    def take_batches(self):
+        '''Returns all batches of files found since the last call'''
+        batches = []
+        while True:
+            try:
+                batches.append(self.__batches.get_nowait())
+            except queue.Empty:
+                return batches
+
+    def __run(self):
+        '''Coordinates the workers, submitting each subdirectory found for scanning until none remain'''
+        stat = os.stat(self.directory)
+        visited = {(stat.st_dev, stat.st_ino)}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=__SCAN_WORKERS__) as executor:
+            pending = {executor.submit(scan_directory, self.directory)}
+            while pending and not self.is_cancelled():
+                completed, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in completed:
+                    try:
+                        files, subdirs = future.result()
+                    except OSError:
+                        continue
+
+                    self.dirs_scanned = self.dirs_scanned + 1
+                    if len(files) > 0:
+                        self.found = self.found + len(files)
+                        self.__batches.put(files)
+
+                    if self.recursive:
+                        for subdir, ident in subdirs:
+                            # Symbolic links may lead back to a directory that has already been scanned
+                            if ident not in visited:
+                                visited.add(ident)
+                                pending.add(executor.submit(scan_directory, subdir))
+
+            for future in pending:
+                future.cancel()
+        self.done = True
+
+
+# -----------------------------------------
+# Global constants
+# -----------------------------------------
+
+__SCAN_WORKERS__ = 8
+
+
+# -----------------------------------------
+# Global variables
+# -----------------------------------------
+
+__scans__ = []
+
+
+# -----------------------------------------
+# Functions
+# -----------------------------------------
+
+def start_scan(directory, recursive):
+    '''Starts scanning the specified directory for supported audio files in the background'''
+    scan = Scan(directory, recursive)
+    __scans__.append(scan)
+    scan.start()
+    return scan
+
+
+def get_scans():
+    '''Returns the scans that are running or have batches that have not been collected'''
+    return __scans__
+
+
+def is_scanning():
+    return len(__scans__) > 0
+
+
+def finish_scan(scan):
+    '''Forgets a scan that is done and has had all of its batches collected'''
+    if scan in __scans__:
+        __scans__.remove(scan)
+
+
+def cancel_all():
+    '''Cancels all scans'''
+    for scan in __scans__:
+        scan.cancel()
+    __scans__.clear()
+
+
+def scan_directory(directory):
+    '''Lists a single directory, returning the supported audio files it contains (sorted by name) and its subdirectories.
+       Runs on a worker thread. File stats are taken here, and used to look up the files in the library.'''
+    files = []
+    subdirs = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    stat = entry.stat()
+                    subdirs.append((entry.path, (stat.st_dev, stat.st_ino)))
+                elif audio.is_supported_format(entry.name) and entry.is_file():
+                    # Files in the working directory are added by name, as they would be when added individually
+                    path = entry.name if directory == os.curdir else entry.path
+                    library.prime(path, entry.stat())
+                    files.append(path)
+            except OSError:
+                pass
+
+    files.sort()
+    return files, subdirs
@@ -0,0 +1,114 @@
+'''
+Index of the words in the playlist's tracks, for searching the playlist as a query is typed
+'''
+
+import bisect
+import os
+import re
+
+
+# -----------------------------------------
+# Global constants
+# -----------------------------------------
+
+__WORD_PATTERN__ = re.compile(r'\w+')
+__PATH_DEPTH__ = 3              # Number of path components indexed: the file name and the directories of the album and artist
+__TAG_FIELDS__ = ['title', 'author', 'album']
+
+
+# -----------------------------------------
+# Types
+# -----------------------------------------
+
+class SearchIndex(object):
+    '''Maps each word of the tracks' paths and tags to the ids of the tracks containing it.
+       A query matches the tracks that contain, for each word of the query, a word starting with it. The words of
+       the index are kept sorted, so the words starting with a query word are found by binary search.
+       The matches of each query word are cached until the index changes, so as a query is typed only its last word
+       is looked up again. The first letter of a word would match most of a large playlist, so the matches of each
+       letter are kept up to date as tracks are added and removed, rather than looked up.'''
+
+    def __init__(self):
+        self.__postings = {}        # Word -> set of the ids of the tracks containing it
+        self.__words = []           # The words of the index, sorted. Words no longer in any track are skipped over.
+        self.__cache = {}           # Query word -> set of matching track ids
+        self.__initials = {}        # First character -> set of the ids of the tracks containing a word starting with it
+
+    def add(self, tracks):
+        '''Adds the words of the specified (track id, text) pairs'''
+        new_words = []
+        for track_id, text in tracks:
+            for word in get_words(text):
+                posting = self.__postings.get(word)
+                if posting is None:
+                    posting = self.__postings[word] = set()
+                    if not self.__has_word(word):
+                        new_words.append(word)
+                    if word[0] not in self.__initials:
+                        self.__initials[word[0]] = set()
+                posting.add(track_id)
+                self.__initials[word[0]].add(track_id)
+
+        if len(new_words) > 0:
+            # Sorting a sorted list with a run appended is linear, so batches of new words are merged cheaply
+            new_words.sort()
+            self.__words.extend(new_words)
+            self.__words.sort()
+        self.__cache.clear()
+
+    def remove(self, tracks):
+        '''Removes the words of the specified (track id, text) pairs. The text must hold all the words indexed for the track.'''
+        for track_id, text in tracks:
+            for word in get_words(text):
+                posting = self.__postings.get(word)
+                if posting is not None:
+                    posting.discard(track_id)
+                    if len(posting) == 0:
+                        del self.__postings[word]
+                    self.__initials[word[0]].discard(track_id)
+        self.__cache.clear()
+
+    def search(self, query):
+        '''Returns the set of ids of the tracks matching the query (which must not be modified), or None if the query has no words'''
+        matches = None
+        # The rarest words are intersected first, so the intermediate sets stay small
+        for posting in sorted((self.__match_word(word) for word in get_words(query)), key=len):
+            matches = posting if matches is None else matches & posting
+            if len(matches) == 0:
+                break
+        return matches
+
+    def __has_word(self, word):
+        i = bisect.bisect_left(self.__words, word)
+        return i < len(self.__words) and self.__words[i] == word
+
+    def __match_word(self, word):
+        '''Returns the ids of the tracks containing a word starting with the specified word'''
+        if len(word) == 1:
+            return self.__initials.get(word, set())
+        matches = self.__cache.get(word)
+        if matches is None:
+            start = bisect.bisect_left(self.__words, word)
+            end = bisect.bisect_left(self.__words, word[:-1] + chr(ord(word[-1]) + 1))
+            postings = [self.__postings[w] for w in self.__words[start:end] if w in self.__postings]
+            matches = set().union(*postings) if len(postings) != 1 else postings[0]
+            self.__cache[word] = matches
+        return matches
+
+
+# -----------------------------------------
+# Functions
+# -----------------------------------------
+
+def get_words(text):
+    '''Returns the distinct lower case words of a text'''
+    return set(__WORD_PATTERN__.findall(text.lower()))
+
+
+def get_track_text(path, meta = None):
+    '''Returns the searchable text of a track: the last components of its path (without the file extension), and its
+       tags if its metadata is known'''
+    parts = os.path.splitext(path)[0].rsplit(os.sep, __PATH_DEPTH__)[-__PATH_DEPTH__:]
+    if meta is not None:
+        parts = parts + [getattr(meta, field) or '' for field in __TAG_FIELDS__]
+    return ' '.join(parts)
@@ -0,0 +1,128 @@
+'''
+Headless mode: runs the audio engine without the terminal UI, controlled over a Unix domain socket
+'''
+
+import asyncio
+import os
+import socket
+
+import commands
+import input_listener
+import library
+
+
+# -----------------------------------------
+# Global constants
+# -----------------------------------------
+
+__SOCKET_NAME__ = 'argon.sock'
+__ENCODING__ = 'utf-8'
+__OK__ = 'OK'
+
+
+# -----------------------------------------
+# Functions
+# -----------------------------------------
+
+def get_default_socket_path():
+    '''Returns the path of the control socket when none is specified'''
+    return os.path.join(library.get_data_dir(), __SOCKET_NAME__)
+
+
+def serve(path = None):
+    '''Runs the audio engine headless, accepting commands on the control socket until a client sends quit.
+       Each line received is processed as a command (the same commands as the command line), and answered with
+       one line per message followed by an empty line.'''
+    asyncio.run(run_server(path or get_default_socket_path()))
+
+
+async def run_server(path):
+    '''Serves clients, and services the audio engine, until a client sends quit'''
+    remove_stale_socket(path)
+    stop_event = asyncio.Event()
+    wake_event = asyncio.Event()
+
+    server = await asyncio.start_unix_server(lambda reader, writer: handle_client(reader, writer, stop_event, wake_event), path=path)
+    os.chmod(path, 0o600)
+    try:
+        async with server:
+            await run_engine(stop_event, wake_event)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+async def run_engine(stop_event, wake_event):
+    '''Dispatches audio events and collects directory scans, sleeping until they next need servicing or a command has been processed'''
+    while not stop_event.is_set():
+        wake_event.clear()
+        # Commands run on a worker thread (see commands), so the engine holds the state lock while it uses the state
+        with commands.get_lock():
+            input_listener.service_events()
+            timeout = input_listener.limit_timeout(input_listener.get_tick_interval())
+        try:
+            await asyncio.wait_for(wake_event.wait(), max(0, timeout))
+        except asyncio.TimeoutError:
+            pass
+
+
+async def handle_client(reader, writer, stop_event, wake_event):
+    '''Processes the commands sent by a client. Commands run on the worker (see commands), in the order they are
+       received from all clients, and each is answered once it is done. The answer ends with the command's progress,
+       if it has any (e.g. a scan that it started).'''
+    try:
+        while not stop_event.is_set():
+            line = await reader.readline()
+            if not line:
+                break
+
+            command = input_listener.submit_command(line.decode(__ENCODING__, 'replace'))
+            try:
+                await asyncio.wrap_future(command.future)
+            except Exception:
+                # Reported below
+                pass
+            messages = command.take_messages()
+            quit_app = input_listener.get_command_result(command, messages.append)
+            status_set, status = command.take_status()
+            if status_set and status is not None:
+                messages.append(status)
+
+            # The command may have started work (e.g. a load or a scan) that the engine must now service
+            wake_event.set()
+            if quit_app:
+                stop_event.set()
+
+            writer.write(('\n'.join(messages or [__OK__]) + '\n\n').encode(__ENCODING__))
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def send(command, path = None):
+    '''Sends a command to a headless player, returning its response'''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path or get_default_socket_path())
+        client.sendall((command + '\n').encode(__ENCODING__))
+        response = b''
+        while not response.endswith(b'\n\n'):
+            data = client.recv(4096)
+            if not data:
+                break
+            response = response + data
+    return response.decode(__ENCODING__).strip('\n')
+
+
+def remove_stale_socket(path):
+    '''Removes a socket left behind by a player that did not exit cleanly. Raises an error if another player is still serving on it.'''
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(path)
+            return
+    raise RuntimeError('A player is already running on {}'.format(path))
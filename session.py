@@ -0,0 +1,274 @@
+'''
+Persistence of the session (the playlist, current track, playback position, main panel mode and volume) across runs.
+The session is saved as a binary snapshot, and the playlist edits made since are appended to a journal, so saving
+does not rewrite the whole playlist after every edit. On startup the journal is replayed onto the snapshot.
+The snapshot stores the playlist in the columns it is kept in (see playlist.Playlist), so it is restored without
+splitting each track's path again.
+'''
+
+import array
+import os
+import struct
+import sys
+
+import library
+
+
+# -----------------------------------------
+# Types
+# -----------------------------------------
+
+class SessionState(object):
+    '''The state of a session, other than its playlist. Enumerations are stored by value, and a playback of 0 means
+       that no session was saved.'''
+    __slots__ = ('current', 'position', 'playback', 'mode', 'volume', 'replaygain')
+
+    def __init__(self, current = -1, position = 0.0, playback = 0, mode = 0, volume = 0, replaygain = 0):
+        self.current = current          # Index of the current track, or -1 if there is none
+        self.position = position        # Seconds into the current track
+        self.playback = playback
+        self.mode = mode
+        self.volume = volume
+        self.replaygain = replaygain
+
+    def pack(self):
+        return __STATE_FORMAT__.pack(self.current, self.position, self.playback, self.mode, self.volume, self.replaygain)
+
+    def unpack(self, data):
+        self.current, self.position, self.playback, self.mode, self.volume, self.replaygain = __STATE_FORMAT__.unpack(data)
+
+
+# -----------------------------------------
+# Global constants
+# -----------------------------------------
+
+__SNAPSHOT_NAME__ = 'session.bin'
+__JOURNAL_NAME__ = 'session.journal'
+__SNAPSHOT_MAGIC__ = b'ARGNSES1'
+__JOURNAL_MAGIC__ = b'ARGNJRN1'
+__HEADER_FORMAT__ = struct.Struct('<Q')             # Generation, shared by a snapshot and the journal of edits made after it
+__STATE_FORMAT__ = struct.Struct('<idBBBB')         # See SessionState.pack
+__COUNT_FORMAT__ = struct.Struct('<QQQQ')           # Number of directories and of tracks, and the lengths in bytes of their names
+__DIR_INDEX_TYPE__ = 'I'        # Type (see array) of the index of each track's directory
+__RECORD_FORMAT__ = struct.Struct('<BI')            # Journal record type, and its length in bytes
+__INDEX_FORMAT__ = 'I'
+__COMPACT_SIZE__ = 1 << 20      # Size of the journal (in bytes) beyond which a new snapshot is taken
+
+# Journal records
+__ADD__ = 1                     # Paths appended to the playlist
+__REMOVE__ = 2                  # Indices removed from the playlist
+__MOVE__ = 3                    # A track moved from one index to another
+__CLEAR__ = 4                   # The playlist cleared
+__STATE__ = 5                   # The state of the session (see SessionState.pack)
+
+
+# -----------------------------------------
+# Global variables
+# -----------------------------------------
+
+__journal__ = None              # Journal file, while the session is open
+__generation__ = 0
+__last_state__ = None           # The state last recorded, so that unchanged states are not recorded again
+
+
+# -----------------------------------------
+# Functions
+# -----------------------------------------
+
+def is_open():
+    return __journal__ is not None
+
+
+def load(tracks):
+    '''Opens the session saved by the last run, restoring its playlist into tracks (an empty playlist.Playlist) and
+       returning its state. Edits are journaled from then on. A journal cut short (e.g. by a crash) is replayed up to
+       its last whole record.'''
+    global __journal__, __generation__, __last_state__
+    state = SessionState()
+    __generation__ = 0
+    try:
+        with open(get_path(__SNAPSHOT_NAME__), 'rb') as f:
+            __generation__ = read_snapshot(f.read(), state, tracks)
+    except (OSError, ValueError, struct.error):
+        state = SessionState()
+        tracks.clear()
+        __generation__ = 0
+
+    journal_path = get_path(__JOURNAL_NAME__)
+    end = 0
+    try:
+        with open(journal_path, 'rb') as f:
+            end = replay_journal(f.read(), state, tracks)
+    except OSError:
+        pass
+
+    if end > 0:
+        os.truncate(journal_path, end)
+        __journal__ = open(journal_path, 'ab')
+    else:
+        start_journal()
+    __last_state__ = state.pack()
+    return state
+
+
+def save(state, tracks):
+    '''Saves the whole session (its state, and its playlist tracks) as a new snapshot, and starts a new journal.
+       The snapshot is written to a temporary file that replaces the last snapshot only once it is complete, so a
+       session is never left half written.'''
+    global __generation__, __last_state__
+    dirs, dir_indices, names = tracks.get_columns()
+    dir_count, dirs, names = len(dirs), encode_names(dirs), encode_names(names)
+    snapshot_path = get_path(__SNAPSHOT_NAME__)
+    temp_path = snapshot_path + '.tmp'
+    os.makedirs(library.get_data_dir(), exist_ok=True)
+    with open(temp_path, 'wb') as f:
+        f.write(__SNAPSHOT_MAGIC__ + __HEADER_FORMAT__.pack(__generation__ + 1) + state.pack())
+        f.write(__COUNT_FORMAT__.pack(dir_count, len(dir_indices), len(dirs), len(names)))
+        f.write(dirs)
+        f.write(array.array(__DIR_INDEX_TYPE__, dir_indices).tobytes())
+        f.write(names)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, snapshot_path)
+
+    # Until the journal is restarted it belongs to the previous generation, so it is ignored if we stop here
+    __generation__ = __generation__ + 1
+    start_journal()
+    __last_state__ = state.pack()
+
+
+def needs_snapshot():
+    '''Returns whether the journal has grown enough that a new snapshot should be saved'''
+    return __journal__ is not None and __journal__.tell() > __COMPACT_SIZE__
+
+
+def record_add(paths):
+    if __journal__ is not None and len(paths) > 0:
+        append_record(__ADD__, encode_names(paths))
+
+
+def record_remove(indices):
+    if __journal__ is not None and len(indices) > 0:
+        append_record(__REMOVE__, struct.pack('<{}{}'.format(len(indices), __INDEX_FORMAT__), *indices))
+
+
+def record_move(src, dst):
+    if __journal__ is not None:
+        append_record(__MOVE__, struct.pack('<2' + __INDEX_FORMAT__, src, dst))
+
+
+def record_clear():
+    if __journal__ is not None:
+        append_record(__CLEAR__, b'')
+
+
+def record_state(state):
+    '''Records the state of the session, unless it is unchanged since it was last recorded'''
+    global __last_state__
+    data = state.pack()
+    if __journal__ is not None and data != __last_state__:
+        append_record(__STATE__, data)
+        __last_state__ = data
+
+
+def close():
+    global __journal__
+    if __journal__ is not None:
+        __journal__.close()
+        __journal__ = None
+
+
+# -----------------------------------------
+# Helpers
+# -----------------------------------------
+
+def get_path(name):
+    return os.path.join(library.get_data_dir(), name)
+
+
+def start_journal():
+    '''Starts an empty journal for the current generation'''
+    global __journal__
+    close()
+    os.makedirs(library.get_data_dir(), exist_ok=True)
+    __journal__ = open(get_path(__JOURNAL_NAME__), 'wb')
+    __journal__.write(__JOURNAL_MAGIC__ + __HEADER_FORMAT__.pack(__generation__))
+    __journal__.flush()
+
+
+def append_record(record_type, data):
+    __journal__.write(__RECORD_FORMAT__.pack(record_type, len(data)) + data)
+    __journal__.flush()
+
+
+def read_snapshot(data, state, tracks):
+    '''Reads a snapshot into the state and the playlist, returning its generation. Raises ValueError if it is not a
+       whole snapshot.'''
+    if data[:len(__SNAPSHOT_MAGIC__)] != __SNAPSHOT_MAGIC__:
+        raise ValueError('Not a session snapshot')
+    offset = len(__SNAPSHOT_MAGIC__)
+    generation, = __HEADER_FORMAT__.unpack_from(data, offset)
+    offset = offset + __HEADER_FORMAT__.size
+    state.unpack(data[offset:offset + __STATE_FORMAT__.size])
+    offset = offset + __STATE_FORMAT__.size
+    dir_count, track_count, dirs_length, names_length = __COUNT_FORMAT__.unpack_from(data, offset)
+    offset = offset + __COUNT_FORMAT__.size
+
+    dirs = decode_names(data[offset:offset + dirs_length], dir_count)
+    offset = offset + dirs_length
+    dir_indices = array.array(__DIR_INDEX_TYPE__)
+    dir_indices.frombytes(data[offset:offset + track_count * dir_indices.itemsize])
+    offset = offset + track_count * dir_indices.itemsize
+    names = decode_names(data[offset:offset + names_length], track_count)
+    offset = offset + names_length
+    if offset != len(data) or len(dirs) != dir_count or len(dir_indices) != track_count or len(names) != track_count:
+        raise ValueError('Truncated session snapshot')
+    if track_count > 0 and max(dir_indices) >= dir_count:
+        raise ValueError('Invalid session snapshot')
+
+    tracks.extend_columns(dirs, array.array('L', dir_indices), names)
+    return generation
+
+
+def replay_journal(data, state, tracks):
+    '''Replays the records of a journal onto the state and the playlist, returning the offset of the end of its last
+       whole record. Returns 0 if the journal does not follow the loaded snapshot.'''
+    header = __JOURNAL_MAGIC__ + __HEADER_FORMAT__.pack(__generation__)
+    if data[:len(header)] != header:
+        return 0
+
+    offset = len(header)
+    while offset + __RECORD_FORMAT__.size <= len(data):
+        record_type, length = __RECORD_FORMAT__.unpack_from(data, offset)
+        start = offset + __RECORD_FORMAT__.size
+        if start + length > len(data):
+            break
+        record = data[start:start + length]
+
+        if record_type == __ADD__:
+            tracks.extend(decode_names(record))
+        elif record_type == __REMOVE__:
+            indices = set(struct.unpack('<{}{}'.format(length // struct.calcsize(__INDEX_FORMAT__), __INDEX_FORMAT__), record))
+            tracks.remove_indices([index for index in indices if index < len(tracks)])
+        elif record_type == __MOVE__:
+            src, dst = struct.unpack('<2' + __INDEX_FORMAT__, record)
+            if src < len(tracks):
+                tracks.move(src, dst)
+        elif record_type == __CLEAR__:
+            tracks.clear()
+        elif record_type == __STATE__:
+            state.unpack(record)
+        offset = start + length
+    return offset
+
+
+def encode_names(names):
+    '''Encodes paths (or parts of them) joined by NUL characters, which cannot occur in them'''
+    return '\0'.join(names).encode(sys.getfilesystemencoding(), 'surrogateescape')
+
+
+def decode_names(data, count = None):
+    '''Decodes the names encoded by encode_names. An empty name cannot be told from none, so their count is given if it is known.'''
+    if count == 0:
+        return []
+    return data.decode(sys.getfilesystemencoding(), 'surrogateescape').split('\0')
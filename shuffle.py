@@ -0,0 +1,137 @@
+'''
+Shuffled play order of the playlist. The order is drawn a track at a time by a Fisher-Yates shuffle of the
+playlist's track ids, so shuffling is O(1) whatever the size of the playlist, and every track is played once before
+any is repeated.
+'''
+
+import random
+
+
+# -----------------------------------------
+# Types
+# -----------------------------------------
+
+class ShuffleOrder(object):
+    '''The shuffled order of a playlist.Playlist, followed through its edits.
+
+       The tracks not yet drawn are the positions from drawn to the end of a virtual array of the playlist's ids.
+       The ids of a playlist are consecutive, so a position holds the id first id + position until a draw swaps it,
+       and only swapped positions are stored. Tracks added to the playlist extend the array, and so join the tracks
+       still to be drawn without any work; removed tracks are dropped when they are drawn. Clearing the playlist
+       starts a new order.
+
+       Drawn tracks are appended to the order, which is also the history that the previous track is taken from.'''
+
+    def __init__(self, tracks):
+        self.__tracks = tracks
+        self.__random = random.Random()
+        self.__first_id = None      # Id at position 0 of the virtual array
+        self.__slots = {}           # Position -> id, for the positions whose id was swapped
+        self.__slot_of = {}         # Id -> position, for the ids that were swapped
+        self.__drawn = 0            # Number of positions drawn in this round
+        self.__order = []           # Ids in the order they were drawn, across rounds
+        self.__cursor = -1          # Index in __order of the current track
+        self.__sync()
+
+    def select(self, track_id):
+        '''Makes a track the current track of the order. A track that has not been drawn yet is drawn now, to be
+           followed by those drawn already. A track that has been drawn is found in the order, which then continues
+           from there.'''
+        self.__sync()
+        if self.__is_at(self.__cursor, track_id):
+            return
+        if self.__is_at(self.__cursor + 1, track_id):
+            self.__cursor = self.__cursor + 1
+            return
+
+        position = self.__slot_of.get(track_id, track_id - self.__first_id)
+        if self.__drawn <= position < self.__get_size():
+            self.__swap(position, self.__drawn)
+            self.__drawn = self.__drawn + 1
+            self.__cursor = self.__cursor + 1
+            self.__order.insert(self.__cursor, track_id)
+            return
+
+        for index in range(len(self.__order) - 1, -1, -1):
+            if self.__order[index] == track_id:
+                self.__cursor = index
+                return
+
+    def get_following(self, count, wrap):
+        '''Returns the ids of up to count tracks that follow the current track, drawing them as needed. Once every
+           track has been drawn a new round is shuffled if wrap is set, and otherwise the order ends.'''
+        self.__sync()
+        following = []
+        index = self.__cursor + 1
+        new_round = False
+        while len(following) < count:
+            if index < len(self.__order):
+                track_id = self.__order[index]
+                if self.__tracks.has_id(track_id):
+                    following.append(track_id)
+                    new_round = False
+                index = index + 1
+            elif self.__draw() is None:
+                # A round that draws nothing means the playlist is empty
+                if not wrap or new_round:
+                    break
+                self.__start_round()
+                new_round = True
+        return following
+
+    def get_previous(self):
+        '''Returns the id of the track played before the current track, or None if there is none'''
+        self.__sync()
+        for index in range(self.__cursor - 1, -1, -1):
+            if self.__tracks.has_id(self.__order[index]):
+                self.__cursor = index
+                return self.__order[index]
+        return None
+
+    def __sync(self):
+        '''Starts a new order if the playlist was cleared (its ids then start after those it had)'''
+        first_id = self.__tracks.get_id_range()[0]
+        if first_id != self.__first_id:
+            self.__first_id = first_id
+            self.__order = []
+            self.__cursor = -1
+            self.__start_round()
+
+    def __start_round(self):
+        self.__slots.clear()
+        self.__slot_of.clear()
+        self.__drawn = 0
+
+    def __get_size(self):
+        return self.__tracks.get_id_range()[1] - self.__first_id
+
+    def __draw(self):
+        '''Draws a random track that has not been drawn in this round, appending it to the order. Returns its id, or
+           None once every track has been drawn.'''
+        size = self.__get_size()
+        while self.__drawn < size:
+            position = self.__random.randrange(self.__drawn, size)
+            track_id = self.__slots.get(position, self.__first_id + position)
+            self.__swap(position, self.__drawn)
+            self.__drawn = self.__drawn + 1
+            if self.__tracks.has_id(track_id):
+                self.__order.append(track_id)
+                return track_id
+        return None
+
+    def __swap(self, a, b):
+        id_a = self.__slots.get(a, self.__first_id + a)
+        id_b = self.__slots.get(b, self.__first_id + b)
+        self.__place(a, id_b)
+        self.__place(b, id_a)
+
+    def __place(self, position, track_id):
+        if track_id == self.__first_id + position:
+            self.__slots.pop(position, None)
+            self.__slot_of.pop(track_id, None)
+        else:
+            self.__slots[position] = track_id
+            self.__slot_of[track_id] = position
+
+    def __is_at(self, index, track_id):
+        return 0 <= index < len(self.__order) and self.__order[index] == track_id
@@ -0,0 +1,247 @@
+'''
+Players that write decoded audio to a sink rather than to a sound device: a WAV file, or nowhere at all. They play
+as fast as their sources can be decoded, so they need no sound device and run faster than real time, for rendering
+playlists to files and for measuring throughput. They mirror the parts of pyglet's Player that the player uses.
+All players write to the same sink, which is opened by open_sink(), so that what is played in a session is rendered
+to one file.
+'''
+
+import collections
+import os
+import threading
+import wave
+
+import stats
+
+
+# -----------------------------------------
+# Types
+# -----------------------------------------
+
+class NullSink(object):
+    '''Discards the audio written to it. Its volume is not applied, other than by the DSP stage (see dsp).'''
+    def write(self, data, audio_format):
+        pass
+
+    def close(self):
+        pass
+
+
+class WavSink(object):
+    '''Writes the audio written to it to a WAV file. A WAV file holds a single format, so whenever the format changes
+       (e.g. between tracks of different sample rates) the audio continues in a new file, numbered after the first.'''
+    def __init__(self, path):
+        self.path = path
+        self.__file = None
+        self.__format = None
+        self.__files = 0
+
+    def write(self, data, audio_format):
+        audio_format = (audio_format.channels, audio_format.sample_size, audio_format.sample_rate)
+        if audio_format != self.__format:
+            self.close()
+            self.__open(audio_format)
+        self.__file.writeframesraw(data)
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def __open(self, audio_format):
+        base, ext = os.path.splitext(self.path)
+        path = self.path if self.__files == 0 else '{}.{}{}'.format(base, self.__files, ext)
+        self.__files = self.__files + 1
+        self.__format = audio_format
+        self.__file = wave.open(path, 'wb')
+        channels, sample_size, sample_rate = audio_format
+        self.__file.setnchannels(channels)
+        self.__file.setsampwidth(sample_size // 8)
+        self.__file.setframerate(sample_rate)
+
+
+class SinkPlayer(object):
+    '''Plays queued sources into a sink on its own thread. Like pyglet's Player, it moves on to the next queued source
+       when one finishes, and reports the end of each source with an on_eos event. Events are delivered on the
+       thread that calls dispatch_events().'''
+
+    def __init__(self):
+        self.volume = 1.0           # Only applied by the DSP stage (see dsp)
+        self.__sources = collections.deque()
+        self.__handlers = {}
+        self.__playing = False
+        self.__deleted = False
+        self.__time = 0.0
+        self.__condition = threading.Condition()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+        __players__.append(self)
+
+    @property
+    def source(self):
+        with self.__condition:
+            return self.__sources[0] if len(self.__sources) > 0 else None
+
+    @property
+    def time(self):
+        return self.__time
+
+    @property
+    def playing(self):
+        return self.__playing
+
+    def push_handlers(self, **handlers):
+        self.__handlers.update(handlers)
+
+    def queue(self, source):
+        with self.__condition:
+            self.__sources.append(source)
+            self.__condition.notify_all()
+
+    def play(self):
+        with self.__condition:
+            self.__playing = True
+            self.__condition.notify_all()
+
+    def pause(self):
+        with self.__condition:
+            self.__playing = False
+
+    def seek(self, timestamp):
+        with self.__condition:
+            if len(self.__sources) > 0:
+                self.__sources[0].seek(timestamp)
+            self.__time = timestamp
+
+    def next_source(self):
+        '''Skips to the next queued source'''
+        with self.__condition:
+            if len(self.__sources) > 0:
+                self.__sources.popleft()
+            self.__time = 0.0
+
+    def delete(self):
+        '''Stops the player'''
+        with self.__condition:
+            self.__deleted = True
+            self.__sources.clear()
+            self.__condition.notify_all()
+        if self in __players__:
+            __players__.remove(self)
+
+    def __run(self):
+        '''Player thread: writes the audio of the current source to the sink while playing'''
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: self.__deleted or (self.__playing and len(self.__sources) > 0))
+                if self.__deleted:
+                    break
+                source = self.__sources[0]
+
+            start = stats.start()
+            data = read_audio_data(source, __READ_BYTES__)
+            with self.__condition:
+                # The source may have been skipped or sought while it was being read
+                if len(self.__sources) == 0 or self.__sources[0] is not source or self.__deleted:
+                    continue
+                if data is None:
+                    self.__sources.popleft()
+                    self.__time = 0.0
+                    post_event(self.__handlers.get('on_eos'))
+                    continue
+                self.__time = data.timestamp + data.duration
+
+            write(data.data[:data.length], source.audio_format)
+            stats.stop('sink.write', start)
+
+
+# -----------------------------------------
+# Global constants
+# -----------------------------------------
+
+__READ_BYTES__ = 65536          # Bytes of audio requested from the current source at a time
+__EVENT_POLL_INTERVAL__ = 0.02  # Seconds between checks for events while a player is playing
+
+
+# -----------------------------------------
+# Global variables
+# -----------------------------------------
+
+__lock__ = threading.Lock()     # Guards the sink and the events
+__sink__ = None
+__events__ = []                 # Handlers posted by player threads, to be called by dispatch_events()
+__players__ = []                # Players that have not been deleted
+
+
+# -----------------------------------------
+# Functions
+# -----------------------------------------
+
+def open_sink(kind, path = None):
+    '''Opens the sink that players write to: 'wav' (writing to the file at path) or 'null'. The file is created once
+       audio is first written.'''
+    global __sink__
+    close()
+    with __lock__:
+        __sink__ = WavSink(path) if kind == 'wav' else NullSink()
+
+
+def create_player():
+    '''Returns a new player writing to the sink'''
+    return SinkPlayer()
+
+
+def write(data, audio_format):
+    with __lock__:
+        if __sink__ is not None:
+            __sink__.write(data, audio_format)
+
+
+def close():
+    '''Stops all players, and closes the sink'''
+    global __sink__
+    for player in list(__players__):
+        player.delete()
+    with __lock__:
+        if __sink__ is not None:
+            __sink__.close()
+            __sink__ = None
+
+
+def dispatch_events():
+    '''Calls the event handlers posted by the players' threads'''
+    with __lock__:
+        events = list(__events__)
+        __events__.clear()
+    for handler in events:
+        handler()
+
+
+def get_event_timeout():
+    '''Returns the time (in seconds) until events should next be checked for, or None if no player is playing'''
+    if len(__events__) > 0:
+        return 0.0
+    for player in __players__:
+        if player.playing:
+            return __EVENT_POLL_INTERVAL__
+    return None
+
+
+# -----------------------------------------
+# Helpers
+# -----------------------------------------
+
+def post_event(handler):
+    if handler is not None:
+        with __lock__:
+            __events__.append(handler)
+
+
+def read_audio_data(source, num_bytes):
+    '''Reads the next audio of a source. Buffered sources are waited on rather than padded with silence when their
+       decoder falls behind, as a sink never waits for audio.'''
+    if hasattr(source, 'read_audio_data'):
+        return source.read_audio_data(num_bytes)
+    if hasattr(source, 'get_audio_data'):
+        return source.get_audio_data(num_bytes)
+    return source._get_audio_data(num_bytes)
@@ -0,0 +1,152 @@
+'''
+Timings and counters of the player's hot paths. Recording is disabled unless the player is started with -stats,
+in which case the statistics are shown in the stats view and written to a file on exit.
+'''
+
+import json
+import os
+import threading
+import time
+
+import library
+
+
+# -----------------------------------------
+# Types
+# -----------------------------------------
+
+class Timing(object):
+    '''Running statistics of the durations (in seconds) of an operation'''
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, seconds):
+        self.count = self.count + 1
+        self.total = self.total + seconds
+        self.max = max(self.max, seconds)
+        self.last = seconds
+
+    def get_mean(self):
+        return self.total / self.count if self.count > 0 else 0.0
+
+    def to_dict(self):
+        return {'count': self.count, 'total': self.total, 'mean': self.get_mean(), 'max': self.max, 'last': self.last}
+
+
+# -----------------------------------------
+# Global constants
+# -----------------------------------------
+
+__DEFAULT_FILE_NAME__ = 'stats.json'
+__TIMING_FORMAT__ = '{:<24} {:>8} {:>10.3f} {:>10.3f} {:>10.3f}'
+__TIMING_HEADER__ = '{:<24} {:>8} {:>10} {:>10} {:>10}'.format('Timing', 'Count', 'Mean ms', 'Max ms', 'Last ms')
+__COUNTER_FORMAT__ = '{:<24} {:>8}'
+__COUNTER_HEADER__ = __COUNTER_FORMAT__.format('Counter', 'Count')
+__DISABLED_TEXT__ = 'Statistics are not being recorded. Start the player with -stats to record them.'
+
+
+# -----------------------------------------
+# Global variables
+# -----------------------------------------
+
+__enabled__ = False
+__lock__ = threading.Lock()     # Statistics are also recorded by the loader and decoder threads
+__timings__ = {}                # Name -> Timing
+__counters__ = {}               # Name -> count
+__version__ = 0                 # Incremented whenever a statistic is recorded
+
+
+# -----------------------------------------
+# Functions
+# -----------------------------------------
+
+def enable():
+    '''Starts recording statistics'''
+    global __enabled__
+    __enabled__ = True
+
+
+def is_enabled():
+    return __enabled__
+
+
+def get_version():
+    return __version__
+
+
+def get_default_path():
+    '''Returns the file the statistics are written to when none is specified'''
+    return os.path.join(library.get_data_dir(), __DEFAULT_FILE_NAME__)
+
+
+def start():
+    '''Returns the start time of an operation to be timed, or None if recording is disabled.
+       Pass the result to stop() once the operation has finished.'''
+    if not __enabled__:
+        return None
+    return time.perf_counter()
+
+
+def stop(name, start_time):
+    '''Records the duration of an operation started with start()'''
+    if start_time is not None:
+        record(name, time.perf_counter() - start_time)
+
+
+def record(name, seconds):
+    '''Records a duration (in seconds) of the named operation'''
+    global __version__
+    if not __enabled__:
+        return
+    with __lock__:
+        timing = __timings__.get(name)
+        if timing is None:
+            timing = __timings__[name] = Timing()
+        timing.add(seconds)
+        __version__ = __version__ + 1
+
+
+def count(name, amount = 1):
+    '''Adds to the named counter'''
+    global __version__
+    if not __enabled__:
+        return
+    with __lock__:
+        __counters__[name] = __counters__.get(name, 0) + amount
+        __version__ = __version__ + 1
+
+
+def get_lines():
+    '''Returns the statistics as lines of text, sorted by name'''
+    if not __enabled__:
+        return [__DISABLED_TEXT__]
+    with __lock__:
+        timings = sorted((name, timing.count, timing.get_mean(), timing.max, timing.last) for name, timing in __timings__.items())
+        counters = sorted(__counters__.items())
+
+    lines = [__TIMING_HEADER__]
+    for name, num, mean, longest, last in timings:
+        lines.append(__TIMING_FORMAT__.format(name, num, mean * 1000, longest * 1000, last * 1000))
+    if len(counters) > 0:
+        lines.append(__COUNTER_HEADER__)
+        for name, value in counters:
+            lines.append(__COUNTER_FORMAT__.format(name, value))
+    return lines
+
+
+def dump(path):
+    '''Writes the statistics to the specified file as JSON'''
+    with __lock__:
+        data = {
+            'timings': {name: timing.to_dict() for name, timing in sorted(__timings__.items())},
+            'counters': dict(sorted(__counters__.items())),
+        }
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.write('\n')
@@ -1,9 +1,15 @@
+import collections
 import curses, curses.panel
+import itertools
 import time
 
 from enum import Enum
 
 import audio
+import dsp
+import library
+import stats
+import waveform
 
 # -----------------------------------------
 # Types
@@ -12,6 +18,7 @@ import audio
 class MainPanelMode(Enum):
     HELP = 1
     DETAILS = 2
+    STATS = 3
 
 
 # -----------------------------------------
@@ -19,15 +26,29 @@ class MainPanelMode(Enum):
 # -----------------------------------------
 
 __SPLASH_TEXT__ = "Welcome to Argon Music Player!"
+__SPLASH_CHAR_DELAY__ = 0.01    # Seconds between the characters of the splash text appearing
+__SPLASH_HOLD__ = 0.3           # Seconds the completed splash text is shown for
 __PLAYLIST_HEADER__ = " PLAYLIST"
+__PLAYLIST_SCROLL_HEADER__ = " PLAYLIST ({}-{} of {})"
+__SEARCH_HEADER__ = " SEARCH ({} matches)"
+__SEARCH_SCROLL_HEADER__ = " SEARCH ({}-{} of {} matches)"
+__SEARCH_PROMPT__ = "/{}"
 __MAIN_HEADER__ = "{}"
 __INPUT_PROMPT_CHAR__ = ": "
 __OUTPUT_FORMAT__ = "< {} >"
+__OUTPUT_MORE_FORMAT__ = "< {} > (+{})"     # A message followed by others waiting to be shown
 __PLAYBACK_BAR_HEIGHT__ = 5
 __PLAYBACK_BAR_HEADER__ = " NOW PLAYING: {}"
 __PLAYBACK_BAR_INFO__ = "{}"
+__PLAYBACK_BAR_VOLUME__ = "VOL {}%  RG {} "
+__PLAYBACK_BAR_ORDER__ = "{}RPT {}  "
+__PLAYBACK_BAR_SHUFFLE__ = "SHUF  "
 
 __UNKNOWN_TRACK_DATA__ = "Unknown"
+__TRACK_LABEL__ = "{} - {}"
+__PLAYLIST_ROW__ = "{}. {}"
+__PLAYLIST_UP_NEXT_ROW__ = "{}. [{}] {}"     # A track in the up next queue, with its position in the queue
+__UP_NEXT_MARKS__ = 99          # Tracks at the front of the up next queue that are marked in the playlist
 
 # -----------------------------------------
 # Global variables
@@ -42,9 +63,25 @@ __playbacK_title = __PLAYBACK_BAR_HEADER__
 __main_panel = None
 __main_width = None
 __main_state = MainPanelMode.DETAILS
+__status = None                 # Message displayed at the bottom of the main panel, until replaced
+__messages = collections.deque()    # Messages written to the command line, displayed in turn (in place of the status) until dismissed
+__force_refresh = False         # Whether the next refresh redraws the whole screen
 
 __playlist = None
 __playlist_width = None
+__playlist_scroll = 0           # Index of the first playlist entry in view
+__playlist_follow = True        # Whether the view should keep the current track visible
+__playlist_last_idx = None
+
+__search_query = None           # Query typed while searching the playlist, or None when not searching
+__search_matches = set()        # Ids of the playlist tracks matching the query
+__search_results = []           # Ids of the first matches (as many as have been shown), in playlist order
+__search_version = None         # Search version (see audio.get_search_version) that the matches were found in
+__search_selected = 0           # Index (within the results) of the selected match
+__search_scroll = 0             # Index (within the results) of the first match in view
+
+__screen_size = None            # Terminal size (lines, cols) that the windows were built for
+__region_state = {}             # Region name -> the state it was last drawn with
 
 
 # -----------------------------------------
@@ -56,8 +93,16 @@ def init():
     global __stdscr
     __stdscr = curses.initscr()
     __stdscr.keypad(True)
+    __stdscr.nodelay(True)  # do not block when reading keys; the input listener waits for input itself
     curses.noecho()         # do not echo input
     curses.cbreak()         # do not wait for Enter after input
+    if hasattr(curses, 'set_escdelay'):
+        curses.set_escdelay(25) # Esc cancels a search, so do not wait long for the rest of an escape sequence
+
+
+def is_active():
+    '''Returns whether the terminal-based GUI has been initialized'''
+    return __stdscr is not None
 
 
 def deinit():
@@ -69,38 +114,65 @@ def deinit():
     curses.endwin()
 
 
-def refresh_thread():
-    while(True):
-        time.sleep(1)
-        refresh()
-
+def refresh(force = False):
+    '''Redraws the regions of the UI whose state has changed since they were last drawn.
+       The windows are only rebuilt when the terminal has been resized, or when a full redraw is forced.'''
+    global __playback_width, __main_width, __playlist_width, __screen_size, __force_refresh
 
-def refresh():
-    '''Redraws the UI at the current terminal window size'''
+    start = stats.start()
     curses.update_lines_cols()
-    __stdscr.clear()
+    rebuild = force or __force_refresh or __screen_size != (curses.LINES, curses.COLS)
+    __force_refresh = False
 
-    global __playback_width, __main_width, __playlist_width
-    __playback_width = __main_width = (int)((curses.COLS / 4) * 3)
-    __playlist_width = (int)(curses.COLS / 4)
+    if rebuild:
+        __stdscr.clear()
+        __screen_size = (curses.LINES, curses.COLS)
+        __playback_width = __main_width = (int)((curses.COLS / 4) * 3)
+        __playlist_width = (int)(curses.COLS / 4)
 
-    draw_playback()
-    draw_main()
-    draw_playlist()
+        draw_playback()
+        draw_main()
+        draw_playlist()
+
+        __stdscr.noutrefresh()
+        __region_state.clear()
+
+    damaged = False
+    for region, get_state, update in __REGIONS:
+        if region not in __region_state or __region_state[region] != get_state():
+            region_start = stats.start()
+            update()
+            stats.stop('ui.draw.' + region, region_start)
+            # Drawing may adjust the region's own state (e.g. the playlist scroll), so we record it afterwards
+            __region_state[region] = get_state()
+            damaged = True
+
+    if rebuild or damaged:
+        curses.panel.update_panels()
+        curses.doupdate()
+        # Refreshes that draw nothing are not recorded, as they would make the stats view redraw itself on every refresh
+        stats.stop('ui.refresh', start)
+
+
+def request_full_refresh():
+    '''Makes the next refresh redraw the whole screen. Unlike refresh, this can be called by commands (see commands).'''
+    global __force_refresh
+    __force_refresh = True
 
-    update_playback()
-    update_main()
-    update_playlist()
-    
-    curses.panel.update_panels()
-    __stdscr.refresh()
+
+def invalidate(region = None):
+    '''Marks the specified region (or all regions if none is specified) to be redrawn on the next refresh'''
+    if region is None:
+        __region_state.clear()
+    else:
+        __region_state.pop(region, None)
 
 
 def display_splash():
-    '''Plays an introductory splash screen'''
+    '''Plays an introductory splash screen. It is kept short (the backend loads in the background meanwhile),
+       and any key press skips it.'''
     __stdscr.border(0)
     __stdscr.refresh()
-    time.sleep(0.5)
 
     centreY = (int)(curses.LINES / 2);  centreX = (int)(curses.COLS / 2);
     halfSplashLen = (int)(len(__SPLASH_TEXT__) / 2)
@@ -112,15 +184,17 @@ def display_splash():
     complete = False
     counter = 0
     while (not complete):
-        time.sleep(0.03)
+        time.sleep(__SPLASH_CHAR_DELAY__)
         __stdscr.addstr(centreY, centreX - halfSplashLen, __SPLASH_TEXT__[:counter], curses.A_BOLD)
         counter += 1
         __stdscr.refresh()
 
         if (counter >= len(__SPLASH_TEXT__)):
             complete = True
-    
-    time.sleep(1)
+        if __stdscr.getch() != -1:
+            return
+
+    time.sleep(__SPLASH_HOLD__)
     curses.beep()
 
 
@@ -133,8 +207,6 @@ def draw_playback():
 
     # Create window attached to left side of screen, 3/4 width of screen and equal to screens height.
     win = curses.newwin(__PLAYBACK_BAR_HEIGHT__, __playback_width, 0, 0)
-    win.erase()
-    win.box()
 
     global __playback_panel
     __playback_panel = curses.panel.new_panel(win)
@@ -145,8 +217,6 @@ def draw_main():
 
     # Create window attached to left side of screen, 3/4 width of screen and equal to screens height.
     win = curses.newwin(curses.LINES - __PLAYBACK_BAR_HEIGHT__, __main_width, __PLAYBACK_BAR_HEIGHT__, 0)
-    win.erase()
-    win.box()
 
     global __main_panel
     __main_panel = curses.panel.new_panel(win)
@@ -157,8 +227,6 @@ def draw_playlist():
 
     # Create window attached to right side of screen, 1/4 width of screen and equal to screens height.
     win = curses.newwin(curses.LINES, __playlist_width + 1, 0, curses.COLS - (curses.COLS - __main_width))
-    win.erase()
-    win.box()
 
     global __playlist
     __playlist = curses.panel.new_panel(win)
@@ -169,10 +237,16 @@ def draw_playlist():
 # -----------------------------------------
 
 def update_playback():
+    '''Draws the current state of playback to the playback UI element'''
     win = __playback_panel.window()
+    win.erase()
+    win.box()
     y, x = win.getmaxyx()
 
-    win.addstr(0, 1, __PLAYBACK_BAR_HEADER__.format(get_playback_state().name).ljust(x - 2), curses.A_REVERSE)
+    order = __PLAYBACK_BAR_ORDER__.format(__PLAYBACK_BAR_SHUFFLE__ if audio.is_shuffled() else '', audio.get_repeat_mode().name)
+    volume = order + __PLAYBACK_BAR_VOLUME__.format(dsp.get_volume(), dsp.get_replaygain_mode().name)
+    header = __PLAYBACK_BAR_HEADER__.format(get_playback_state().name)
+    win.addnstr(0, 1, header.ljust(x - 2 - len(volume)) + volume, x - 2, curses.A_REVERSE)
 
     if get_playback_state() is not audio.PlaybackState.STOPPED:
         track = get_current_track()
@@ -180,24 +254,28 @@ def update_playback():
             win.addnstr(1, 2, __PLAYBACK_BAR_INFO__.format(track), x - 1)
 
     current_time = get_current_track_time()
-    a, b, total_time = get_current_track_info()
+    total_time = get_current_track_duration()
 
     # Timestamps
     win.addnstr(2, 2, total_time.get_timestamp_str().rjust(x - 4), x - 2)
     win.addnstr(2, 2, current_time.get_timestamp_str(), x - 2)
 
-    # Progress bar
+    # Progress bar, drawn over the waveform of the track once its peaks are known
     fill = 0
     if total_time.totalseconds > 0:
-        fill = int((x - 4) * (current_time.totalseconds / total_time.totalseconds)) + 1
+        fill = min(x - 4, int((x - 4) * (current_time.totalseconds / total_time.totalseconds)) + 1)
+    bar = waveform.get_bar(get_current_track_peaks(), x - 4) or ''.ljust(x - 4)
     win.addnstr(3, 1, '[', x - 1)
     win.addnstr(3, x - 2, ']', x - 1)
-    win.addnstr(3, 2, ''.ljust(fill), x - 2, curses.A_REVERSE)
+    win.addnstr(3, 2, bar[:fill], x - 2, curses.A_REVERSE)
+    win.addnstr(3, 2 + fill, bar[fill:], x - 2 - fill)
 
 
 def update_main():
     '''Draws the current state of the main panel'''
     win = __main_panel.window()
+    win.erase()
+    win.box()
     y, x = win.getmaxyx()
 
     # Print all available modes, enclosing our current mode in brackets
@@ -213,58 +291,193 @@ def update_main():
     try:
         if __main_state is MainPanelMode.HELP:
             win.addnstr(2, start_x,  ":                                          Activates input mode", end_x)
+            win.addnstr(3, start_x,  "/                                          Searches the playlist as you type", end_x)
 
             win.addnstr(4, start_x,  "Commands:", end_x)
             win.addnstr(5, start_x,  "h | help                                   Displays information to navigate to this screen", end_x)
-            win.addnstr(6, start_x,  "m | mode   [help | details]                Changes the main panel mode", end_x)
+            win.addnstr(6, start_x,  "m | mode   [help | details | stats]        Changes the main panel mode", end_x)
             win.addnstr(7, start_x,  "p | play                                   Toggles play / pause of the current track", end_x)
             win.addnstr(8, start_x,  "p | play   [-f | -file] [filename]         Plays the file specified", end_x)
             win.addnstr(9, start_x,  "p | play   [playlist_track_num]            Plays the track specified from the playlist", end_x)
             win.addnstr(10, start_x, "s | stop                                   Stops playback", end_x)
             win.addnstr(11, start_x, "a | add    [filename [, ...]]              Adds the file(s) specified to the playlist", end_x)
-            win.addnstr(12, start_x, "a | add    -dir                            Adds all supported audio files in the current directory", end_x)
+            win.addnstr(12, start_x, "a | add    [-dir | -r] [directory]         Adds all supported audio files in the directory (-r: and subdirectories)", end_x)
             win.addnstr(13, start_x, "r | remove [playlist_track_num [, ...]]    Removes the track(s) specified from the playlist", end_x)
             win.addnstr(14, start_x, "r | remove [-all | -a]                     Removes all tracks from the playlist", end_x)
-            win.addnstr(15, start_x, "q | quit                                   Quits the applicatio safely", end_x)
-
-            win.addnstr(17, start_x, "Quick controls:  ", end_x)
-            win.addnstr(18, start_x, "p|spacebar:play/pause     s:stop     b:previous     n:next", end_x)
+            win.addnstr(15, start_x, "mv | move  [from_track_num] [to_track_num] Moves a track to another position in the playlist", end_x)
+            win.addnstr(16, start_x, "ld | load  [filename]                      Adds the tracks of a playlist file (M3U, PLS or XSPF)", end_x)
+            win.addnstr(17, start_x, "sv | save  [filename]                      Saves the playlist to a playlist file (M3U, PLS or XSPF)", end_x)
+            win.addnstr(18, start_x, "eq | enqueue [track_num | from-to [, ...]] Queues the track(s) specified to play next", end_x)
+            win.addnstr(19, start_x, "dq | dequeue [queue_pos [, ...] | -all]    Removes the track(s) specified from the up next queue", end_x)
+            win.addnstr(20, start_x, "qu | queue                                 Shows the up next queue (queued tracks are marked [n])", end_x)
+            win.addnstr(21, start_x, "f | find   [query]                         Searches the playlist for the tracks matching the query", end_x)
+            win.addnstr(22, start_x, "sk | seek  [+ | -][[hh:]mm:]ss             Seeks to a timestamp, or forwards/backwards by a time", end_x)
+            win.addnstr(23, start_x, "v | volume [0-100 | +n | -n]               Sets the volume, or raises/lowers it by n percent", end_x)
+            win.addnstr(24, start_x, "rg | replaygain [off | track | album]      Sets how tracks are normalized by their ReplayGain", end_x)
+            win.addnstr(25, start_x, "sh | shuffle [on | off]                    Turns shuffle on or off (toggles it without an argument)", end_x)
+            win.addnstr(26, start_x, "rp | repeat [off | one | all]              Sets what plays after the end of the playlist, or of the track", end_x)
+            win.addnstr(27, start_x, "an | analyze [-library | -cancel]          Analyzes the playlist (or library) in the background", end_x)
+            win.addnstr(28, start_x, "cancel                                     Cancels running commands, directory scans and analysis", end_x)
+            win.addnstr(29, start_x, "q | quit                                   Quits the applicatio safely", end_x)
+
+            win.addnstr(31, start_x, "Quick controls:  ", end_x)
+            win.addnstr(32, start_x, "p|spacebar:play/pause     s:stop     b:previous     n:next     z:shuffle     r:repeat", end_x)
+            win.addnstr(33, start_x, "up/down:scroll     pgup/pgdn:page     home/end:top/bottom     c:current track", end_x)
+            win.addnstr(34, start_x, "left/right:seek 5s     shift+left/right:seek 60s     +/-:volume     ctrl+c:cancel", end_x)
+            win.addnstr(35, start_x, "While searching:  up/down:select     enter:play selected     esc:cancel", end_x)
             
 
         elif __main_state is MainPanelMode.DETAILS:
-            info, audiof, duration = get_current_track_info()
-            
-            if info is not None:
-                win.addnstr(2, start_x, "Title: {}".format(info.title.decode('utf-8') if info.title else __UNKNOWN_TRACK_DATA__), end_x)
-                win.addnstr(3, start_x, "Artist: {}".format(info.author.decode('utf-8') if info.author else __UNKNOWN_TRACK_DATA__), end_x)
-                win.addnstr(4, start_x, "Album: {}".format(info.album.decode('utf-8') if info.album else __UNKNOWN_TRACK_DATA__), end_x)
-                win.addnstr(5, start_x, "Year: {}".format(info.year if info.year else __UNKNOWN_TRACK_DATA__), end_x)
-                win.addnstr(6, start_x, "Track: {}".format(info.track if info.track else __UNKNOWN_TRACK_DATA__), end_x)
-                win.addnstr(7, start_x, "Duration: {}".format(duration.get_timestamp_str() if duration else __UNKNOWN_TRACK_DATA__), end_x)
-                win.addnstr(8, start_x, "Genre: {}".format(info.genre.decode('utf-8') if info.genre else __UNKNOWN_TRACK_DATA__), end_x)
-            if audiof is not None:
-                win.addnstr(10, start_x, "Channels: {}".format(audiof.channels if audiof.channels else __UNKNOWN_TRACK_DATA__), end_x)
-                win.addnstr(11, start_x, "Sample rate: {}".format(audiof.sample_rate if audiof.sample_rate else __UNKNOWN_TRACK_DATA__), end_x)
-                win.addnstr(12, start_x, "Sample size: {}".format(audiof.sample_size if audiof.sample_size else __UNKNOWN_TRACK_DATA__), end_x)
+            meta = get_current_track_metadata()
+
+            if meta is not None:
+                win.addnstr(2, start_x, "Title: {}".format(meta.title or __UNKNOWN_TRACK_DATA__), end_x)
+                win.addnstr(3, start_x, "Artist: {}".format(meta.author or __UNKNOWN_TRACK_DATA__), end_x)
+                win.addnstr(4, start_x, "Album: {}".format(meta.album or __UNKNOWN_TRACK_DATA__), end_x)
+                win.addnstr(5, start_x, "Year: {}".format(meta.year or __UNKNOWN_TRACK_DATA__), end_x)
+                win.addnstr(6, start_x, "Track: {}".format(meta.track or __UNKNOWN_TRACK_DATA__), end_x)
+                win.addnstr(7, start_x, "Duration: {}".format(format_duration(meta.duration) if meta.duration else __UNKNOWN_TRACK_DATA__), end_x)
+                win.addnstr(8, start_x, "Genre: {}".format(meta.genre or __UNKNOWN_TRACK_DATA__), end_x)
+
+                win.addnstr(10, start_x, "Channels: {}".format(meta.channels or __UNKNOWN_TRACK_DATA__), end_x)
+                win.addnstr(11, start_x, "Sample rate: {}".format(meta.sample_rate or __UNKNOWN_TRACK_DATA__), end_x)
+                win.addnstr(12, start_x, "Sample size: {}".format(meta.sample_size or __UNKNOWN_TRACK_DATA__), end_x)
+
+        elif __main_state is MainPanelMode.STATS:
+            # Leave room for the status line at the bottom of the panel
+            for i, line in enumerate(stats.get_lines()[:max(0, y - 5)]):
+                win.addnstr(2 + i, start_x, line, end_x)
+
+        if __search_query is not None:
+            win.addnstr(y - 2, start_x, __SEARCH_PROMPT__.format(__search_query), end_x)
+        elif len(__messages) > 1:
+            win.addnstr(y - 2, start_x, __OUTPUT_MORE_FORMAT__.format(__messages[0], len(__messages) - 1), end_x)
+        elif len(__messages) > 0:
+            win.addnstr(y - 2, start_x, __OUTPUT_FORMAT__.format(__messages[0]), end_x)
+        elif __status is not None:
+            win.addnstr(y - 2, start_x, __OUTPUT_FORMAT__.format(__status), end_x)
     except:
         pass
 
 
 def update_playlist():
-    '''Draws the current playlist to the playlist UI element'''
+    '''Draws the visible slice of the playlist to the playlist UI element.
+       Only the rows that fit in the window are formatted, so the cost of a redraw does not depend on the playlist length.'''
+    global __playlist_scroll, __playlist_follow, __playlist_last_idx
+
     win = __playlist.window()
+    win.erase()
+    win.box()
     y, x = win.getmaxyx()
-    
-    win.addstr(0, 1, __PLAYLIST_HEADER__.ljust(x - 2), curses.A_REVERSE)
-    
-    width = __playlist_width - 1
+
+    if __search_query is not None:
+        update_search_results(win)
+        return
+
+    tracks = get_playlist_tracks()
+    count = len(tracks)
+    rows = get_playlist_rows()
+    current_idx = get_current_track_idx()
+
+    # Whenever the current track changes we resume following it, otherwise we respect the user's scroll position.
+    if current_idx != __playlist_last_idx:
+        __playlist_last_idx = current_idx
+        __playlist_follow = True
+
+    if __playlist_follow and rows > 0:
+        if current_idx < __playlist_scroll or current_idx >= __playlist_scroll + rows:
+            __playlist_scroll = current_idx - int(rows / 2)
+
+    __playlist_scroll = clamp_playlist_scroll(__playlist_scroll, count, rows)
+
+    header = __PLAYLIST_HEADER__
+    if count > rows:
+        header = __PLAYLIST_SCROLL_HEADER__.format(__playlist_scroll + 1, __playlist_scroll + rows, count)
+    win.addnstr(0, 1, header.ljust(x - 2), x - 2, curses.A_REVERSE)
+
+    width = x - 2
+    offset = 1
+    up_next = audio.get_up_next_positions(__UP_NEXT_MARKS__)
+    ids = tracks.iter_ids(__playlist_scroll, __playlist_scroll + rows) if len(up_next) > 0 else itertools.repeat(None)
+    for track, track_id in zip(tracks[__playlist_scroll:__playlist_scroll + rows], ids):
+        index = __playlist_scroll + offset - 1
+        highlight = curses.A_REVERSE if (index == current_idx) else curses.A_NORMAL
+        if track_id in up_next:
+            label = __PLAYLIST_UP_NEXT_ROW__.format(index + 1, up_next[track_id], get_track_label(track))
+        else:
+            label = __PLAYLIST_ROW__.format(index + 1, get_track_label(track))
+        duration = get_track_duration_label(track)
+        win.addnstr(offset, 1, label[:max(0, width - len(duration))].ljust(width - len(duration)) + duration, width, highlight)
+        offset = offset + 1
+
+
+def update_search_results(win):
+    '''Draws the visible slice of the search results to the playlist UI element, numbered by their playlist index'''
+    global __search_scroll
+
+    y, x = win.getmaxyx()
+    refresh_search_results()
+    count = len(__search_matches)
+    rows = get_playlist_rows()
+
+    # Keep the selected match in view
+    if __search_selected < __search_scroll:
+        __search_scroll = __search_selected
+    elif __search_selected >= __search_scroll + rows:
+        __search_scroll = __search_selected - rows + 1
+    __search_scroll = clamp_playlist_scroll(__search_scroll, count, rows)
+
+    header = __SEARCH_HEADER__.format(count)
+    if count > rows:
+        header = __SEARCH_SCROLL_HEADER__.format(__search_scroll + 1, __search_scroll + rows, count)
+    win.addnstr(0, 1, header.ljust(x - 2), x - 2, curses.A_REVERSE)
+
+    width = x - 2
     offset = 1
-    for track in get_playlist_tracks():
-        highlight = curses.A_REVERSE if (offset - 1 == get_current_track_idx()) else curses.A_NORMAL
-        win.addnstr(offset, 1 , "{}. {}".format(offset, track).ljust(width), width, highlight)
+    for track_id in get_search_results(__search_scroll + rows)[__search_scroll:]:
+        index = audio.get_playlist_track_idx(track_id)
+        highlight = curses.A_REVERSE if (__search_scroll + offset - 1 == __search_selected) else curses.A_NORMAL
+        win.addnstr(offset, 1, "{}. {}".format(index + 1, get_track_label(audio.get_playlist_track_path(track_id))).ljust(width), width, highlight)
         offset = offset + 1
 
-    curses.panel.update_panels()
+
+def scroll_playlist(lines):
+    '''Scrolls the playlist view by the specified number of lines (negative values scroll up)'''
+    global __playlist_scroll, __playlist_follow
+    __playlist_follow = False
+    __playlist_scroll = clamp_playlist_scroll(__playlist_scroll + lines, len(get_playlist_tracks()), get_playlist_rows())
+
+
+def page_playlist(pages):
+    '''Scrolls the playlist view by the specified number of pages (negative values scroll up)'''
+    scroll_playlist(pages * max(1, get_playlist_rows()))
+
+
+def scroll_playlist_to(index):
+    '''Scrolls the playlist view so that the playlist entry at the specified index is at the top'''
+    global __playlist_scroll, __playlist_follow
+    __playlist_follow = False
+    __playlist_scroll = clamp_playlist_scroll(index, len(get_playlist_tracks()), get_playlist_rows())
+
+
+def follow_current_track():
+    '''Returns the playlist view to the current track and keeps it in view'''
+    global __playlist_follow, __playlist_last_idx
+    __playlist_follow = True
+    __playlist_last_idx = None
+
+
+def get_playlist_rows():
+    '''Returns the number of playlist entries that fit in the playlist UI element'''
+    if __playlist is None:
+        return 0
+    y, x = __playlist.window().getmaxyx()
+    return max(0, y - 2)
+
+
+def clamp_playlist_scroll(scroll, count, rows):
+    '''Limits a scroll position so that the view never extends past either end of the playlist'''
+    return max(0, min(scroll, count - rows))
 
 
 # -----------------------------------------
@@ -281,20 +494,115 @@ def read_cmd_line(message = ''):
 
     # Display string prompt with message. Adjust cursor pos according to input indicator and any message, and limit to length of input panel.
     curses.echo()
+    __stdscr.nodelay(False)
     cmd = __stdscr.getstr(curses.LINES - 2, 1 + len(__INPUT_PROMPT_CHAR__) + len(message), __main_width - len(__INPUT_PROMPT_CHAR__) - len(message) - 2).decode(encoding="utf-8")
+    __stdscr.nodelay(True)
     curses.noecho()
 
+    # The command line is drawn over the main panel, so it must be repainted on the next refresh
+    invalidate('main')
     return cmd
 
 
 def write_cmd_line(message):
-    '''Writes the provided message to the input panel, halting until the user provides input to dismiss it'''
+    '''Writes the provided message to the command line, at the bottom of the main panel. Messages are shown in turn,
+       each until a key is pressed (see dismiss_cmd_line). Does not wait for the key.'''
+    __messages.append(message)
 
-    __stdscr.hline(curses.LINES - 3, 1, '_', __main_width - 2)
-    __stdscr.addnstr(curses.LINES - 2, 1, __OUTPUT_FORMAT__.format(message).ljust(__main_width - 2), __main_width - 2)
-    __stdscr.refresh()
-    # Halt until user presses another key
-    __stdscr.getch()
+
+def dismiss_cmd_line():
+    '''Dismisses the message shown on the command line, showing the next, if any'''
+    if len(__messages) > 0:
+        __messages.popleft()
+
+
+# -----------------------------------------
+# Search
+# -----------------------------------------
+
+def start_search():
+    '''Starts searching the playlist. Until the search ends, the playlist UI element shows the tracks matching the query.'''
+    set_search_query('')
+
+
+def end_search():
+    '''Stops searching the playlist, showing the whole playlist again'''
+    global __search_query, __search_matches, __search_results, __search_version
+    __search_query = None
+    __search_matches = set()
+    __search_results = []
+    __search_version = None
+
+
+def is_searching():
+    return __search_query is not None
+
+
+def get_search_query():
+    return __search_query
+
+
+def set_search_query(query):
+    '''Sets the query of the search, finding its matches and selecting the first'''
+    global __search_query, __search_version, __search_selected, __search_scroll
+    __search_query = query
+    __search_version = None
+    __search_selected = 0
+    __search_scroll = 0
+    refresh_search_results()
+
+
+def refresh_search_results():
+    '''Finds the matches of the query again if they may have changed (e.g. the playlist was edited) since they were found'''
+    global __search_matches, __search_results, __search_version, __search_selected
+    if __search_version == audio.get_search_version():
+        return
+    __search_version = audio.get_search_version()
+    __search_matches = audio.search_playlist(__search_query) or set()
+    __search_results = []
+    __search_selected = max(0, min(__search_selected, len(__search_matches) - 1))
+
+
+def get_search_results(stop):
+    '''Returns the matches up to index stop, in playlist order. Matches are only put in order as far as they are
+       shown, and then further ahead, so that scrolling through them does not order them again each time.'''
+    global __search_results
+    if len(__search_results) < min(stop, len(__search_matches)):
+        __search_results = audio.order_search_matches(__search_matches, max(stop, 2 * len(__search_results)))
+    return __search_results[:stop]
+
+
+def move_search_selection(lines):
+    '''Moves the selection by the specified number of matches (negative values move up)'''
+    global __search_selected
+    __search_selected = max(0, min(__search_selected + lines, len(__search_matches) - 1))
+
+
+def page_search_selection(pages):
+    '''Moves the selection by the specified number of pages (negative values move up)'''
+    move_search_selection(pages * max(1, get_playlist_rows()))
+
+
+def get_search_selection():
+    '''Returns the (0-based) playlist index of the selected match, or None if nothing matches'''
+    refresh_search_results()
+    if len(__search_matches) == 0:
+        return None
+    return audio.get_playlist_track_idx(get_search_results(__search_selected + 1)[__search_selected])
+
+
+def set_status(message):
+    '''Sets the message displayed at the bottom of the main panel. Unlike write_cmd_line this needs no dismissing.'''
+    global __status
+    __status = message
+
+
+def read_key():
+    '''Returns the next key pressed, or None if no key is waiting. Does not block.'''
+    try:
+        return __stdscr.getkey()
+    except curses.error:
+        return None
 
 
 # -----------------------------------------
@@ -317,17 +625,78 @@ def get_playback_state():
     '''Returns the current state of playback from the audio controller'''
     return audio.get_playback_state()
 
-def get_current_track_info():
-    '''Returns info regarding the currently playing track'''
-    return audio.get_current_track_info()
+def get_current_track_duration():
+    '''Returns the total playing time of the currently playing track'''
+    return audio.get_current_track_duration()
 
 def get_current_track_time():
     '''Returns the timestamp of the currently playing track'''
     return audio.get_current_track_time()
 
+def get_current_track_peaks():
+    '''Returns the peaks of the waveform of the current track, or None if they are not known'''
+    if get_playback_state() is audio.PlaybackState.STOPPED:
+        return None
+    return waveform.get_peaks(audio.get_playing_track())
+
+def get_current_track_metadata():
+    '''Returns the library metadata of the currently playing track'''
+    return audio.get_current_track_metadata()
+
+def get_track_label(track):
+    '''Returns the text to display for a track in the playlist: its artist and title if they are known, otherwise its path'''
+    meta = library.get_metadata(track)
+    if meta is None or not meta.title:
+        return track
+    if meta.author:
+        return __TRACK_LABEL__.format(meta.author, meta.title)
+    return meta.title
+
+def get_track_duration_label(track):
+    '''Returns the duration of a track as displayed after its label in the playlist, or '' if it is not known'''
+    meta = library.get_cached_metadata(track)
+    if meta is None or not meta.duration:
+        return ''
+    return ' ' + format_duration(meta.duration)
+
+def format_duration(seconds):
+    '''Returns a duration in seconds as a timestamp string'''
+    return audio.Duration.from_seconds(seconds).get_timestamp_str()
+
+
+def get_playback_region_state():
+    '''Returns the state displayed by the playback UI element, used to detect when it must be redrawn'''
+    return (get_playback_state(), get_current_track(), get_current_track_time(), get_current_track_duration(), waveform.get_version(), dsp.get_version(),
+            audio.is_shuffled(), audio.get_repeat_mode())
+
+def get_main_region_state():
+    '''Returns the state displayed by the main UI element, used to detect when it must be redrawn'''
+    stats_version = stats.get_version() if __main_state is MainPanelMode.STATS else None
+    message = __messages[0] if len(__messages) > 0 else None
+    return (__main_state, __status, message, len(__messages), __search_query, get_playback_state(), get_current_track(), audio.get_playing_track(),
+            library.get_version(), stats_version)
+
+def get_playlist_region_state():
+    '''Returns the state displayed by the playlist UI element, used to detect when it must be redrawn'''
+    search_version = audio.get_search_version() if __search_query is not None else None
+    return (audio.get_playlist_version(), audio.get_up_next_version(), library.get_version(), get_current_track_idx(), __playlist_scroll, __playlist_follow,
+            __search_query, search_version, __search_selected, __search_scroll)
+
+
+def get_mode():
+    '''Returns the mode of the app (main panel)'''
+    return __main_state
 
 def set_mode(mode):
     '''Sets the mode of the app (main panel)'''
     global __main_state
     if (isinstance(mode, MainPanelMode)):
-        __main_state = mode
\ No newline at end of file
+        __main_state = mode
+
+
+# Each region is drawn by its update function, only when the state returned by its state function has changed
+__REGIONS = [
+    ('playback', get_playback_region_state, update_playback),
+    ('main', get_main_region_state, update_main),
+    ('playlist', get_playlist_region_state, update_playlist),
+]
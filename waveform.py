@@ -0,0 +1,200 @@
+'''
+Peak envelopes of tracks, drawn as the seek bar of the playback panel. Computing them requires NumPy, which is
+optional: without it the seek bar is drawn as a plain progress bar.
+'''
+
+import concurrent.futures
+import functools
+import os
+import threading
+
+import backend
+import dsp
+import library
+import stats
+
+
+# -----------------------------------------
+# Types
+# -----------------------------------------
+
+class PeakMeter(object):
+    '''Computes the peaks of a track as its frames are added. Each batch of frames is reduced as a whole to the peaks
+       of blocks of frames, and the block peaks are reduced to __PEAK_COUNT__ peaks once the whole track has been added.'''
+
+    def __init__(self):
+        numpy = backend.get_numpy()
+        self.__blocks = []          # Arrays of the peaks of blocks
+        self.__pending = numpy.empty(0, dtype=numpy.float32)     # Frame amplitudes that do not fill a block yet
+
+    def add(self, frames):
+        '''Adds an array of frames (see dsp.read_frames)'''
+        numpy = backend.get_numpy()
+        amplitudes = numpy.concatenate((self.__pending, numpy.abs(frames).max(axis=1)))
+        whole = len(amplitudes) - len(amplitudes) % __BLOCK_FRAMES__
+        self.__blocks.append(amplitudes[:whole].reshape(-1, __BLOCK_FRAMES__).max(axis=1))
+        self.__pending = amplitudes[whole:]
+
+    def get_peaks(self):
+        '''Returns the peaks of the frames added, scaled to 0-255, as bytes. Returns None if no frames were added.'''
+        blocks = self.__blocks + ([self.__pending.max(keepdims=True)] if len(self.__pending) > 0 else [])
+        if len(blocks) == 0:
+            return None
+        return reduce_peaks(backend.get_numpy().concatenate(blocks))
+
+
+# -----------------------------------------
+# Global constants
+# -----------------------------------------
+
+__CACHE_KIND__ = 'waveform'
+__PEAK_COUNT__ = 512            # Peaks stored per track, each the loudest sample of its slice of the track, scaled to 0-255
+__BLOCK_FRAMES__ = 1024         # Frames reduced to a single peak as the track is decoded
+__LEVELS__ = ' .:-=+*#%'        # Characters drawn for increasing peak levels
+__BAR_CACHE_SIZE__ = 64         # Seek bars kept, by peaks and width
+
+
+# -----------------------------------------
+# Global variables
+# -----------------------------------------
+
+__lock__ = threading.Lock()
+__peaks__ = {}                  # Absolute path -> peaks (bytes), or None if they cannot be computed
+__pending__ = set()             # Absolute paths whose peaks are being computed
+__worker__ = None               # Executor that computes peaks off the input thread
+__version__ = 0                 # Incremented whenever the peaks of a track become available
+
+
+# -----------------------------------------
+# Functions
+# -----------------------------------------
+
+def is_available():
+    '''Returns whether peaks can be computed, i.e. whether NumPy is installed'''
+    return backend.has_numpy()
+
+
+def get_version():
+    return __version__
+
+
+def get_peaks(path):
+    '''Returns the peaks of the specified file, or None if they are not yet known or cannot be computed.
+       Peaks are read from the library, or otherwise computed in the background once per file, and become available
+       once get_version() changes.'''
+    if path is None or not is_available():
+        return None
+
+    key = os.path.abspath(path)
+    with __lock__:
+        if key in __peaks__:
+            return __peaks__[key]
+        if key in __pending__:
+            return None
+
+    try:
+        stat = os.stat(key)
+    except OSError:
+        return None
+
+    data = library.lookup_blob(__CACHE_KIND__, key, stat)
+    if data is not None:
+        peaks = data if len(data) > 0 else None
+        with __lock__:
+            __peaks__[key] = peaks
+        return peaks
+
+    request_peaks(key, stat)
+    return None
+
+
+def request_peaks(key, stat):
+    '''Computes the peaks of the specified file on the worker thread'''
+    global __worker__
+    with __lock__:
+        if key in __pending__:
+            return
+        __pending__.add(key)
+        if __worker__ is None:
+            __worker__ = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    __worker__.submit(compute, key, stat)
+
+
+def compute(key, stat):
+    '''Decodes the specified file to compute its peaks, and stores them in the library'''
+    start = stats.start()
+    try:
+        peaks = compute_peaks(key)
+    except Exception:
+        peaks = None
+    stats.stop('waveform.compute', start)
+
+    try:
+        store_peaks(key, stat, peaks)
+    finally:
+        with __lock__:
+            __pending__.discard(key)
+
+
+def store_peaks(key, stat, peaks):
+    '''Stores the peaks of the specified file (None if they cannot be computed), both in memory and in the library'''
+    global __version__
+    try:
+        library.store_blob(__CACHE_KIND__, key, stat, peaks if peaks is not None else b'')
+    finally:
+        with __lock__:
+            __peaks__[key] = peaks
+            __version__ = __version__ + 1
+
+
+def compute_peaks(path):
+    '''Decodes the specified file and returns its peaks (see PeakMeter), or None if they cannot be computed'''
+    source = backend.get_pyglet().media.load(path, streaming=True)
+    meter = PeakMeter()
+    for frames in dsp.read_frames(source):
+        meter.add(frames)
+    return meter.get_peaks()
+
+
+def get_bar(peaks, width):
+    '''Returns the seek bar of the specified peaks, as a string of width characters'''
+    if peaks is None or width <= 0:
+        return None
+    return draw_bar(peaks, width)
+
+
+def close():
+    '''Stops computing peaks'''
+    global __worker__
+    if __worker__ is not None:
+        __worker__.shutdown(wait=True, cancel_futures=True)
+        __worker__ = None
+
+
+# -----------------------------------------
+# Helpers
+# -----------------------------------------
+
+def reduce_peaks(blocks):
+    '''Reduces the peaks of blocks of frames (full scale being 1.0) to __PEAK_COUNT__ peaks scaled to 0-255, returned as bytes'''
+    numpy = backend.get_numpy()
+    starts = numpy.arange(__PEAK_COUNT__) * len(blocks) // __PEAK_COUNT__
+    if len(blocks) >= __PEAK_COUNT__:
+        peaks = numpy.maximum.reduceat(blocks, starts)
+    else:
+        peaks = blocks[starts]
+    return numpy.minimum(peaks * 255, 255).astype(numpy.uint8).tobytes()
+
+
+@functools.lru_cache(maxsize=__BAR_CACHE_SIZE__)
+def draw_bar(peaks, width):
+    '''Returns the characters of a seek bar width characters wide, each showing the loudest of the peaks it spans.
+       Bars are cached, so redrawing the playback panel costs no more than drawing a plain progress bar.'''
+    top = len(__LEVELS__) - 1
+    chars = []
+    for i in range(width):
+        start = i * len(peaks) // width
+        end = max(start + 1, (i + 1) * len(peaks) // width)
+        # Any sound at all is drawn above the lowest level, so that quiet passages remain visible
+        chars.append(__LEVELS__[(max(peaks[start:end]) * top + 254) // 255])
+    return ''.join(chars)